@@ -5,18 +5,16 @@ from shiny import reactive, render # reactivity (i.e. calculations)
 from shiny.ui import page_navbar # for adding a navbar
 from shiny.types import FileInfo
 import plotly.graph_objects as go # graph
+import pandas as pd # batch results table
 from shinywidgets import render_widget # rendering graph
 import functions # functions from functions.py
 import nextcladefunctions
 import re # regex
+import os
+import asyncio # waiting for background Nextclade jobs
 from pathlib import Path
 import faicons
 from htmltools import HTML
-import os
-import time
-import subprocess
-import shutil
-import stat
 from shiny import ui as core_ui
 
 ui.page_opts(
@@ -31,6 +29,19 @@ with ui.nav_control():
 
 css_file = Path(__file__).parent / "css" / "styles.css"
 
+# the FAQ promises that uploads and their results aren't kept, so the Nextclade result cache is off in the app
+# unless a cache size is set explicitly
+if 'NEXTCLADE_CACHE_SIZE' not in os.environ:
+    nextcladefunctions.result_cache.max_entries = 0
+
+# every distribution listed in the registry (data/distributions.json); this file runs once per session,
+# but the tables are loaded once per worker process and only read here. Their bin counts come
+# memory-mapped from the compiled reference store, shared by every app worker on the host
+reference_tables = functions.get_reference_tables()
+# total number of mutations in each distribution, for normalizing the histogram
+totals = reference_tables.totals()
+display_names = dict(zip(reference_tables.names, reference_tables.display_names))
+
 # Name of application tab
 with ui.nav_panel("Home"):
     with ui.card():
@@ -97,40 +108,42 @@ with ui.nav_panel("Home"):
                     ui.input_text_area("var4", "Please enter a comma-separated list of the lineage-defining mutations (using genomic nucleotide positions, example shown)", 
                                         "C897A, G3431T, A7842G, C8293T, G8393A, G11042T, C12789T, T13339C, T15756A, A18492G, ins21608, C21711T, G21941T, T22032C, C22208T, A22034G, C22295A, C22353A, A22556G, G22770A, G22895C, T22896A, G22898A, A22910G, C22916T, del23009, G23012A, C23013A, T23018C, T23019C, C23271T, C23423T, A23604G, C24378T, C24990T, C25207T, A26529C, A26610G, C26681T, C26833T, C28958A",autoresize=True,)
                     'Power analyses suggest that a minimum of 10 lineage-defining mutations are needed for accurate results.'
+            # the Nextclade job analyzing this session's upload in the background, and why an upload was turned away
+            nextclade_job = reactive.value(None)
+            nextclade_rejected = reactive.value('')
             with ui.panel_conditional("input.var2 === '2'"):
                 #with ui.tooltip(id="cond_tooltip2", placement="right"):
-                ui.input_file("file1", "Please select a file that contains a SARS-CoV-2 genome consensus sequence (FASTA header required, U must be converted to T)", accept=['.fasta', '.FASTA', '.fa'], multiple = False,)
+                ui.input_file("file1", "Please select a file that contains one or more SARS-CoV-2 genome consensus sequences (FASTA headers required, U must be converted to T)", accept=['.fasta', '.FASTA', '.fa'], multiple = False,)
+                @render.text
+                def nextclade_progress():
+                    job = nextclade_job.get()
+                    if job is None:
+                        return nextclade_rejected.get()
+                    # check on the job again shortly until it has finished
+                    if not job.done():
+                        reactive.invalidate_later(0.5)
+                    return {'queued': f'Waiting for Nextclade (number {job.position()} in the queue)...',
+                            'running': 'Running Nextclade on your sequences...',
+                            'done': 'Nextclade finished. Select a sequence and click "Submit".',
+                            'failed': 'Nextclade could not analyze this file.',
+                            'cancelled': 'Nextclade analysis cancelled.'}[job.status]
+                ui.input_action_button("cancel_nextclade", "Cancel Upload Analysis", class_="btn-secondary")
+                # choose which record of a multi-record file to analyze
+                ui.input_select("record", "Select Sequence", choices=[])
                 #'You must include a SINGLE FASTA header and all U in the sequence should be converted to T.'
             
             @reactive.calc
             def parsed_file():
-                err_msg = "Error"
                 if not input.file1():
                     return
-                if not os.path.exists("./data/results/"):
-                    os.makedirs("./data/results/")
+                # the upload is analyzed in place, Nextclade copies it into a workspace of its own
+                file_path = input.file1()[0]["datapath"]
                 try:
-                    with open(input.file1()[0]["datapath"], "r") as f:
+                    with open(file_path, "r") as f:
                         content = f.read()
-                        err_msg += "read"
-                    timestr = time.strftime("%m%d-%H%M%S")
-                    file_path = Path(__file__).parent / f"./data/results/{timestr}.fasta" #need unique name
-                    os.system("chown -R shiny:shiny ./data/results/")
-                    err_msg += "own"
-                    # change permissions for the directory to 777
-                    subprocess.run(['chmod', '0777', "./data/results/"])
-                    err_msg += "mod"
-                    # make node for file in directory
-                    fh1 = os.open (f"./data/results/{timestr}.fasta", os.O_CREAT, 0o777)
-                    os.close (fh1)
-                    err_msg += "touch"
-                    with open(file_path, "w") as f2:
-                        err_msg += "open"
-                        f2.write(content)
-                        err_msg += "write"
                     return content, file_path
-                except:
-                    return err_msg, err_msg
+                except (OSError, UnicodeDecodeError):
+                    return "Error", "Error"
             
             @reactive.effect
             @reactive.event(input.file1)
@@ -142,6 +155,11 @@ with ui.nav_panel("Home"):
                 ui.input_select("var3", "Select Color Palette",
                     choices= ["plasma", "viridis", "inferno", "seaborn"])
                 'You can change the colors of the plot here.'
+
+            # window width for the likelihood ratio track
+            with ui.tooltip(id="btn_tooltip_window", placement="right"):
+                ui.input_numeric("window", "Select Likelihood Ratio Track Window (nucleotides)", 1000, min=10, max=30000, step=10)
+                'The chronic vs. global pre-VoC log likelihood ratio is calculated in a window of this width starting at every genome position.'
                 
             with ui.tooltip(id="btn_tip_submit", placement="right"):
                 ui.input_action_button("submit", "Submit", class_="btn-success")
@@ -150,69 +168,117 @@ with ui.nav_panel("Home"):
         # second column (or "card")
         with ui.card():
             private_muts = reactive.value(None)
+            # (record name, private mutations) for every record of the uploaded file
+            fasta_records = reactive.value([])
             
+            @reactive.extended_task
+            async def nextclade_task(job):
+                # Nextclade runs on a background thread, so the worker keeps serving other sessions meanwhile
+                return await asyncio.wrap_future(job.future)
+
             @reactive.effect
             @reactive.event(input.file1)
             def _():
                 results, file_path = parsed_file()
+                # a new upload replaces the one still being analyzed
+                with reactive.isolate():
+                    if nextclade_job.get() is not None:
+                        nextclade_job.get().cancel()
+                # forget the previous file's sequences, so they can't be submitted while this one is analyzed
+                fasta_records.set([])
+                ui.update_select("record", choices=[])
+                private_muts.set("Pending")
                 if results.startswith("Error"):
+                    nextclade_job.set(None)
+                    fasta_records.set([])
                     private_muts.set("Error")
                 else:
-                    private_muts.set(nextcladefunctions.execute_nextclade(file_path))
+                    try:
+                        job = nextcladefunctions.submit_job(file_path)
+                    except nextcladefunctions.QueueFullError as e:
+                        # the server is busy; tell the user now rather than making them wait
+                        nextclade_job.set(None)
+                        nextclade_rejected.set(f'The server is busy: {e}')
+                        return
+                    nextclade_rejected.set('')
+                    nextclade_job.set(job)
+                    nextclade_task.invoke(job)
+
+            @reactive.effect
+            @reactive.event(input.cancel_nextclade)
+            def _cancel_nextclade():
+                job = nextclade_job.get()
+                if job is not None:
+                    job.cancel()
+                    nextclade_task.cancel()
+
+            @reactive.effect
+            def _nextclade_done():
+                if nextclade_task.status() != "success":
+                    return
+                records = nextclade_task.result()
+                # cancelled jobs don't return any records
+                if records is None:
+                    return
+                fasta_records.set(records)
+                ui.update_select("record", choices={str(i): name for i, (name, mutations) in enumerate(records)}, selected='0')
+                private_muts.set(records[0][1] if records else "Error")
+            @reactive.effect
+            @reactive.event(input.record)
+            def _select_record():
+                # switch to the private mutations of the selected record
+                records = fasta_records.get()
+                if input.record() and int(input.record()) < len(records):
+                    private_muts.set(records[int(input.record())][1])
             @reactive.calc
-            def number_of_mutations():
-                # return the number of mutations that the user has entered
+            def parsed_mutations():
+                # parse the user's mutations (from the uploaded file, the selected lineage or the text box)
+                # once; every calculation below uses the parsed mutations
                 if private_muts.get():
-                    if private_muts.get() == "Error":
-                        return 
-                    return len(functions.parse_user_input(private_muts.get()))
+                    return functions.tokenize_mutations(private_muts.get())
                 elif input.var2() != '1':
-                    return len(functions.parse_user_input(input.var2()))
+                    return functions.tokenize_mutations(input.var2())
                 elif input.var2() == '1':
-                    return len(functions.parse_user_input(input.var4()))
+                    return functions.tokenize_mutations(input.var4())
+            @reactive.calc
+            @reactive.event(input.submit, ignore_none=False)
+            def analysis():
+                # every calculation on the submitted mutations is done once here; the outputs below only
+                # read from the result
+                return functions.analyze_mutations(input.var(), parsed_mutations(), reference_tables)
 
             @render.text
             @reactive.event(input.submit, ignore_none=False)
             def print_mutations():
+                if private_muts.get() == "Pending":
+                    # the uploaded file has no results yet
+                    if nextclade_rejected.get():
+                        return f'{nextclade_rejected.get()} Please upload your file again.'
+                    if nextclade_job.get() is not None and nextclade_job.get().done():
+                        return 'Nextclade did not finish analyzing your file. Please upload it again.'
+                    return 'Your file is still being analyzed by Nextclade. Please click "Submit" again once it has finished.'
                 if private_muts.get():
                     if private_muts.get() == "Error":
                         private_muts.set(None)
                         return 'Please double check your input to ensure that it includes only numeric nucleotide positions between 1 and 30000 (no commas inside digits) and either zero, one or two of the nucleotides A, C, T, G or U. Optionally, each list item may start OR end with "ins", "del" or "indel". Please enter ONLY the first nucleotide at which an insertion, deletion or indel occurs (e.g. del28248). Do not use "_" characters. If you uploaded a file, make sure that the file contains at least 100 nucleotides and that it is the correct file format.'
-                    transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                elif input.var2() != '1':
-                    transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                elif input.var2() == '1':
-                    transitions, transversions = functions.transition_or_transversion(input.var4())
-                if transversions == False:
-                    return 'Please double check your input to ensure that it includes only numeric nucleotide positions between 1 and 30000 (no commas inside digits) and either zero, one or two of the nucleotides A, C, T, G or U. Optionally, each list item may start OR end with "ins", "del" or "indel". Please enter ONLY the first nucleotide at which an insertion, deletion or indel occurs (e.g. del28248). Do not use "_" characters. If you uploaded a file, make sure that the file contains at least 100 nucleotides and that it is the correct file format.'
-                if number_of_mutations() == 1:
-                    return f'You have entered {number_of_mutations()} mutation.'
+                result = analysis()
+                if not result.valid:
+                    # point the user to the first entry that couldn't be parsed
+                    return f'{result.mutations.errors[0]} ' + 'Please double check your input to ensure that it includes only numeric nucleotide positions between 1 and 30000 (no commas inside digits) and either zero, one or two of the nucleotides A, C, T, G or U. Optionally, each list item may start OR end with "ins", "del" or "indel". Please enter ONLY the first nucleotide at which an insertion, deletion or indel occurs (e.g. del28248). Do not use "_" characters. If you uploaded a file, make sure that the file contains at least 100 nucleotides and that it is the correct file format.'
+                if len(result.mutations) == 1:
+                    return f'You have entered {len(result.mutations)} mutation.'
                 else:
-                    return f'You have entered {number_of_mutations()} mutations.'
+                    return f'You have entered {len(result.mutations)} mutations.'
             with ui.layout_column_wrap(width=1/2):
                 with ui.card():
                     with ui.div(style="display: flex; justify-content: center; align-items: center; height: 100%;"):
-                        @reactive.calc
-                        def get_transition_transversion_ratio():
-                                    # gui accepts input as a string, so it first needs to be split into a list 
-                                    # splits occur wherever there is a comma
-                                    # then pass to function defined in functions.py
-                                    # to get number of transitions, transversions
-                            if private_muts.get():
-                                transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                            elif input.var2() != '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                            elif input.var2() == '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var4())
-                            return transitions, transversions
-                        
                         with ui.tooltip(id="btn_tooltip3", placement="right"):        
                             @render_widget
                             @reactive.event(input.submit, ignore_none=False)
                                     # function to plot transition/transversion ratio heatmap
                             
                             def heatmap():
-                                transitions, transversions = get_transition_transversion_ratio()
+                                transitions, transversions = analysis().transitions, analysis().transversions
                                 fig2 = go.Figure()
                                 config = {'displayModeBar': False}
                                 if transversions == False:
@@ -263,189 +329,57 @@ with ui.nav_panel("Home"):
                                     @render.ui
                                     @reactive.event(input.submit, ignore_none=False)
                                     def mut_lineage():
-                                        if private_muts.get():
-                                            transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                                        elif input.var2() != '1':
-                                            transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                                        elif input.var2() == '1':
-                                            transitions, transversions = functions.transition_or_transversion(input.var4())
-                                        if transversions == False:
+                                        if not analysis().valid:
                                             return ''
-                                        if private_muts.get():
-                                            if (functions.mut_lineage_parsing(private_muts.get())[0] == '') and (functions.mut_lineage_parsing(private_muts.get())[1] == ''):
-                                                return 'NO'
-                                            else:
-                                                return f'Confirmed: {functions.mut_lineage_parsing(private_muts.get())[0]}'
-                                        if input.var2() != '1':
-                                            if (functions.mut_lineage_parsing(input.var2())[0] == '') and (functions.mut_lineage_parsing(input.var2())[1] == ''):
-                                                return 'NO'
-                                            else:
-                                                return f'Confirmed: {functions.mut_lineage_parsing(input.var2())[0]}'
-                                        elif input.var2() == '1':
-                                            if (functions.mut_lineage_parsing(input.var4())[0] == '') and (functions.mut_lineage_parsing(input.var4())[1] == ''):
-                                                return 'NO'
-                                            else:
-                                                return f'Confirmed: {functions.mut_lineage_parsing(input.var4())[0]}'
+                                        mutator_text, potential_mutator_text = analysis().mutators, analysis().potential_mutators
+                                        if (mutator_text == '') and (potential_mutator_text == ''):
+                                            return 'NO'
+                                        else:
+                                            return f'Confirmed: {mutator_text}'
 
                                     @render.ui
                                     @reactive.event(input.submit, ignore_none=False)
                                     def potential_mut_lineage():
-                                        if private_muts.get():
-                                            if (functions.mut_lineage_parsing(private_muts.get())[0] == '') and (functions.mut_lineage_parsing(private_muts.get())[1] == ''):
-                                                return ''
-                                            else:
-                                                return f'Potential: {functions.mut_lineage_parsing(private_muts.get())[1]}'
-                                        elif input.var2() != '1':
-                                            if (functions.mut_lineage_parsing(input.var2())[0] == '') and (functions.mut_lineage_parsing(input.var2())[1] == ''):
-                                                return ''
-                                            else:
-                                                return f'Potential: {functions.mut_lineage_parsing(input.var2())[1]}'
-                                        elif input.var2() == '1':
-                                            if (functions.mut_lineage_parsing(input.var4())[0] == '') and (functions.mut_lineage_parsing(input.var4())[1] == ''):
-                                                return ''
-                                            else:
-                                                return f'Potential: {functions.mut_lineage_parsing(input.var4())[1]}'
+                                        mutator_text, potential_mutator_text = analysis().mutators, analysis().potential_mutators
+                                        if (mutator_text == '') and (potential_mutator_text == ''):
+                                            return ''
+                                        else:
+                                            return f'Potential: {potential_mutator_text}'
                         'See Application Notes table for a list of Confirmed and Potential mutator sites.'
 
             with ui.card():
-                # shiny won't use file paths in quotes, you have to use pathlib
-                # define mutation distributions and total number of mutations for chronic sequences
-                chronic_data = Path(__file__).parent / "./data/chronicnucl.tsv"
-                chronic, total_chronic = functions.parse_mutation_files(chronic_data)
-                # for deer sequences
-                deer_data = Path(__file__).parent / "./data/deernucl.tsv"
-                deer, total_deer = functions.parse_mutation_files(deer_data)
-                # for global sequences
-                global_data = Path(__file__).parent / "./data/globalnucl.tsv"
-                global_, total_global = functions.parse_mutation_files(global_data)
-                
-                # for late global sequences
-                globallate_data = Path(__file__).parent / "./data/globallatenucl.tsv"
-                global_late, total_lateglobal = functions.parse_mutation_files(globallate_data)
-
-                # once nucleotide positions where mutations occur are entered into the text box, these
-                # calculations occur reactively
-                @reactive.calc
-                # function to parse user mutation data input for plotting
-                def plot_user_input():
-                    # gui accepts input as a string, so it first needs to be split into a list 
-                    # splits occur wherever there is a comma
-                    if private_muts.get():
-                        mutated_nucleotide_list = functions.parse_user_input(private_muts.get())
-                    elif input.var2() != '1':
-                        mutated_nucleotide_list = functions.parse_user_input(input.var2())
-                    elif input.var2() == '1':
-                        mutated_nucleotide_list = functions.parse_user_input(input.var4())
-                    # try to remove non-digit characters, then convert each string in list into
-                    # a digit
-                    try: 
-                        int_nuc_list = [re.sub('\D', '', i) for i in mutated_nucleotide_list]
-                        digit_nuc_list = [int(i) for i in int_nuc_list]
-                        mut_nuc_list = [i for i in digit_nuc_list if (i < 30001 and i > 0)]
-                    # if this fails, return some dummy data so the plot is still rendered
-                    except ValueError: 
-                        int_nuc_list = [re.sub('\D', '', i) for i in mutated_nucleotide_list]
-                        digit_nuc_list = []
-                        for i in int_nuc_list:
-                            try:
-                                digit_nuc_list.append(int(i))
-                                mut_nuc_list = [i for i in digit_nuc_list if (i < 30001 and i > 0)]
-                            except ValueError:
-                                return [[0,0,0,0], [1,1,1,1], 1]
-                        if len(mut_nuc_list) == 0:
-                            return [[0,0,0,0], [1,1,1,1], 1]               
-                    except: return [[0,0,0,0], [1,1,1,1], 1]
-                    if private_muts.get():
-                        transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                    elif input.var2() != '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                    elif input.var2() == '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var4())
-                    if transversions == False:
-                        return [[0,0,0,0], [1,1,1,1], 1]
-                    # otherwise, parse the list of mutation positions into bins based on the size
-                    # specified by the user
-                    counts, bins0 = functions.make_bins(mut_nuc_list, input.var())
-                    # determine the total number of mutations that are in the list supplied by the
-                    # user
-                    total_counts = sum(counts)
-                    if total_counts == 0:
-                        total_counts += 1
-                    # return everything
-                    
-                    return counts, bins0, total_counts
-
                 # plot out mutation distributions
                 @render_widget
                 @reactive.event(input.submit, ignore_none=False)
                 # function to plot graph
                 def hist1():
-                    # assign x variables
-                    x0 = global_
-                    x1 = global_late
-                    x2 = chronic
-                    x3 = deer
                     opacity = 1.0
                     
-                    # calculate mutations per user-specified bin size in histogram for each distribution
-                    # chronic
-                    counts0, bins0 = functions.make_bins(x0,input.var())
-                    # global
-                    counts1, bins1 = functions.make_bins(x1,input.var())
-                    # global late
-                    counts2, bins2 = functions.make_bins(x2,input.var())
-                    # deer
-                    counts3, bins3 = functions.make_bins(x3,input.var(), deer = True)
+                    result = analysis()
+                    # look up mutations per user-specified bin size in histogram for each distribution
+                    table = reference_tables.table(result.binsize)
+                    bins0 = table.bins
                     # instatiate figure
                     fig = go.Figure()
-                    if private_muts.get():
-                        transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                    elif input.var2() != '1' or '2':
-                        transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                    elif input.var2() == '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var4())
-                    if transversions == False:
+                    if not result.valid:
                         return fig
                     # add plot of nucleotide positions specified by user
                     fig.add_trace(go.Bar(
                     x=bins0,
-                    y=[x/plot_user_input()[2] for x in plot_user_input()[0]], # normalize bin counts by total number of mutations
+                    y=[x/result.total_counts for x in result.counts], # normalize bin counts by total number of mutations
                     name='user input', # name used in legend and hover labels,
                     marker_color=functions.select_palette(input.var3())[0], # user specifies colour palette
                     opacity=opacity
                     ))
-                    # add plot of early global
-                    fig.add_trace(go.Bar(
-                    x=bins0,
-                    y=[x/total_global for x in counts0], # normalize bin counts by total number of mutations
-                    name='global pre-VoC', # name used in legend and hover labels,
-                    marker_color=functions.select_palette(input.var3())[1], # user specifies colour palette
-                    opacity=opacity
-                    ))
-                    # add plot of late global distribution
-                    fig.add_trace(go.Bar(
-                    x=bins0,
-                    y=[x/total_lateglobal for x in counts1], # normalize bin counts by total number of mutations
-                    name='global Omicron', # name used in legend and hover labels,
-                    marker_color=functions.select_palette(input.var3())[2], # user specifies colour palette
-                    opacity=opacity
-                    ))
-                    # add plot of chronic distribution
-                    fig.add_trace(go.Bar(
-                    x=bins0,
-                    y=[x/total_chronic for x in counts2],
-                    name='chronic',
-                    marker_color=functions.select_palette(input.var3())[3],
-                    opacity=opacity    
-                    ))
-                    # add plot of deer distribution
-                    fig.add_trace(go.Bar(
-                    x=bins0,
-                    y=[x/total_deer for x in counts3], # normalize bin counts by total number of mutations
-                    name='deer', # name used in legend and hover labels,
-                    marker_color=functions.select_palette(input.var3())[4], # user specifies colour palette
-                    opacity=opacity
-                    ))
+                    # add plot of each distribution in the registry
+                    for display_name, dist_counts, total, color in zip(reference_tables.display_names, table.counts, totals, reference_tables.palette(input.var3())):
+                        fig.add_trace(go.Bar(
+                        x=bins0,
+                        y=[x/total for x in dist_counts], # normalize bin counts by total number of mutations
+                        name=display_name, # name used in legend and hover labels,
+                        marker_color=color, # user specifies colour palette
+                        opacity=opacity
+                        ))
                     fig.update_layout(
                     title_text='Distribution of Mutations\nAcross Genome', # title of plot
                     xaxis_title_text='Genome Position', # xaxis label
@@ -470,156 +404,78 @@ with ui.nav_panel("Home"):
                     )
                     # return figure
                     return fig
+
+                # plot out the likelihood ratio track beneath the histogram
+                @render_widget
+                @reactive.event(input.submit, ignore_none=False)
+                # function to plot the chronic vs. global pre-VoC log likelihood ratio along the genome
+                def track1():
+                    fig = go.Figure()
+                    if not analysis().valid or not input.window():
+                        return fig
+                    # one value per window start, calculated from cumulative sums over the genome
+                    starts, ends, ratios = functions.likelihood_ratio_track(analysis().mutations, reference_tables, min(max(int(input.window()), 1), 30000))
+                    fig.add_trace(go.Scatter(
+                    x=(starts + ends) / 2, # plot each window at its centre
+                    y=ratios,
+                    mode='lines',
+                    name='chronic vs. global pre-VoC',
+                    line_color=reference_tables.palette(input.var3())[reference_tables.names.index('chronic')], # user specifies colour palette
+                    hovertemplate='Window centre: %{x}<br>Log likelihood ratio: %{y:.2f}'
+                    ))
+                    fig.update_layout(
+                    title_text=f'Chronic vs. Global pre-VoC Log Likelihood Ratio ({int(input.window())} nt windows)', # title of plot
+                    xaxis_title_text='Genome Position', # xaxis label
+                    yaxis_title_text='Log Likelihood Ratio', # yaxis label
+                    height=300,
+                    plot_bgcolor='white' # specify white background
+                    )
+                    fig.update_yaxes( # make y axes and ticks look pretty
+                    mirror=True,
+                    ticks='outside',
+                    showline=True,
+                    linecolor='black',
+                    gridcolor='lightgrey',
+                    zeroline=True,
+                    zerolinecolor='black'
+                    )
+                    fig.update_xaxes( # make x axes and ticks look pretty
+                    mirror=True,
+                    ticks='outside',
+                    showline=True,
+                    linecolor='black',
+                    gridcolor='white'
+                    )
+                    # return figure
+                    return fig
             
             with ui.card():
                 @render.text
                 @reactive.event(input.submit, ignore_none=False)
                 def txt():
                     return f'The log likelihoods of your sequence fitting the mutation distributions above are as follows: (higher is better)'
-                with ui.layout_column_wrap(width=1/2):
-                # once nucleotide positions where mutations occur are entered into the text box, these
-                # calculations occur reactively
-                    @reactive.calc
-                    # function to calculate log likelihoods of user's mutation distribution fitting each 
-                    # of the specified mutation distributions
-                    def calc_likelihoods():
-                        # input user's bin size selection, global mutations, chronic mutations, deer mutations, user's mutations
-                        if private_muts.get():
-                            likelihood_list, most_likely = functions.most_likely(input.var(), global_, global_late, chronic, deer, private_muts.get())
-                        elif input.var2() != '1':
-                            likelihood_list, most_likely = functions.most_likely(input.var(), global_, global_late, chronic, deer, input.var2())
-                        elif input.var2() == '1':
-                            likelihood_list, most_likely = functions.most_likely(input.var(), global_, global_late, chronic, deer, input.var4())
-                        # return a list of tuples: [(global_likelihood, 'global'), (global_late_likelihood, 'global_late'),(chronic_likelihood, 'chronic'), (deer_likelihood, 'deer')]
-                        # and the name of the distribution that the user's list of mutations fits best (e.g. 'chronic')
-                        return likelihood_list, most_likely
-                    with ui.card():
-                        # print text out for the user
-
-                        @reactive.event(input.submit, ignore_none=False)
-                        def txt1():
-                        # if reactive calculations have been performed (i.e. likelihoods have been calculated),
-                        # display likelihoods, otherwise prompt user to enter a list of mutated nucleotide positions
-                            if private_muts.get():
-                                transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                            elif input.var2() != '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                            elif input.var2() == '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var4())
-                            if transversions == False:
-                                return ''
-                            try:
-                                return f'{calc_likelihoods()[0][0][0]:.2f}'
-                            except:
-                                pass
-                        @reactive.event(input.submit, ignore_none=False)
-                        def txt2():
-                            if private_muts.get():
-                                transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                            elif input.var2() != '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                            elif input.var2() == '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var4())
-                            if transversions == False:
-                                return ''
-                            # if reactive calculations have been performed (i.e. likelihoods have been calculated),
-                            # display likelihoods, otherwise don't do anything 
-                            try:
-                                return f'{calc_likelihoods()[0][1][0]:.2f}'
-                            except:
-                                pass
-                        @reactive.event(input.submit, ignore_none=False)
-                        def get_color():
-                            color = functions.select_palette(input.var3())[1]
-                            return color
-                        @reactive.event(input.submit, ignore_none=False)
-                        def get_color1():
-                            color = functions.select_palette(input.var3())[2]
-                            return color
-                        @render.ui
-                        def styled_card_core():
-                            color = get_color()
-                            result = txt1()
-                            return core_ui.card(
-                                core_ui.card_header("global pre-VoC"),
-                                core_ui.h2(f'{result}'),
-                                style=f"background-color: {color}; text-align: center; color: #FFFFFF;"
-                            )
-
-                        @render.ui
-                        def styled_card_core1():
-                            color = get_color1()
-                            result = txt2()
-                            return core_ui.card(
-                                core_ui.card_header("global Omicron"),
-                                core_ui.h2(f'{result}'),
-                                style=f"background-color: {color}; text-align: center; color: #FFFFFF;"
-                            )
-                        
-                        
-                        # print text out for the user
-                    
-                       
-                    with ui.card():
-                        # print text out for the user
-                        @reactive.event(input.submit, ignore_none=False)
-                        def txt3():
+                @render.ui
+                @reactive.event(input.submit, ignore_none=False)
+                def styled_cards():
+                    # one card per distribution in the registry, two to a row
+                    result = analysis()
+                    colours = reference_tables.palette(input.var3())
+                    cards = []
+                    for i, (display_name, color) in enumerate(zip(reference_tables.display_names, colours)):
                         # if reactive calculations have been performed (i.e. likelihoods have been calculated),
-                        # display likelihoods, otherwise prompt user to enter a list of mutated nucleotide positions
-                            if private_muts.get():
-                                transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                            elif input.var2() != '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                            elif input.var2() == '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var4())
-                            if transversions == False:
-                                return ''
-                            try:
-                                return f'{calc_likelihoods()[0][2][0]:.2f}'
-                            except:
-                                pass
-                        @reactive.event(input.submit, ignore_none=False)
-                        def txt4():
-                            if private_muts.get():
-                                transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                            elif input.var2() != '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                            elif input.var2() == '1':
-                                transitions, transversions = functions.transition_or_transversion(input.var4())
-                            if transversions == False:
-                                return ''
-                            # if reactive calculations have been performed (i.e. likelihoods have been calculated),
-                            # display likelihoods, otherwise don't do anything 
+                        # display likelihoods, otherwise don't do anything
+                        likelihood = ''
+                        if result.valid:
                             try:
-                                return f'{calc_likelihoods()[0][3][0]:.2f}'
-                            except:
+                                likelihood = f'{result.likelihoods[i][0]:.2f}'
+                            except (TypeError, ValueError, IndexError):
                                 pass
-                        @reactive.event(input.submit, ignore_none=False)
-                        def get_color2():
-                            color = functions.select_palette(input.var3())[3]
-                            return color
-                        @reactive.event(input.submit, ignore_none=False)
-                        def get_color3():
-                            color = functions.select_palette(input.var3())[4]
-                            return color
-                        @render.ui
-                        def styled_card_core2():
-                            color = get_color2()
-                            result = txt3()
-                            return core_ui.card(
-                                core_ui.card_header("chronic"),
-                                core_ui.h2(f'{result}'),
-                                style=f"background-color: {color}; text-align: center; color: #FFFFFF;"
-                            )
-                        @render.ui
-                        def styled_card_core3():
-                            color = get_color3()
-                            result = txt4()
-                            return core_ui.card(
-                                core_ui.card_header("deer"),
-                                core_ui.h2(f'{result}'),
-                                style=f"background-color: {color}; text-align: center; color: #FFFFFF;"
-                            )
+                        cards.append(core_ui.card(
+                            core_ui.card_header(display_name),
+                            core_ui.h2(f'{likelihood}'),
+                            style=f"background-color: {color}; text-align: center; color: #FFFFFF;"
+                        ))
+                    return core_ui.layout_column_wrap(*cards, width=1/2)
                         
             # print text out for the user
             with ui.value_box(
@@ -630,46 +486,50 @@ with ui.nav_panel("Home"):
                 @render.ui
                 @reactive.event(input.submit, ignore_none=False)
                 def txt5():
-                    if private_muts.get():
-                        transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                    elif input.var2() != '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                    elif input.var2() == '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var4())
-                    if transversions == False:
+                    result = analysis()
+                    if not result.valid:
                         return ''
                     # if reactive calculations have been performed (i.e. likelihoods have been calculated),
                     # display likelihoods, otherwise don't do anything
-                    if calc_likelihoods()[0][0][0] == float(0):
+                    if result.likelihoods[0][0] == float(0):
                         return ''
-                    try:
-                        return f'{calc_likelihoods()[1][1].replace("_", " ")}'
-                        
-                    except:
-                        pass
+                    return f'{display_names.get(result.most_likely[1], result.most_likely[1])}'
                 @render.ui
                 @reactive.event(input.submit, ignore_none=False)
                 def txt6():
-                    if private_muts.get():
-                        transitions, transversions = functions.transition_or_transversion(private_muts.get())
-                    elif input.var2() != '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var2())                                   
-                    elif input.var2() == '1':
-                        transitions, transversions = functions.transition_or_transversion(input.var4())
-                    if transversions == False:
+                    result = analysis()
+                    if not result.valid:
                         return ''
                     try:
-                        if int(functions.times_more_likely(calc_likelihoods()[0])[0]) > 99999:     
-                            more_likely = functions.sci_notation(functions.times_more_likely(calc_likelihoods()[0])[0], sig_fig=1)
+                        if int(result.times_more_likely) > 99999:
+                            more_likely = functions.sci_notation(result.times_more_likely, sig_fig=1)
                         else:
-                            more_likely = f'{functions.times_more_likely(calc_likelihoods()[0])[0]:.2f}'
-                        dist = functions.times_more_likely(calc_likelihoods()[0])[1]
+                            more_likely = f'{result.times_more_likely:.2f}'
+                        dist = result.compared_to
                         if private_muts.get():
                             private_muts.set(None)
-                        return f'({more_likely} times more likely than the {dist.replace("_", " ")} distribution.)'
+                        return f'({more_likely} times more likely than the {display_names.get(dist, dist)} distribution.)'
                     except:
                         private_muts.set(None)
                         return f'Please enter a list of nucleotide positions or upload a FASTA file to calculate likelihoods.'
+                @render.ui
+                @reactive.event(input.submit, ignore_none=False)
+                def txt7():
+                    result = analysis()
+                    if not result.valid:
+                        return ''
+                    # how often a chronic vs. global pre-VoC margin this large arises by chance
+                    p_value = result.p_value
+                    if p_value is None:
+                        # the null tables only cover the simulated lineage sizes
+                        null_table = functions.get_null_table()
+                        if null_table is None or str(input.var()) not in null_table.binsizes:
+                            return ''
+                        smallest, largest = null_table.size_range
+                        if smallest <= len(result.mutations.positions) <= largest:
+                            return ''
+                        return f'Empirical p-values are only available for lineages of {smallest} to {largest} mutations.'
+                    return f'Chronic vs. global pre-VoC empirical p-value: {p_value:.2g}'
                     
                         
             
@@ -680,6 +540,103 @@ with ui.nav_panel("Home"):
     )                
 
                 
+# name of batch tab
+with ui.nav_panel("Batch"):
+    # names of the files of the current batch, and the BatchJob analyzing them (or why it was turned away)
+    batch_names = reactive.value([])
+    batch_job = reactive.value(None)
+    # results of the files that have finished, keyed by (file number, bin size), so each is only scored once
+    batch_scored = {}
+
+    @reactive.effect
+    @reactive.event(input.batch_files)
+    def _submit_batch():
+        # a new batch replaces the one still being analyzed
+        with reactive.isolate():
+            if isinstance(batch_job.get(), nextcladefunctions.NextcladeJob):
+                batch_job.get().cancel()
+        batch_scored.clear()
+        files = input.batch_files()
+        batch_names.set([file["name"] for file in files])
+        # the whole batch takes one place in the queue, its files are analyzed one after the other
+        try:
+            batch_job.set(nextcladefunctions.submit_batch([file["datapath"] for file in files]))
+        except nextcladefunctions.QueueFullError as e:
+            batch_job.set(f'not analyzed, the server is busy: {e}')
+
+    @reactive.effect
+    @reactive.event(input.cancel_batch)
+    def _cancel_batch():
+        if isinstance(batch_job.get(), nextcladefunctions.NextcladeJob):
+            batch_job.get().cancel()
+
+    @reactive.calc
+    def batch_results():
+        job = batch_job.get()
+        names = batch_names.get()
+        if job is None:
+            return pd.DataFrame()
+        # check on the batch again shortly until it has finished, then add the rows of every file
+        if isinstance(job, str):
+            finished = []
+        else:
+            finished = list(job.finished)
+            if not job.done():
+                reactive.invalidate_later(1)
+        frames = []
+        for i, file_name in enumerate(names):
+            if i < len(finished):
+                status, samples = 'done', finished[i]
+            elif isinstance(job, str) or job.done():
+                status, samples = job if isinstance(job, str) else job.status, [("", "Error", "Error")]
+            else:
+                break
+            key = (i, input.batch_var())
+            if key not in batch_scored:
+                df = functions.batch_results_table(input.batch_var(), samples, reference_tables)
+                df.insert(0, 'file', file_name)
+                df.insert(1, 'status', status)
+                batch_scored[key] = df
+            frames.append(batch_scored[key])
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    with ui.layout_columns(col_widths=(4, 8)):
+        with ui.card():
+            ui.input_select("batch_var", "Select Bin Size",
+                choices= ['genes_split', 'gene', int(500), int(1000)])
+            ui.input_file("batch_files", "Please select one or more FASTA files, each with one or more SARS-CoV-2 genome consensus sequences (FASTA headers required, U must be converted to T)", accept=['.fasta', '.FASTA', '.fa'], multiple = True,)
+            @render.text
+            def batch_progress():
+                job = batch_job.get()
+                if job is None:
+                    return ''
+                if isinstance(job, str):
+                    return f'The batch was {job}'
+                # check on the batch again shortly until it has finished
+                if not job.done():
+                    reactive.invalidate_later(1)
+                if job.status == 'queued':
+                    return f'Waiting for Nextclade (number {job.position()} in the queue)...'
+                if job.status == 'running':
+                    return f'Nextclade is analyzing the {len(batch_names.get())} files...'
+                return f'{len(job.finished)} of {len(batch_names.get())} files finished ({job.status}).'
+            ui.input_action_button("cancel_batch", "Cancel Batch", class_="btn-secondary")
+            # results of every sequence analyzed so far
+            @render.download(filename="smdp_batch_results.csv", label="Download Results (CSV)")
+            def download_batch_csv():
+                yield batch_results().to_csv(index=False)
+            @render.download(filename="smdp_batch_results.json", label="Download Results (JSON)")
+            def download_batch_json():
+                yield batch_results().to_json(orient='records', indent=2)
+        with ui.card():
+            @render.data_frame
+            def batch_table():
+                # one row per sequence, filled in as each file finishes
+                rounded = {name: 2 for name in [*display_names.values(), 'transition_transversion_ratio', 'times_more_likely']}
+                return render.DataGrid(batch_results().round(rounded), width="100%")
+
 # name of notes tab 
 with ui.nav_panel("Application Notes"):
     # markdown of text to appear on second tab page
@@ -774,7 +731,7 @@ In addition, the app informs the user whether the data contain signals consisten
 <br>
 
 ### Application Use
-This application accepts a list of comma separated nucleotide positions in a SARS-CoV-2 genome where lineage-defining mutations occur. **Lineage-defining mutations are the subset of mutations in a lineage that have occurred since divergence from the larger SARS-CoV-2 tree.** A list of lineage-defining mutations (the “mutation set”) for [pangolin-designated SARS-CoV-2 lineages](https://en.wikipedia.org/wiki/Phylogenetic_Assignment_of_Named_Global_Outbreak_Lineages) can be found [here](https://github.com/cov-lineages/pango-designation?tab=readme-ov-file). The tool will also accept a FASTA file containing a **SINGLE** SARS-CoV-2 genome consensus sequence. In this case, the [NextClade CLI](https://docs.nextstrain.org/projects/nextclade/en/stable/user/nextclade-cli/index.html) is used to determine lineage-defining mutations (called private mutations in NextClade).
+This application accepts a list of comma separated nucleotide positions in a SARS-CoV-2 genome where lineage-defining mutations occur. **Lineage-defining mutations are the subset of mutations in a lineage that have occurred since divergence from the larger SARS-CoV-2 tree.** A list of lineage-defining mutations (the “mutation set”) for [pangolin-designated SARS-CoV-2 lineages](https://en.wikipedia.org/wiki/Phylogenetic_Assignment_of_Named_Global_Outbreak_Lineages) can be found [here](https://github.com/cov-lineages/pango-designation?tab=readme-ov-file). The tool will also accept a FASTA file containing one or more SARS-CoV-2 genome consensus sequences. In this case, the [NextClade CLI](https://docs.nextstrain.org/projects/nextclade/en/stable/user/nextclade-cli/index.html) is used to determine lineage-defining mutations (called private mutations in NextClade).
 
 The application determines the likelihood of observing the mutation set as a random draw from each distribution (chronic infection, deer-specific mutations, global (pre-VOC) and global (Omicron era)). The log likelihood of observing the mutation set from each distribution is displayed (in natural log units).
 
@@ -798,7 +755,7 @@ The following diagram shows how your data are processed after submission of eith
 - These coordinates MUST be **genomic** coordinates, **not gene** coordinates like `S:G107Y`
 - Indels should be reported by including the first position only e.g. `ins21608` or `del28248` **NOT** `ins21608TCATGCCGCTGT` or `del28248_28250`
 - If you would like to convert gene coordinates to nucleotide coordinates, try using Theo Sanderson’s [tool](https://codon2nucleotide.theo.io/)
-- FASTA files must contain a single sequence with a canonical header (e.g. `>genome_sequence`), have one of the following suffixes: `.FASTA`, `.fasta` or `.fa` and **ALL** U nucleotides must be converted to T before upload
+- FASTA files may contain several sequences, each with a canonical header (e.g. `>genome_sequence`), have one of the following suffixes: `.FASTA`, `.fasta` or `.fa` and **ALL** U nucleotides must be converted to T before upload
 - For more tips on formatting your input for optimal results, see the **"FAQ"** tab
 
 ### Additional Information
@@ -827,7 +784,7 @@ with ui.nav_panel("FAQ"):
     -   Have a [FASTA header](https://en.wikipedia.org/wiki/FASTA_format) (First line starts with '`>`')
     -   Have one of the following suffixes: `.FASTA`, `.fasta`, `.fa`
     -   Have all *U* nucleotides converted to *T*
-    -   Contain a **SINGLE** genome sequence
+    -   Contain one or more genome sequences, each with its own header (select the sequence to analyze after uploading)
     -   Be flat text with [`UTF-8`](https://en.wikipedia.org/wiki/UTF-8) encoding. If you are unsure of what software to use, the following options will work. These are NOT the only options. 
         -   **Windows**: [Notepad](https://apps.microsoft.com/detail/9msmlrh6lzf3?hl=en-US&gl=US)
         -   **Mac**: [BBEdit](https://www.barebones.com/)
@@ -842,8 +799,9 @@ with ui.nav_panel("FAQ"):
 -   **What happens to my sequence when I upload it? How are lineage-defining mutations determined?**
 
     -   When you upload a file, the sequence is analyzed using the [NextClade CLI](https://docs.nextstrain.org/projects/nextclade/en/stable/user/nextclade-cli/index.html). 
-    -   The reference dataset is determined via *ad hoc* alignment with all available [Nextstrain datasets](https://github.com/nextstrain/nextclade_data/tree/release/data/nextstrain/sars-cov-2) (Wuhan, BA.2, BA.2.86, XBB) *latest release = 2025-09-19.*
-    -   Each resulting .tsv file is examined to determine the best alignment score. The reference dataset with the best score is chosen as the reference for your sequence. 
+    -   The reference dataset is chosen from the available [Nextstrain datasets](https://github.com/nextstrain/nextclade_data/tree/release/data/nextstrain/sars-cov-2) (Wuhan, BA.2, BA.2.86, XBB) *latest release = 2025-09-19.* Your sequence is first compared with each reference sequence by the short sequences (k-mers) they share, and when one reference is clearly closest only that dataset is aligned.
+    -   If no reference is clearly closest, your sequence is aligned with all four datasets and the one with the best alignment score is chosen as the reference for your sequence.
+    -   Sequences are passed to NextClade and its results read back directly, so no alignment files are written.
     -   The **private nucleotide mutations** (reversion substitutions, labeled substitutions and unlabeled substitutions) that are found from the alignment of your sequence with the reference are extracted.
     -   These mutations are used as input to determine distributions, changes at mutator sites and transition:transversion ratio.
     -   See the diagram that describes the flow of data within SMDP in the **"Application Notes"** tab for a visual depiction.
@@ -0,0 +1,79 @@
+import argparse
+
+import cli
+import functions
+
+default_lineage_sizes = list(range(1, 31)) + list(range(35, 101, 5))
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="""Build the null distribution tables used to attach empirical p-values to results.
+
+Lineages of k mutations are drawn from the global pre-VoC distribution and the quantiles of their
+chronic vs. global pre-VoC log likelihood ratio are stored for each bin size and k.
+Re-run this whenever the reference data changes.""",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--bin-sizes",
+        nargs="+",
+        choices=["genes_split", "gene", "500", "1000"],
+        default=["genes_split", "gene", "500", "1000"],
+        help="Bin sizes to simulate (default: all)",
+    )
+    parser.add_argument(
+        "--mutations",
+        nargs="+",
+        type=int,
+        default=default_lineage_sizes,
+        metavar="K",
+        help="Numbers of mutations per lineage to simulate (default: 1-30, then 35-100 in steps of 5)",
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        default=100000,
+        help="Number of lineages simulated for each bin size and k (default: 100000)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed for the simulations (default: 1)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use (default: 1)",
+    )
+    parser.add_argument(
+        "--output",
+        default=str(functions.null_table_file),
+        help="Output file (default: the table shipped in the data directory)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    if min(args.mutations) < 1 or args.replicates < 1:
+        print("Error: `--mutations` and `--replicates` must be positive.")
+        exit(1)
+
+    reference_tables = cli.load_reference_tables()
+    null_table = functions.build_null_table(
+        reference_tables,
+        args.bin_sizes,
+        args.mutations,
+        replicates=args.replicates,
+        seed=args.seed,
+        jobs=args.jobs,
+    )
+    null_table.save(args.output)
+    print(f"Null tables saved as {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import argparse
+import csv
+import itertools
 import json
+import math
+import sys
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import functions
 
@@ -18,7 +23,19 @@ Please cite: https://doi.org/10.48550/arXiv.2407.11201""",
     )
     parser.add_argument(
         "mutations",
-        help="Comma-separated list of mutations or path to a file containing mutations",
+        nargs="?",
+        help="Comma-separated list of mutations, path to a file containing mutations, or a (multi-record) FASTA file analyzed with Nextclade",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Score every sample in a TSV, CSV or JSONL file of sample_id and mutations ('-' reads TSV from stdin) or every record of a FASTA file, writing one JSON result per line",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of samples scored together in batch mode (default: 1000)",
     )
     parser.add_argument(
         "--bin-size",
@@ -46,6 +63,39 @@ Please cite: https://doi.org/10.48550/arXiv.2407.11201""",
         default="plasma",
         help="Color palette for the plot (default: plasma)",
     )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        metavar="REPLICATES",
+        help="Report bootstrap confidence intervals calculated from this many replicates",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed for the bootstrap replicates",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use for bootstrap replicates or batch mode (default: 1)",
+    )
+    parser.add_argument(
+        "--track-window",
+        type=int,
+        help="Write a chronic vs. global pre-VoC log likelihood ratio track using windows of this many nucleotides",
+    )
+    parser.add_argument(
+        "--track-output",
+        default="likelihood_track.bedgraph",
+        help="Output file for the track (default: likelihood_track.bedgraph)",
+    )
+    parser.add_argument(
+        "--track-format",
+        choices=["bedgraph", "tsv"],
+        default="bedgraph",
+        help="Format of the track (default: bedgraph)",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -54,7 +104,38 @@ Please cite: https://doi.org/10.48550/arXiv.2407.11201""",
     return parser.parse_args()
 
 
-def load_mutations(mutations_input: str) -> List[str]:
+fasta_suffixes = [".fasta", ".fa", ".fas"]
+
+
+def is_fasta(mutations_input: str) -> bool:
+    try:
+        return (
+            Path(mutations_input).suffix.lower() in fasta_suffixes
+            and Path(mutations_input).is_file()
+        )
+    except OSError:
+        return False
+
+
+def load_fasta_records(fasta_file: str) -> List[Tuple[str, str]]:
+    # every reference dataset is run once over the whole file, then the best reference is picked per record
+    import nextcladefunctions
+
+    records = []
+    for name, mutations in nextcladefunctions.execute_nextclade_records(
+        Path(fasta_file).resolve()
+    ):
+        if mutations == "Error":
+            print(
+                f"Warning: Nextclade could not align record {name!r}; it was skipped.",
+                file=sys.stderr,
+            )
+        else:
+            records.append((name, mutations))
+    return records
+
+
+def load_mutations(mutations_input: str) -> functions.ParsedMutations:
     is_file = False
     try:
         is_file = Path(mutations_input).is_file()
@@ -65,78 +146,109 @@ def load_mutations(mutations_input: str) -> List[str]:
             mutations = f.read().strip()
     else:
         mutations = mutations_input
-    return functions.parse_user_input(mutations)
-
-
-def load_distribution_data() -> Dict[str, Tuple[List[int], int]]:
-    data_dir = Path(__file__).parent / "data"
-    distributions = {
-        "chronic": "chronicnucl.tsv",
-        "deer": "deernucl.tsv",
-        "global": "globalnucl.tsv",
-        "global_late": "globallatenucl.tsv",
-    }
+    return functions.tokenize_mutations(mutations)
 
-    data = {}
-    for name, filename in distributions.items():
-        file_path = data_dir / filename
-        data[name], data[f"total_{name}"] = functions.parse_mutation_files(file_path)
 
-    return data
+def load_reference_tables() -> functions.ReferenceTables:
+    # memory-mapped from the compiled reference store, which is rebuilt when the data changes
+    return functions.load_reference_tables()
 
 
 def calculate_likelihoods(
     bin_size: str,
-    mutations: List[str],
-    distribution_data: Dict[str, Tuple[List[int], int]],
+    mutations: functions.ParsedMutations,
+    reference_tables: functions.ReferenceTables,
 ) -> Tuple[List[Tuple[float, str]], str]:
-    likelihood_list, most_likely = functions.most_likely(
-        bin_size,
-        distribution_data["global"],
-        distribution_data["global_late"],
-        distribution_data["chronic"],
-        distribution_data["deer"],
-        mutations,
+    likelihood_list, most_likely = functions.rank_distributions(
+        bin_size, mutations, reference_tables
     )
     return likelihood_list, most_likely
 
 
 def analyze_mutations(
-    mutations: str, bin_size: str, verbose: bool
-) -> Tuple[Dict[str, any], List[str], Dict[str, Tuple[List[int], int]]]:
+    mutations: str,
+    bin_size: str,
+    verbose: bool,
+    bootstrap: Optional[int] = None,
+    seed: Optional[int] = None,
+    jobs: int = 1,
+    reference_tables: Optional[functions.ReferenceTables] = None,
+) -> Tuple[Dict[str, any], functions.ParsedMutations, functions.ReferenceTables]:
+    # the input is parsed once and the parsed mutations are passed to every function below
     mut_list = load_mutations(mutations)
-    transitions, transversions = functions.transition_or_transversion(mutations)
+    transitions, transversions = functions.transition_or_transversion(mut_list)
+    spectrum = functions.substitution_spectrum(mut_list)[0]
+    for error in mut_list.errors:
+        print(f"Warning: {error}", file=sys.stderr)
 
     if verbose:
-        print(f"Analyzing {len(mut_list)} mutations...")
+        print(f"Analyzing {len(mut_list.positions)} mutations...")
         print(f"Transitions: {transitions}, Transversions: {transversions}")
 
-    distribution_data = load_distribution_data()
+    if reference_tables is None:
+        reference_tables = load_reference_tables()
     likelihood_list, most_likely = calculate_likelihoods(
-        bin_size, mutations, distribution_data
+        bin_size, mut_list, reference_tables
     )
+    times_more_likely, compared_to = functions.times_more_likely(likelihood_list)
+    display_names = dict(zip(reference_tables.names, reference_tables.display_names))
 
     results = {
-        "mutations_count": len(mut_list),
+        "mutations_count": len(mut_list.positions),
         "transition_transversion_ratio": transitions / transversions
         if transversions
         else None,
+        "substitution_spectrum": dict(
+            zip(functions.substitution_classes, spectrum.tolist())
+        ),
         "likelihoods": {
-            dist.replace("_", " "): likelihood[0]
-            for dist, likelihood in zip(distribution_data.keys(), likelihood_list)
+            display_name: likelihood
+            for display_name, (likelihood, name) in zip(
+                reference_tables.display_names, likelihood_list
+            )
         },
-        "best_fit": most_likely,
-        "times_more_likely": functions.times_more_likely(likelihood_list)[0],
-        "compared_to": functions.times_more_likely(likelihood_list)[1].replace(
-            "_", " "
+        "best_fit": display_names.get(most_likely[1], most_likely[1]),
+        "times_more_likely": times_more_likely,
+        "compared_to": display_names.get(compared_to, compared_to),
+        "mutator_lineage": functions.mut_lineage_parsing(mut_list),
+        "p_value": functions.empirical_p_value(
+            bin_size, likelihood_list, len(mut_list.positions)
         ),
-        "mutator_lineage": functions.mut_lineage_parsing(mutations),
     }
 
+    if bootstrap and len(mut_list.positions) > 0:
+        if verbose:
+            print(f"Calculating {bootstrap} bootstrap replicates...")
+        bootstrap_result = functions.bootstrap_likelihoods(
+            bin_size, mut_list, reference_tables, bootstrap, seed=seed, jobs=jobs
+        )
+        results["bootstrap"] = {
+            "replicates": bootstrap_result.replicates,
+            "confidence": bootstrap_result.confidence,
+            "likelihood_intervals": {
+                name: [lower, upper]
+                for name, lower, upper in zip(
+                    reference_tables.display_names,
+                    bootstrap_result.lower.tolist(),
+                    bootstrap_result.upper.tolist(),
+                )
+            },
+            "win_fraction": dict(
+                zip(
+                    reference_tables.display_names,
+                    bootstrap_result.win_fraction.tolist(),
+                )
+            ),
+            "times_more_likely_interval": [
+                bootstrap_result.times_more_likely_lower,
+                bootstrap_result.times_more_likely_upper,
+            ],
+        }
+
     if verbose:
         print("Analysis complete.")
 
-    return results, mut_list, distribution_data
+    return results, mut_list, reference_tables
 
 
 def print_results(results: Dict[str, any]) -> None:
@@ -151,6 +263,22 @@ def print_results(results: Dict[str, any]) -> None:
     print(
         f"({results['times_more_likely']:.2f} times more likely than the {results['compared_to']} distribution)"
     )
+    if results["p_value"] is not None:
+        print(
+            f"Chronic vs. global pre-VoC empirical p-value: {results['p_value']:.2g}"
+        )
+
+    if "bootstrap" in results:
+        bootstrap = results["bootstrap"]
+        print(
+            f"\nBootstrap {bootstrap['confidence']:.0%} confidence intervals ({bootstrap['replicates']} replicates):"
+        )
+        for dist, (lower, upper) in bootstrap["likelihood_intervals"].items():
+            print(
+                f"  {dist}: {lower:.2f} to {upper:.2f} (best fit in {bootstrap['win_fraction'][dist]:.1%} of replicates)"
+            )
+        lower, upper = bootstrap["times_more_likely_interval"]
+        print(f"  times more likely: {lower:.2f} to {upper:.2f}")
 
     print("\nMutator lineage analysis:")
     if results["mutator_lineage"][0]:
@@ -162,9 +290,9 @@ def print_results(results: Dict[str, any]) -> None:
 
 
 def generate_plot(
-    mut_list: List[str],
+    mut_list: functions.ParsedMutations,
     bin_size: str,
-    distribution_data: Dict[str, Tuple[List[int], int]],
+    reference_tables: functions.ReferenceTables,
     color_palette: str,
     output_file: str,
 ) -> None:
@@ -177,19 +305,21 @@ def generate_plot(
         )
         return
 
-    counts, bins = functions.make_bins(mut_list, bin_size)
+    counts, bins = functions.make_bins(mut_list.positions, bin_size)
 
     plt.figure(figsize=(12, 6))
     sns.set_style("whitegrid")
     sns.set_palette(color_palette)
 
-    for name, data in distribution_data.items():
-        if not name.startswith("total_"):
-            dist_counts, _ = functions.make_bins(data, bin_size)
-            total = distribution_data[f"total_{name}"]
-            plt.plot(
-                bins, [x / total for x in dist_counts], label=name.replace("_", " ")
-            )
+    table = reference_tables.table(bin_size)
+    for display_name, dist_counts, total in zip(
+        reference_tables.display_names, table.counts, reference_tables.totals()
+    ):
+        plt.plot(
+            bins,
+            [x / total for x in dist_counts],
+            label=display_name,
+        )
 
     plt.plot(
         bins, [x / len(mut_list) for x in counts], label="input mutations", linewidth=2
@@ -201,20 +331,199 @@ def generate_plot(
     plt.legend()
     plt.tight_layout()
     plt.savefig(output_file)
-    print(f"Plot saved as {output_file}")
+    print(f"Plot saved as {output_file}", file=sys.stderr)
+
+
+def write_track(
+    mut_list: functions.ParsedMutations,
+    reference_tables: functions.ReferenceTables,
+    window: int,
+    track_format: str,
+    output_file: str,
+) -> None:
+    starts, ends, ratios = functions.likelihood_ratio_track(
+        mut_list, reference_tables, window
+    )
+    with open(output_file, "w") as f:
+        if track_format == "bedgraph":
+            # windows overlap, so each value is reported at the centre of its window
+            # (bedGraph coordinates are 0-based, end exclusive)
+            f.write(
+                f'track type=bedGraph name="chronic vs global pre-VoC" description="log likelihood ratio, {window} nt windows"\n'
+            )
+            for start, ratio in zip(starts + window // 2, ratios):
+                f.write(f"NC_045512.2\t{start - 1}\t{start}\t{ratio:.4f}\n")
+        else:
+            f.write("window_start\twindow_end\tlog_likelihood_ratio\n")
+            for start, end, ratio in zip(starts, ends, ratios):
+                f.write(f"{start}\t{end}\t{ratio:.4f}\n")
+    print(f"Track saved as {output_file}", file=sys.stderr)
+
+
+def read_batch(batch_file: str) -> Iterator[Tuple[str, str]]:
+    # rows are read lazily, so the whole file is never held in memory
+    if is_fasta(batch_file):
+        yield from load_fasta_records(batch_file)
+        return
+    if batch_file == "-":
+        f, suffix = sys.stdin, ".tsv"
+    else:
+        f, suffix = open(batch_file, "r", newline=""), Path(batch_file).suffix.lower()
+    try:
+        if suffix in [".jsonl", ".ndjson", ".json"]:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    mutations = record["mutations"]
+                    if isinstance(mutations, list):
+                        mutations = ", ".join(mutations)
+                    yield str(record["sample_id"]), mutations
+        else:
+            reader = csv.reader(f, delimiter="," if suffix == ".csv" else "\t")
+            for row in reader:
+                if len(row) < 2 or row[0].lower() == "sample_id":
+                    continue
+                yield row[0], row[1]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# reference tables of a batch worker process, loaded from the memory-mapped store on the first chunk
+_batch_tables = None
+
+
+def score_samples(bin_size: str, samples: List[Tuple[str, str]]) -> List[str]:
+    global _batch_tables
+    if _batch_tables is None:
+        _batch_tables = load_reference_tables()
+    parsed = [functions.tokenize_mutations(mutations) for sample_id, mutations in samples]
+    scores = functions.score_batch(bin_size, parsed, _batch_tables)
+    display_names = dict(zip(_batch_tables.names, _batch_tables.display_names))
+    lines = []
+    for (sample_id, mutations), mut_list, row in zip(
+        samples, parsed, scores.to_dict("records")
+    ):
+        result = {
+            "sample_id": sample_id,
+            "mutations_count": len(mut_list.positions),
+            # as in single sample mode, lineages without transversions count one
+            "transition_transversion_ratio": row["transitions"]
+            / max(row["transversions"], 1),
+            "likelihoods": {
+                display_name: _number(row[name])
+                for name, display_name in display_names.items()
+            },
+            "best_fit": display_names.get(row["best_fit"], row["best_fit"]),
+            "times_more_likely": _number(row["times_more_likely"]),
+            "compared_to": display_names.get(row["compared_to"], row["compared_to"]),
+            "p_value": _number(row["p_value"]),
+            "mutator_lineage": functions.mut_lineage_parsing(mut_list),
+            "errors": [str(error) for error in mut_list.errors],
+        }
+        lines.append(json.dumps(result))
+    return lines
+
+
+def _number(value: float) -> Optional[float]:
+    # nan isn't valid JSON
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def ordered_map(
+    function: Callable, tasks: Iterable[tuple], jobs: int
+) -> Iterator[any]:
+    # like Executor.map(), but only a few tasks are submitted ahead of the one being returned,
+    # so memory doesn't grow with the number of tasks
+    if jobs <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    pool = functions.get_process_pool(jobs)
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(function, *task))
+        if len(pending) >= 2 * jobs:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_batch(batch_file: str, bin_size: str, batch_size: int, jobs: int) -> int:
+    samples = read_batch(batch_file)
+    chunks = iter(lambda: list(itertools.islice(samples, batch_size)), [])
+    count = 0
+    for lines in ordered_map(
+        score_samples, ((bin_size, chunk) for chunk in chunks), jobs
+    ):
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        count += len(lines)
+    return count
 
 
 def main() -> None:
     args = parse_arguments()
 
+    if args.batch:
+        count = run_batch(args.batch, args.bin_size, max(args.batch_size, 1), args.jobs)
+        if args.verbose:
+            print(f"Scored {count} samples.", file=sys.stderr)
+        return
+    if args.mutations is None:
+        print("Error: Provide a list of mutations or a `--batch` file.")
+        exit(1)
+
+    if args.track_window is not None and not 1 <= args.track_window <= 30000:
+        print("Error: `--track-window` must be between 1 and 30000 nucleotides.")
+        exit(1)
+
     if args.plot and args.bin_size not in ["500", "1000"]:
         print(
             "Error: Plotting is only available for integer bin sizes. Set `--bin-size` to 500 or 1000 to plot."
         )
         exit(1)
 
-    results, mut_list, distribution_data = analyze_mutations(
-        args.mutations, args.bin_size, args.verbose
+    if is_fasta(args.mutations):
+        records = load_fasta_records(args.mutations)
+        if len(records) == 0:
+            print("Error: None of the records in the FASTA file could be analyzed.")
+            exit(1)
+        if len(records) > 1:
+            # results for each record of a multi-record FASTA file, sharing one set of reference tables
+            reference_tables = load_reference_tables()
+            all_results = []
+            for name, mutations in records:
+                results = analyze_mutations(
+                    mutations,
+                    args.bin_size,
+                    args.verbose,
+                    reference_tables=reference_tables,
+                )[0]
+                if args.output == "text":
+                    print(f"Record: {name}")
+                    print(f"Mutations: {mutations}")
+                    print_results(results)
+                    print()
+                all_results.append({"record": name, "mutations": mutations, **results})
+            if args.output == "json":
+                print(json.dumps(all_results, indent=2))
+            if args.plot or args.track_window or args.bootstrap:
+                print(
+                    "Warning: Plots, tracks and bootstrap intervals are only produced for single-record FASTA files.",
+                    file=sys.stderr,
+                )
+            return
+        args.mutations = records[0][1]
+
+    results, mut_list, reference_tables = analyze_mutations(
+        args.mutations,
+        args.bin_size,
+        args.verbose,
+        bootstrap=args.bootstrap,
+        seed=args.seed,
+        jobs=args.jobs,
     )
 
     if args.output == "text":
@@ -222,11 +531,20 @@ def main() -> None:
     elif args.output == "json":
         print(json.dumps(results, indent=2))
 
+    if args.track_window is not None:
+        write_track(
+            mut_list,
+            reference_tables,
+            args.track_window,
+            args.track_format,
+            args.track_output,
+        )
+
     if args.plot:
         generate_plot(
             mut_list,
             args.bin_size,
-            distribution_data,
+            reference_tables,
             args.color_palette,
             args.plot_output,
         )
@@ -1,15 +1,36 @@
 # functions to be used in app.py
 
 # imports
-import pandas as pd # processing dataframes
+# pandas is imported by the functions that return dataframes, as importing it takes longer than
+# everything else the CLI does
 import numpy as np # numbers are important!
 import re # regex
 import math # math is important!
+import csv # reading the small reference files
+import json # distribution registry
+import os
+import hashlib # reference store names
+import shutil
+import tempfile
 from pathlib import Path
+from collections import namedtuple
 
 # for test purposes only
 # example_mutation_list = [897, 3431, 7842, 8293, 8393, 11042, 12789, 13339, 15756, 18492, 21608, 21711, 21941, 22032, 22208, 22034, 22295, 22353, 22556, 22770, 22895, 22896, 22898, 22910, 22916, 23009, 23012, 23013, 23018, 23019, 23271, 23423, 23604, 24378, 24990, 25207, 26529, 26610, 26681, 26833, 28958]
 
+# function to read the columns of a small delimited file
+def read_columns(filename, sep=','):
+    '''
+    inputs: filename-name of file to be opened, sep-column separator
+
+    output: dictionary of lists of the values (strings) in each column, keyed by the column names in the header
+    '''
+    # utf-8-sig drops the byte order mark that some of the csv files start with
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f, delimiter=sep) if row]
+    header = rows[0]
+    return {name: [row[i] for row in rows[1:]] for i, name in enumerate(header)}
+
 # function to parse nucleotide mutation files
 def parse_mutation_files(filename):
     '''
@@ -18,21 +39,41 @@ def parse_mutation_files(filename):
     outputs: mut_list-list of mutations contained in file. If multiple mutations are observed in the same
     location, the location appears multiple times in the list. total_mutations-total number of mutations in file
     '''
-    # open the file
-    df = pd.read_csv(filename, sep='\t')
-    # rename the columns
-    df.columns = ['position', 'counts']
+    # open the file, the first column holds positions and the second counts
+    positions, counts = [[int(i) for i in column] for column in read_columns(filename, sep='\t').values()]
     # instantiate the list of mutations
     mut_list = []
     # add each nucleotide position where there is a mutation to the list. 
     # for each genome position x where there is a mutation, the position is added n times, 
     # where n is the integer in the 'counts' column
-    for x, y in zip(df.counts.tolist(), df.position.tolist()):
+    for x, y in zip(counts, positions):
         mut_list.extend([y] * x)
     # calculate the total number of mutations in the list
-    total_mutations = sum(df.counts.tolist())
+    total_mutations = sum(counts)
     return mut_list, total_mutations
 
+# compact form of a mutation file: positions-array of the distinct mutated nucleotide positions,
+# weights-array of the number of mutations observed at each of those positions
+WeightedPositions = namedtuple('WeightedPositions', ['positions', 'weights'])
+
+# function to parse nucleotide mutation files into position and count arrays
+def parse_mutation_counts(filename):
+    '''
+    input: name of file to be opened
+    
+    outputs: mutations-WeightedPositions holding each mutated position once along with the number of
+    mutations observed there (unlike parse_mutation_files(), the positions are not repeated),
+    total_mutations-total number of mutations in file
+    '''
+    # open the file, the first column holds positions and the second counts
+    positions, weights = [np.array(column, dtype=int) for column in read_columns(filename, sep='\t').values()]
+    # calculate the total number of mutations in the file
+    total_mutations = int(weights.sum())
+    return WeightedPositions(positions, weights), total_mutations
+
+# gene files already read by parse_gene_files(), keyed by bin size
+_gene_files = {}
+
 # function to parse gene files
 # gene bins from Wuhan reference sequence NC_045512.2
 def parse_gene_files(filename):
@@ -41,47 +82,192 @@ def parse_gene_files(filename):
     
     outputs: genelist-list of nucleotide gene start positions, 
     names-list of gene names
+
+    Each file is read once per process; the lists returned are copies, so callers may change them.
     '''
+    if filename not in _gene_files:
+        _gene_files[filename] = read_gene_file(filename)
+    genelist, names = _gene_files[filename]
+    return list(genelist), list(names)
+
+# function to read a gene file (see parse_gene_files())
+def read_gene_file(filename):
     # if the user selects "gene" as bin size
     if filename == 'gene':
         gene_data = Path(__file__).parent / "./data/genes.csv"
-        df = pd.read_csv(gene_data)
+        df = read_columns(gene_data)
         # make a list of nucleotide gene start coordinates
-        genelist = df['start'].tolist()
+        genelist = [int(i) for i in df['start']]
         # make a list of gene names
-        names = df['gene'].tolist()
+        names = df['gene']
         names.pop()
     # if the user selects "genes_split" as bin size
     # this option splits the spike protein up into three sections:
     # NTD, RBD and postRBD
     elif filename == 'genes_split':
         split_gene_data = Path(__file__).parent / "./data/genes_split.csv"
-        df = pd.read_csv(split_gene_data)
+        df = read_columns(split_gene_data)
         # make a list of nucleotide gene start coordinates
-        genelist = df['start'].tolist()
+        genelist = [int(i) for i in df['start']]
         # make a list of gene names
-        names = df['gene'].tolist()
+        names = df['gene']
         names.pop()
     return genelist, names
 
+# class to hold a set of masked genome sites
+class GenomeMask:
+    '''
+    Boolean array indexed by nucleotide position (1-30001, index 0 is unused) that is True at masked sites.
+    Masks are applied to lists of positions by indexing, so the cost doesn't depend on the number of masked sites.
+    '''
+    def __init__(self, positions=None):
+        '''
+        input: positions-optional list of nucleotide positions to mask
+        '''
+        self.masked = np.zeros(30002, dtype=bool)
+        if positions is not None:
+            self.masked[np.asarray(positions, dtype=int)] = True
+
+    @classmethod
+    def from_bed(cls, filename):
+        '''
+        input: filename-BED file of masked regions (0-based start, end exclusive). Comment, track and browser
+        lines are ignored
+
+        output: GenomeMask with every site in the regions masked
+        '''
+        mask = cls()
+        with open(filename) as f:
+            for line in f:
+                if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+                    continue
+                fields = line.split('\t')
+                start, end = int(fields[1]), int(fields[2])
+                # convert to 1-based positions
+                mask.masked[start + 1:end + 1] = True
+        return mask
+
+    def __or__(self, other):
+        '''
+        output: GenomeMask with the sites masked in either mask
+        '''
+        combined = GenomeMask()
+        combined.masked = self.masked | other.masked
+        return combined
+
+    def apply(self, x):
+        '''
+        input: x-list or array of nucleotide positions (or WeightedPositions)
+
+        output: the positions (with their weights) that are not masked, as arrays
+        '''
+        if isinstance(x, WeightedPositions):
+            keep = ~self.masked[np.clip(x.positions, 0, 30001)]
+            return WeightedPositions(x.positions[keep], x.weights[keep])
+        x = np.asarray(x, dtype=int)
+        return x[~self.masked[np.clip(x, 0, 30001)]]
+
+# masked sites are because the deer distribution was calculated from aa positions, so non-coding sites were dropped
+deer_mask = GenomeMask.from_bed(Path(__file__).parent / "./data/masks/deer.bed")
+
+# folder holding the existing distributions and the registry (distributions.json) that lists them
+data_dir = Path(__file__).parent / "data"
+
+# an existing distribution listed in the registry
+# name-name used in results, display_name-name shown to users, file-path of its mutation counts file,
+# masks-list of GenomeMask applied to it (and to the user's mutations when they are compared to it),
+# colour-optional hex code used in plots instead of the colour from the selected palette
+Distribution = namedtuple('Distribution', ['name', 'display_name', 'file', 'masks', 'colour'])
+
+# function to load the registry of existing distributions
+def load_registry(directory=data_dir):
+    '''
+    input: directory-folder containing distributions.json and the files it lists
+
+    output: list of Distribution, in the order that likelihoods are reported
+
+    Each entry of distributions.json needs a name and a file (mutation counts as read by parse_mutation_counts()),
+    and may have a display_name, a list of masks (BED files) and a colour. Paths are relative to the directory.
+    Adding a distribution only needs its file and an entry in distributions.json.
+    '''
+    directory = Path(directory)
+    with open(directory / "distributions.json") as f:
+        entries = json.load(f)["distributions"]
+    registry = []
+    for entry in entries:
+        masks = [GenomeMask.from_bed(directory / mask) for mask in entry.get("masks", [])]
+        registry.append(Distribution(entry["name"], entry.get("display_name") or entry["name"].replace("_", " "),
+                                     directory / entry["file"], masks, entry.get("colour")))
+    return registry
+
+# existing distributions shipped with the app
+registry = load_registry()
+
+# names of the existing distributions, in the order that likelihoods are reported
+distribution_names = [distribution.name for distribution in registry]
+
+# masks added to each distribution on top of those in the registry, keyed by distribution name
+distribution_masks = {}
+
+# function to add a mask (e.g. problematic sites or primer dropout regions) to a distribution
+def register_mask(distribution, mask):
+    '''
+    inputs: distribution-name of the distribution (e.g. 'chronic'), mask-GenomeMask to apply to it
+
+    Masks should be registered before ReferenceTables are created, as the tables are binned with the
+    masks in place at that time.
+    '''
+    distribution_masks.setdefault(distribution, []).append(mask)
+
+# function to combine a list of masks into one
+def combine_masks(masks):
+    '''
+    input: masks-list of GenomeMask
+
+    output: GenomeMask masking every site masked in any of them, or None if the list is empty
+    '''
+    if len(masks) == 0:
+        return None
+    combined = masks[0]
+    for mask in masks[1:]:
+        combined = combined | mask
+    return combined
+
+# function to combine the masks of a distribution
+def get_mask(distribution, registry=registry):
+    '''
+    inputs: distribution-name of the distribution, registry-list of Distribution the masks are taken from
+
+    output: GenomeMask combining the distribution's masks from the registry and every mask registered for it,
+    or None if there are none
+    '''
+    masks = [mask for entry in registry if entry.name == distribution for mask in entry.masks]
+    return combine_masks(masks + distribution_masks.get(distribution, []))
+
 # function to make bins based on either genes or a specific number of nucleotides,
 # depending on what the user selects. Mutation positions are then put into bins.
-def make_bins(x, binsize, deer = False):
+def make_bins(x, binsize, deer = False, mask = None):
     '''
-    inputs: x-list of nucleotide positions where mutations occur, binsize-user-defined bin size
+    inputs: x-list of nucleotide positions where mutations occur (or WeightedPositions from
+    parse_mutation_counts()), binsize-user-defined bin size
     for plotting and likelihood calculations
     binsize - the size of the bins that user input should be placed into
     deer - flag for whether or not the mutations are being placed in bins to compare to deer distribution (sites are masked in this case)
+    mask - optional GenomeMask of sites to drop before binning (used instead of the deer flag)
     
     outputs: counts-a list of the number of mutations that fall into each bin, bins0- the names
     of the bins
     '''
-    # masked sites are because the deer distribution was calculated from aa positions, so non-coding sites were dropped
-    mask_deer = [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,51,52,53,54,55,56,57,58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,90,91,92,93,94,95,96,97,98,99,100,101,102,103,104,105,106,107,108,109,110,111,112,113,114,115,116,117,118,119,120,121,122,123,124,125,126,127,128,129,130,131,132,133,134,135,136,137,138,139,140,141,142,143,144,145,146,147,148,149,150,151,152,153,154,155,156,157,158,159,160,161,162,163,164,165,166,167,168,169,170,171,172,173,174,175,176,177,178,179,180,181,182,183,184,185,186,187,188,189,190,191,192,193,194,195,196,197,198,199,200,201,202,203,204,205,206,207,208,209,210,211,212,213,214,215,216,217,218,219,220,221,222,223,224,225,226,227,228,229,230,231,232,233,234,235,236,237,238,239,240,241,242,243,244,245,246,247,248,249,250,251,252,253,254,255,256,257,258,259,260,261,262,263,264,265,21556,21557,21558,21559,21560,21561,21562,25385,25386,25387,25388,25389,25390,25391,25392,26221,26222,26223,26224,26225,26226,26227,26228,26229,26230,26231,26232,26233,26234,26235,26236,26237,26238,26239,26240,26241,26242,26243,26244,26473,26474,26475,26476,26477,26478,26479,26480,26481,26482,26483,26484,26485,26486,26487,26488,26489,26490,26491,26492,26493,26494,26495,26496,26497,26498,26499,26500,26501,26502,26503,26504,26505,26506,26507,26508,26509,26510,26511,26512,26513,26514,26515,26516,26517,26518,26519,26520,26521,26522,27192,27193,27194,27195,27196,27197,27198,27199,27200,27201,27388,27389,27390,27391,27392,27393,27888,27889,27890,27891,27892,27893,28260,28261,28262,28263,28264,28265,28266,28267,28268,28269,28270,28271,28272,28273,29534,29535,29536,29537,29538,29539,29540,29541,29542,29543,29544,29545,29546,29547,29548,29549,29550,29551,29552,29553,29554,29555,29556,29557,29675,29676,29677,29678,29679,29680,29681,29682,29683,29684,29685,29686,29687,29688,29689,29690,29691,29692,29693,29694,29695,29696,29697,29698,29699,29700,29701,29702,29703,29704,29705,29706,29707,29708,29709,29710,29711,29712,29713,29714,29715,29716,29717,29718,29719,29720,29721,29722,29723,29724,29725,29726,29727,29728,29729,29730,29731,29732,29733,29734,29735,29736,29737,29738,29739,29740,29741,29742,29743,29744,29745,29746,29747,29748,29749,29750,29751,29752,29753,29754,29755,29756,29757,29758,29759,29760,29761,29762,29763,29764,29765,29766,29767,29768,29769,29770,29771,29772,29773,29774,29775,29776,29777,29778,29779,29780,29781,29782,29783,29784,29785,29786,29787,29788,29789,29790,29791,29792,29793,29794,29795,29796,29797,29798,29799,29800,29801,29802,29803,29804,29805,29806,29807,29808,29809,29810,29811,29812,29813,29814,29815,29816,29817,29818,29819,29820,29821,29822,29823,29824,29825,29826,29827,29828,29829,29830,29831,29832,29833,29834,29835,29836,29837,29838,29839,29840,29841,29842,29843,29844,29845,29846,29847,29848,29849,29850,29851,29852,29853,29854,29855,29856,29857,29858,29859,29860,29861,29862,29863,29864,29865,29866,29867,29868,29869,29870,29871,29872,29873,29874,29875,29876,29877,29878,29879,29880,29881,29882,29883,29884,29885,29886,29887,29888,29889,29890,29891,29892,29893,29894,29895,29896,29897,29898,29899,29900,29901,29902,29903]
     # if the list of mutations is being compared to the deer distribution, it needs to be masked
     if deer == True:
-        masked_input = [i for i in x if i not in mask_deer]
-        x = masked_input
+        mask = get_mask('deer')
+    if mask is not None:
+        x = mask.apply(x)
+    # reference distributions from parse_mutation_counts() carry a weight (count) for each position
+    if isinstance(x, WeightedPositions):
+        x, weights = x
+    else:
+        x, weights = np.asarray(x), None
     # first see if the user has selected an integer bin size
     try:
         int(binsize)
@@ -89,10 +275,12 @@ def make_bins(x, binsize, deer = False):
         # fall into each bin (based on genome size of 30,000) and then make a list
         # of the centers of each of the bins for plotting 
         # np.histogram gives you the bin edges https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-        counts, bins0 = np.histogram(x, bins=range(1,30002,int(binsize)))
+        counts, bins0 = np.histogram(x, bins=range(1,30002,int(binsize)), weights=weights)
         bins0 = 0.5 * (bins0[:-1] + bins0[1:])
     except ValueError:
-        y = [i for i in x if i > 263 and i < 30001]
+        keep = (x > 263) & (x < 30001)
+        y = x[keep]
+        weights = None if weights is None else weights[keep]
         if binsize == 'gene':
             # first get the gene start positions and gene names from file using
             # parse_gene_files() function
@@ -102,10 +290,69 @@ def make_bins(x, binsize, deer = False):
             # parse_gene_files() function
             genebins, names = parse_gene_files('genes_split')
         # then make a list of the number of mutations that fall into each bin (gene)
-        counts, bins = np.histogram(y, bins=genebins)
+        counts, bins = np.histogram(y, bins=genebins, weights=weights)
         bins0 = names
     return counts, bins0
 
+# function to map every genome position to the bin that make_bins() would place it in
+def bin_lookup(binsize, deer = False, mask = None):
+    '''
+    inputs: binsize-user-defined bin size, deer-flag for whether or not the deer masked sites should be dropped,
+    mask-optional GenomeMask of sites to drop (used instead of the deer flag)
+
+    output: lookup-array of length 30002 where lookup[position] is the index of the bin that the position falls into,
+    or -1 if the position is not counted in any bin
+    '''
+    positions = np.arange(30002)
+    try:
+        # same bin edges as np.histogram() in make_bins()
+        edges = np.arange(1, 30002, int(binsize))
+    except ValueError:
+        edges = np.array(parse_gene_files('gene' if binsize == 'gene' else 'genes_split')[0])
+    lookup = np.searchsorted(edges, positions, side='right') - 1
+    # like np.histogram(), the last bin includes its right edge
+    lookup[positions == edges[-1]] = len(edges) - 2
+    lookup[(positions < edges[0]) | (positions > edges[-1])] = -1
+    if deer == True:
+        mask = get_mask('deer')
+    if mask is not None:
+        lookup[mask.masked] = -1
+    return lookup
+
+# function to count the mutations of many lineages into bins in one pass
+def count_matrix(rows, positions, lookup, n_rows, n_bins):
+    '''
+    inputs: rows-array giving the lineage (row) that each mutation belongs to, positions-array of the matching
+    nucleotide positions, lookup-position to bin lookup from bin_lookup(), n_rows-number of lineages,
+    n_bins-number of bins in the table (a mask can leave the last bins without any position in the lookup)
+
+    output: array of bin counts with one row per lineage and one column per bin
+    '''
+    bin_index = lookup[positions]
+    # drop positions that do not fall into any bin
+    keep = bin_index >= 0
+    flat = rows[keep] * n_bins + bin_index[keep]
+    return np.bincount(flat, minlength=n_rows * n_bins).reshape(n_rows, n_bins)
+
+# function to count the mutations at every nucleotide position
+def site_counts(x, mask = None):
+    '''
+    inputs: x-list of nucleotide positions where mutations occur (or WeightedPositions),
+    mask-optional GenomeMask of sites to drop
+
+    output: array of length 30002 where entry i is the number of mutations at position i
+    '''
+    if mask is not None:
+        x = mask.apply(x)
+    if isinstance(x, WeightedPositions):
+        x, weights = x
+    else:
+        x, weights = np.asarray(x, dtype=int), None
+    # positions outside of the genome are dropped
+    keep = (x > 0) & (x < 30002)
+    weights = None if weights is None else weights[keep]
+    return np.bincount(x[keep], weights=weights, minlength=30002).astype(int)
+
 # function to calculate likelihood of user's mutation list belonging to specified distributions
 def get_likelihood(existing_bin_counts, test_bin_counts):
     '''
@@ -121,76 +368,845 @@ def get_likelihood(existing_bin_counts, test_bin_counts):
     # perform the likelihood calculation
     return np.sum(np.log(((existing_bin_counts + 1)/np.sum(existing_bin_counts + 1)) ** test_bin_counts))
 
+# bin counts and smoothed log probabilities of every existing distribution for a single bin size
+# names-distribution names, bins-bin names (or centres), counts-array of bin counts with one row per
+# distribution, log_probs-array of log((counts + 1) / sum(counts + 1)) with one row per distribution,
+# lookups-position to bin lookups from bin_lookup(), one for each distinct mask used by the distributions,
+# groups-array giving the index of the lookup that each distribution (row) uses
+ReferenceTable = namedtuple('ReferenceTable', ['names', 'bins', 'counts', 'log_probs', 'lookups', 'groups'])
+
+# class to hold the existing distributions and cache their bin tables
+class ReferenceTables:
+    '''
+    The existing distributions never change between calls, so they are binned once per bin size
+    and the resulting ReferenceTable is kept and reused by every subsequent call to most_likely().
+    '''
+    def __init__(self, *distributions, names=None, display_names=None, colours=None, masks=None):
+        '''
+        inputs: distributions-mutated nucleotide positions in each distribution (WeightedPositions from
+        parse_mutation_counts() or lists from parse_mutation_files()), by default global pre-VoC, global Omicron,
+        chronic and deer as in the registry, names-optional distribution names (defaults to distribution_names),
+        display_names, colours-optional display names and plot colours, masks-optional GenomeMask (or None)
+        for each distribution (defaults to the masks of each name, see get_mask())
+        '''
+        self.distributions = list(distributions)
+        self.names = list(names) if names is not None else list(distribution_names)
+        if len(self.names) != len(self.distributions):
+            raise ValueError(f'Expected {len(self.names)} distributions ({", ".join(self.names)}), got {len(self.distributions)}.')
+        self.display_names = list(display_names) if display_names is not None else [name.replace('_', ' ') for name in self.names]
+        self.colours = list(colours) if colours is not None else [None] * len(self.names)
+        # masks registered for each distribution when the tables were created
+        self.masks = list(masks) if masks is not None else [get_mask(name) for name in self.names]
+        # distributions sharing a mask share a lookup, so the user's mutations are binned once per mask
+        distinct_masks = []
+        groups = []
+        for mask in self.masks:
+            if mask not in distinct_masks:
+                distinct_masks.append(mask)
+            groups.append(distinct_masks.index(mask))
+        self.distinct_masks = distinct_masks
+        self.groups = np.array(groups)
+        # cache of ReferenceTable objects keyed by bin size
+        self._tables = {}
+        # cache of per-position count arrays keyed by distribution name
+        self._site_counts = {}
+
+    @classmethod
+    def from_registry(cls, registry=registry, distributions=None):
+        '''
+        inputs: registry-list of Distribution (defaults to the shipped registry),
+        distributions-optional dictionary of the already loaded WeightedPositions of each distribution,
+        keyed by name. Distributions that aren't in it are read from their files
+
+        output: ReferenceTables holding every distribution in the registry
+        '''
+        distributions = distributions or {}
+        loaded = [distributions[entry.name] if entry.name in distributions else parse_mutation_counts(entry.file)[0]
+                  for entry in registry]
+        return cls(*loaded, names=[entry.name for entry in registry],
+                   display_names=[entry.display_name for entry in registry],
+                   colours=[entry.colour for entry in registry],
+                   masks=[combine_masks(entry.masks + distribution_masks.get(entry.name, [])) for entry in registry])
+
+    def palette(self, palette_name):
+        '''
+        input: palette_name-user-specified palette name (see select_palette())
+
+        output: list of hex codes with one colour for every distribution. The first colour of the palette is
+        left for the user's mutations, and distributions with their own colour in the registry keep it
+        '''
+        colour_list = select_palette(palette_name)
+        return [colour or colour_list[1 + i % (len(colour_list) - 1)] for i, colour in enumerate(self.colours)]
+
+    def totals(self):
+        '''
+        output: list of the total number of mutations in each distribution (before masking)
+        '''
+        return [int(x.weights.sum()) if isinstance(x, WeightedPositions) else len(x) for x in self.distributions]
+
+    def site_counts(self, name):
+        '''
+        input: name-name of the distribution
+
+        output: array of the number of mutations at every position in the distribution (see site_counts()),
+        with the distribution's masks applied
+        '''
+        if name not in self._site_counts:
+            index = self.names.index(name)
+            self._site_counts[name] = site_counts(self.distributions[index], self.masks[index])
+        return self._site_counts[name]
+
+    def table(self, binsize):
+        '''
+        input: binsize-user-selected bin size ('gene', 'genes_split' or an integer number of nucleotides)
+
+        output: ReferenceTable for the bin size, calculated the first time it is requested
+        '''
+        # '500' from the app and 500 from python refer to the same bins
+        key = str(binsize)
+        if key not in self._tables:
+            counts = []
+            for x, mask in zip(self.distributions, self.masks):
+                dist_counts, bins = make_bins(x, binsize, mask=mask)
+                counts.append(dist_counts)
+            counts = np.array(counts)
+            # add one to each bin so that there are no bins lacking data
+            log_probs = np.log((counts + 1) / np.sum(counts + 1, axis=1, keepdims=True))
+            lookups = [bin_lookup(binsize, mask=mask) for mask in self.distinct_masks]
+            self._tables[key] = ReferenceTable(self.names, bins, counts, log_probs, lookups, self.groups)
+        return self._tables[key]
+
+# bin sizes whose tables are kept in the reference store
+store_binsizes = ['genes_split', 'gene', '500', '1000']
+
+# folder holding the reference stores, one sub-folder per content hash (can be moved with SMDP_STORE_DIR)
+store_dir = Path(os.environ.get('SMDP_STORE_DIR', Path(__file__).parent / "data" / "store"))
+
+# bump when the layout of the store changes, so that old stores are rebuilt
+store_version = '1'
+
+# every store folder is named with this prefix and the content hash; nothing else in store_dir is touched
+store_prefix = 'smdp-store-'
+
+# function to calculate the content hash of the reference data that a store is built from
+def reference_hash(registry=registry):
+    '''
+    input: registry-list of Distribution
+
+    output: hex digest covering the store layout, every distribution (name, display name, colour, counts file
+    and masks, including registered masks) and the gene boundary files
+    '''
+    digest = hashlib.sha256(store_version.encode())
+    for entry in registry:
+        digest.update(json.dumps([entry.name, entry.display_name, entry.colour]).encode())
+        digest.update(Path(entry.file).read_bytes())
+        mask = combine_masks(entry.masks + distribution_masks.get(entry.name, []))
+        digest.update(b'-' if mask is None else mask.masked.tobytes())
+    for filename in ['genes.csv', 'genes_split.csv']:
+        digest.update((Path(__file__).parent / "data" / filename).read_bytes())
+    return digest.hexdigest()
+
+# function to write the arrays of a ReferenceTables to a store folder
+def build_reference_store(reference_tables, path):
+    '''
+    inputs: reference_tables-ReferenceTables to store, path-folder to write to
+
+    Every array is written as its own .npy file so that it can be memory-mapped by load_reference_store().
+    '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    names = reference_tables.names
+    np.save(path / 'site_counts.npy', np.array([site_counts(x) for x in reference_tables.distributions]))
+    np.save(path / 'masked_site_counts.npy', np.array([reference_tables.site_counts(name) for name in names]))
+    np.save(path / 'groups.npy', reference_tables.groups)
+    np.save(path / 'masks.npy', np.array([np.zeros(30002, dtype=bool) if mask is None else mask.masked
+                                          for mask in reference_tables.distinct_masks]))
+    for binsize in store_binsizes:
+        table = reference_tables.table(binsize)
+        np.save(path / f'bins_{binsize}.npy', np.asarray(table.bins))
+        np.save(path / f'counts_{binsize}.npy', table.counts)
+        np.save(path / f'log_probs_{binsize}.npy', table.log_probs)
+        np.save(path / f'lookups_{binsize}.npy', np.array(table.lookups))
+    metadata = {'names': names, 'display_names': reference_tables.display_names,
+                'colours': reference_tables.colours,
+                'unmasked': [mask is None for mask in reference_tables.distinct_masks]}
+    with open(path / 'metadata.json', 'w') as f:
+        json.dump(metadata, f)
+
+# function to load a store folder written by build_reference_store()
+def load_reference_store(path):
+    '''
+    input: path-store folder
+
+    output: ReferenceTables with the site counts and the tables of store_binsizes filled in from the store.
+    The arrays are memory-mapped read-only, so processes loading the same store share one copy of them
+    '''
+    path = Path(path)
+    with open(path / 'metadata.json') as f:
+        metadata = json.load(f)
+    def load(name):
+        return np.load(path / f'{name}.npy', mmap_mode='r')
+    counts = load('site_counts')
+    distributions = []
+    for row in counts:
+        positions = np.flatnonzero(row)
+        distributions.append(WeightedPositions(positions, np.asarray(row[positions])))
+    # distributions sharing a lookup share one GenomeMask, so the groups come out the same
+    distinct_masks = []
+    for masked, unmasked in zip(load('masks'), metadata['unmasked']):
+        mask = None
+        if not unmasked:
+            mask = GenomeMask()
+            mask.masked = masked
+        distinct_masks.append(mask)
+    groups = load('groups')
+    reference_tables = ReferenceTables(*distributions, names=metadata['names'],
+                                       display_names=metadata['display_names'], colours=metadata['colours'],
+                                       masks=[distinct_masks[group] for group in groups])
+    masked_counts = load('masked_site_counts')
+    reference_tables._site_counts = dict(zip(reference_tables.names, masked_counts))
+    for binsize in store_binsizes:
+        bins = load(f'bins_{binsize}')
+        reference_tables._tables[binsize] = ReferenceTable(reference_tables.names,
+                                                           bins.tolist() if bins.dtype.kind == 'U' else bins,
+                                                           load(f'counts_{binsize}'), load(f'log_probs_{binsize}'),
+                                                           list(load(f'lookups_{binsize}')), reference_tables.groups)
+    return reference_tables
+
+# function to load the existing distributions through the reference store, building the store if needed
+def load_reference_tables(registry=registry, directory=None):
+    '''
+    inputs: registry-list of Distribution, directory-folder holding the stores (defaults to store_dir)
+
+    output: ReferenceTables for the registry
+
+    The store is named after the content hash of the reference data, so it is rebuilt only when that
+    changes. It is written to a temporary folder and renamed into place, so other processes never see a
+    partly written store. Only folders named with store_prefix are ever removed, so the folder can be shared
+    with other data. If the folder can't be written to or the store can't be read (e.g. it belongs to
+    another user), the distributions are read directly instead.
+    '''
+    directory = Path(directory) if directory is not None else store_dir
+    path = directory / f'{store_prefix}{reference_hash(registry)}'
+    if not path.is_dir():
+        reference_tables = ReferenceTables.from_registry(registry)
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            temporary = tempfile.mkdtemp(prefix=f'.{store_prefix}building-', dir=directory)
+        except OSError:
+            return reference_tables
+        try:
+            build_reference_store(reference_tables, temporary)
+            # mkdtemp makes the folder private, app workers may run as another user
+            os.chmod(temporary, 0o755)
+            os.rename(temporary, path)
+        except OSError:
+            # another process finished building the same store first
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not path.is_dir():
+                return reference_tables
+        # remove stores built from older reference data
+        for old in directory.iterdir():
+            if old != path and old.name.startswith(store_prefix) and old.is_dir():
+                shutil.rmtree(old, ignore_errors=True)
+    try:
+        return load_reference_store(path)
+    except (OSError, ValueError, KeyError):
+        # the store was removed in the meantime, or can't be read by this user
+        return ReferenceTables.from_registry(registry)
+
+# reference tables shared by everything in this process, loaded the first time they are needed
+_reference_tables = None
+
+# function to get the reference tables shared by every app session in this process
+def get_reference_tables():
+    '''
+    output: ReferenceTables from load_reference_tables(), loaded once per process
+
+    The tables (and the bin tables they cache) are shared by every caller, so they must be treated as
+    read-only; the arrays loaded from the store are read-only memory maps.
+    '''
+    global _reference_tables
+    if _reference_tables is None:
+        _reference_tables = load_reference_tables()
+    return _reference_tables
+
+# function to calculate the log likelihoods of the user's mutations for every row of a reference table
+def get_likelihoods(table, mut_nuc_list):
+    '''
+    inputs: table-ReferenceTable for the selected bin size,
+    mut_nuc_list-list of nucleotide positions from user's list
+
+    output: array of log likelihoods, one per distribution in the table
+    '''
+    positions = np.asarray(mut_nuc_list, dtype=int)
+    # bin the user's mutations once for each mask, then pick the counts that match each distribution
+    n_bins = table.counts.shape[1]
+    mut_counts = np.array([count_matrix(np.zeros(len(positions), dtype=int), positions, lookup, 1, n_bins)[0]
+                           for lookup in table.lookups])
+    user_counts = mut_counts[table.groups]
+    # same calculation as get_likelihood(), as sum(counts * log(probability)) for every row at once
+    return np.sum(table.log_probs * user_counts, axis=1)
+
+# function to calculate the log likelihoods of many lineages for every row of a reference table
+def score_matrix(table, rows, positions, n_rows):
+    '''
+    inputs: table-ReferenceTable for the selected bin size, rows-array giving the lineage (row) of each mutation,
+    positions-array of the mutated nucleotide positions, n_rows-number of lineages
+
+    output: array of log likelihoods with one row per lineage and one column per distribution in the table
+    '''
+    # one count matrix for each mask, multiplied by the log probabilities of the distributions using that mask
+    likelihoods = np.zeros((n_rows, len(table.names)))
+    for group, lookup in enumerate(table.lookups):
+        in_group = table.groups == group
+        counts = count_matrix(rows, positions, lookup, n_rows, table.counts.shape[1])
+        likelihoods[:, in_group] = counts @ table.log_probs[in_group].T
+    return likelihoods
+
+# function to calculate the log likelihood ratio of two distributions in a window starting at every genome position
+def likelihood_ratio_track(mutated_nucleotide_list, reference_tables, window, numerator='chronic', denominator='global_pre-VoC'):
+    '''
+    inputs: mutated_nucleotide_list-user's mutations (string or ParsedMutations),
+    reference_tables-ReferenceTables holding the existing distributions, window-width of the window in nucleotides,
+    numerator, denominator-names of the distributions to compare (default chronic vs. global pre-VoC)
+
+    outputs: starts-first position of each window, ends-last position of each window,
+    ratios-log likelihood ratio of the user's mutations inside each window
+    (numerator log likelihood - denominator log likelihood)
+
+    Each window is treated like one bin of make_bins() with an integer bin size equal to the window width:
+    the probability of a mutation falling into the window under a distribution is
+    (mutations in window + 1) / (total mutations + number of bins). The window sums are taken from cumulative
+    sums of per-position counts, so the whole track takes the same time whatever the window width.
+    '''
+    window = int(window)
+    if window < 1 or window > 30000:
+        raise ValueError('The window width must be between 1 and 30000 nucleotides.')
+    positions = tokenize_mutations(mutated_nucleotide_list).positions
+    # number of bins of this width across the genome, used for the + 1 added to each bin
+    n_bins = len(range(1, 30002, window)) - 1
+    starts = np.arange(1, 30001 - window + 1)
+    ratios = np.zeros(len(starts))
+    for name, sign in [(numerator, 1), (denominator, -1)]:
+        index = reference_tables.names.index(name)
+        mask = reference_tables.masks[index]
+        dist_counts = reference_tables.site_counts(name)[1:30001]
+        user_counts = site_counts(positions, mask)[1:30001]
+        # cumulative sums so that the sum over positions [start, start + window) is a single subtraction
+        dist_sums = np.concatenate([[0], np.cumsum(dist_counts)])
+        user_sums = np.concatenate([[0], np.cumsum(user_counts)])
+        dist_window = dist_sums[starts - 1 + window] - dist_sums[starts - 1]
+        user_window = user_sums[starts - 1 + window] - user_sums[starts - 1]
+        log_probs = np.log((dist_window + 1) / (dist_counts.sum() + n_bins))
+        ratios += sign * user_window * log_probs
+    return starts, starts + window - 1, ratios
+
+# function to pull the nucleotide positions out of the user's input
+def parse_positions(mutated_nucleotide_list):
+    '''
+    input: mutated_nucleotide_list-string of comma-separated mutations, or ParsedMutations
+
+    output: mut_nuc_list-list of integer nucleotide positions between 1 and 30000. Entries that aren't
+    recognised mutations or fall outside of the genome are skipped
+    '''
+    return tokenize_mutations(mutated_nucleotide_list).positions.tolist()
+
 # function to determine most likely distribution for the user's list of mutations
-def most_likely(binsize, global_, global_late, chronic, deer, mutated_nucleotide_list):
+def most_likely(binsize, global_, global_late, chronic, deer, mutated_nucleotide_list, reference_tables=None):
     '''
     inputs: binsize-user-selected binsize, global_-list of mutated nucleotide positions in global distribution,
     chronic-list of mutated nucleotide positions in chronic distribution, deer-list of mutated nucleotide positions
-    in deer distribution, mutated_nucleotide_list-user-specified list of mutated nucleotide positions
+    in deer distribution, mutated_nucleotide_list-user-specified list of mutated nucleotide positions (string or ParsedMutations),
+    reference_tables-optional ReferenceTables holding the existing distributions. When it is supplied the cached
+    bin tables are used and only the user's mutations are binned
     
     outputs: zipped-a list of tuples containing the likelihood that the user's mutation distribution fits each of the
     existing distributions in the following format [(global_likelihood, 'global'), (global_late_likelihood, 'global_late'),
     (chronic_likelihood, 'chronic'), (deer_likelihood, 'deer')],
     best_fit: the name of the distribution that the user's list of mutations fits best (e.g. 'chronic')
     '''
+    if reference_tables is None:
+        reference_tables = ReferenceTables(global_, global_late, chronic, deer)
+    return rank_distributions(binsize, mutated_nucleotide_list, reference_tables)
+
+# function to determine which of the distributions in a ReferenceTables best fits the user's list of mutations
+def rank_distributions(binsize, mutated_nucleotide_list, reference_tables):
+    '''
+    inputs: binsize-user-selected binsize, mutated_nucleotide_list-user-specified list of mutated nucleotide
+    positions (string or ParsedMutations), reference_tables-ReferenceTables holding the existing distributions
+
+    outputs: zipped-a list of (likelihood, name) tuples, one for each distribution in reference_tables,
+    best_fit: the (likelihood, name) tuple of the distribution that fits best (see most_likely())
+    '''
     # first try to see if user input of mutated nucleotides can be processed
     try:
-        # gui accepts input as a string, so it first needs to be split into a list 
-        # splits occur wherever there is a comma 
-        mutated_nucleotide_list = mutated_nucleotide_list.rstrip(',').rstrip().split(',') 
-        # try to remove non-digit characters, then convert each string in list into
-        # an integer
-        int_nuc_list = [re.sub('\D', '', i) for i in mutated_nucleotide_list]
-        digit_nuc_list = [int(i) for i in int_nuc_list]
-        mut_nuc_list = [i for i in digit_nuc_list if i > 0 and i < 30001]
-    except ValueError:
-        # if this fails, return None and exit function - there will be a message printed on the
-        # screen prompting the user to enter appropriate input
-        int_nuc_list = [re.sub('\D', '', i) for i in mutated_nucleotide_list]
-        mut_nuc_list = []
-        for i in int_nuc_list:
-            try:
-                if int(i) < 30001 and int(i) > 0:
-                    mut_nuc_list.append(int(i))
-                else: 
-                    pass 
-            except:
-                pass
+        mut_nuc_list = parse_positions(mutated_nucleotide_list)
     except:    
-        names = ['', '', '', '']
-        dummy_likelihoods = ['','','','']
+        names = [''] * len(reference_tables.names)
+        dummy_likelihoods = [''] * len(reference_tables.names)
         # zip the two lists together
         dummy_zipped = list(zip(dummy_likelihoods, names))
         dummy_fit = ['','']
         return dummy_zipped, dummy_fit
     
-    # if the user's input is processed successfully, split the mutated nucleotide positions
-    # into bins
-    mut_counts, mut_bins = make_bins(mut_nuc_list, binsize)
-    mut_counts_deer, mut_bins_deer = make_bins(mut_nuc_list, binsize, deer=True)
-    # get bins for global, chronic and deer
-    global_counts, global_bins = make_bins(global_,binsize)
-    global_late_counts, global_late_bins = make_bins(global_late, binsize)
-    chronic_counts, chronic_bins = make_bins(chronic,binsize)
-    deer_counts, deer__bins = make_bins(deer,binsize,deer=True)
-    
-    # calculate all likelihoods using the number of mutations per bin in the user's input and
-    # in existing distributions
-    global_likelihood = get_likelihood(global_counts, mut_counts)
-    global_late_likelihood = get_likelihood(global_late_counts, mut_counts)
-    chronic_likelihood = get_likelihood(chronic_counts, mut_counts)
-    deer_likelihood = get_likelihood(deer_counts, mut_counts_deer)
+    # get bins for every distribution (calculated once per bin size and cached)
+    table = reference_tables.table(binsize)
     
+    # if the user's input is processed successfully, split the mutated nucleotide positions
+    # into bins and calculate all likelihoods using the number of mutations per bin in the 
+    # user's input and in existing distributions
     # make a list of all likelihoods
-    likelihood_list = [global_likelihood, global_late_likelihood, chronic_likelihood, deer_likelihood]
+    likelihood_list = list(get_likelihoods(table, mut_nuc_list))
     # create a matching list of names for the list above
-    names = ['global_pre-VoC', 'global_Omicron', 'chronic', 'deer']
+    names = table.names
     # zip the two lists together
     zipped = list(zip(likelihood_list, names))
     # find the name of the distribution that best fits the user's input
     best_fit = max(zipped)
     return zipped, best_fit
 
+# function to score many lists of mutations against the existing distributions at once
+def score_batch(binsize, mutation_sets, reference_tables, sample_ids=None, null_table=None):
+    '''
+    inputs: binsize-user-selected binsize, mutation_sets-list of strings of comma-separated mutations
+    or ParsedMutations (one per lineage), reference_tables-ReferenceTables holding the existing distributions,
+    sample_ids-optional list of names for the lineages (defaults to their index),
+    null_table-optional NullTable used for the p_value column (defaults to the shipped table)
+
+    output: pandas DataFrame with one row per lineage containing the number of mutations, the counts of
+    transitions and transversions, the log likelihood of each distribution, the best fit distribution, the number of times more likely it is than the next best
+    fit distribution (times_more_likely), the name of that distribution (compared_to) and the empirical
+    p-value of the null table's log likelihood ratio (p_value, see NullTable.p_values())
+    '''
+    import pandas as pd
+    table = reference_tables.table(binsize)
+    # parse every lineage once
+    parsed_list = []
+    for mutations in mutation_sets:
+        try:
+            parsed_list.append(tokenize_mutations(mutations))
+        except AttributeError:
+            # entries that aren't strings (e.g. missing values) are scored as empty lineages
+            parsed_list.append(tokenize_mutations(''))
+    # collect the positions of every lineage into one array, remembering which lineage (row) each came from
+    position_lists = [i.positions for i in parsed_list]
+    n = len(position_lists)
+    lengths = np.array([len(i) for i in position_lists], dtype=int)
+    rows = np.repeat(np.arange(n), lengths)
+    positions = np.concatenate(position_lists) if n > 0 else np.array([], dtype=int)
+    # log likelihoods of every lineage against every distribution as matrix products
+    likelihoods = score_matrix(table, rows, positions, n)
+    # sort each row so that the best and next best fits are the last two columns
+    order = np.argsort(likelihoods, axis=1, kind='stable')
+    best = order[:, -1]
+    second = order[:, -2]
+    lineages = np.arange(n)
+    names = np.array(table.names, dtype=object)
+    empty = lengths == 0
+    df = pd.DataFrame(likelihoods, columns=table.names)
+    df.insert(0, 'mutations_count', lengths)
+    spectrum, transitions, transversions = substitution_spectrum(parsed_list)
+    df.insert(1, 'transitions', transitions)
+    df.insert(2, 'transversions', transversions)
+    df['best_fit'] = np.where(empty, '', names[best])
+    df['times_more_likely'] = np.where(empty, np.nan, np.exp(likelihoods[lineages, best] - likelihoods[lineages, second]))
+    df['compared_to'] = np.where(empty, '', names[second])
+    if null_table is None:
+        null_table = get_null_table()
+    if null_table is not None and null_table.numerator in table.names and null_table.denominator in table.names:
+        ratios = df[null_table.numerator].to_numpy() - df[null_table.denominator].to_numpy()
+        df['p_value'] = null_table.p_values(binsize, lengths, ratios)
+    else:
+        df['p_value'] = np.nan
+    if sample_ids is not None:
+        df.index = pd.Index(list(sample_ids), name='sample_id')
+    return df
+
+# function to build the downloadable results table of many sequences for the app's batch tab
+def batch_results_table(binsize, samples, reference_tables, null_table=None):
+    '''
+    inputs: binsize-user-selected binsize, samples-list of (sample name, best reference, mutations) tuples
+    (e.g. from nextcladefunctions.nextclade_records(), with "Error" as the reference and mutations of sequences
+    that couldn't be aligned), reference_tables-ReferenceTables holding the existing distributions,
+    null_table-optional NullTable (defaults to the shipped table)
+
+    output: pandas DataFrame with one row per sample holding the sample name, best reference, number of
+    mutations, transition:transversion ratio, mutator sites, the log likelihood of each distribution (columns
+    named after their display names), the best fit distribution, times_more_likely and the empirical p-value
+    '''
+    import pandas as pd
+    mutation_sets = [tokenize_mutations('' if mutations == "Error" else mutations) for name, reference, mutations in samples]
+    scores = score_batch(binsize, mutation_sets, reference_tables, null_table=null_table)
+    display_names = dict(zip(reference_tables.names, reference_tables.display_names))
+    mutators = [mut_lineage_parsing(parsed) for parsed in mutation_sets]
+    df = pd.DataFrame({
+        'sample': [name for name, reference, mutations in samples],
+        'best_reference': [reference for name, reference, mutations in samples],
+        'mutations_count': scores['mutations_count'].to_numpy(),
+        # as in the single sample view, lineages without transversions count one
+        'transition_transversion_ratio': scores['transitions'].to_numpy() / np.maximum(scores['transversions'].to_numpy(), 1),
+        'mutators': [confirmed for confirmed, potential in mutators],
+        'potential_mutators': [potential for confirmed, potential in mutators],
+    })
+    for name in reference_tables.names:
+        df[display_names[name]] = scores[name].to_numpy()
+    df['best_fit'] = [display_names.get(name, name) for name in scores['best_fit']]
+    df['times_more_likely'] = scores['times_more_likely'].to_numpy()
+    df['p_value'] = scores['p_value'].to_numpy()
+    return df
+
+# pool of worker processes shared by the simulations, kept between calls so that processes only start once
+_process_pool = None
+_process_pool_size = 0
+
+# function to get the shared pool of worker processes
+def get_process_pool(jobs):
+    '''
+    input: jobs-number of worker processes
+
+    output: ProcessPoolExecutor with that many workers (the existing pool is reused if it is the same size)
+    '''
+    from concurrent.futures import ProcessPoolExecutor # running simulations on several cores
+    global _process_pool, _process_pool_size
+    if _process_pool is None or _process_pool_size != jobs:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+        _process_pool = ProcessPoolExecutor(max_workers=jobs)
+        _process_pool_size = jobs
+    return _process_pool
+
+# summary of bootstrap replicates of the log likelihoods
+# names-distribution names, likelihoods-point estimates of the log likelihoods, lower, upper-confidence interval
+# of each log likelihood, win_fraction-fraction of replicates in which each distribution fits best,
+# best_fit, compared_to-names of the best and next best fit distributions (from the point estimates),
+# times_more_likely-point estimate of how many times more likely best_fit is than compared_to,
+# times_more_likely_lower, times_more_likely_upper-confidence interval of times_more_likely,
+# replicates-number of bootstrap replicates, confidence-confidence level of the intervals
+BootstrapResult = namedtuple('BootstrapResult', ['names', 'likelihoods', 'lower', 'upper', 'win_fraction',
+                                                 'best_fit', 'compared_to', 'times_more_likely',
+                                                 'times_more_likely_lower', 'times_more_likely_upper',
+                                                 'replicates', 'confidence'])
+
+# function to calculate the log likelihoods of one chunk of bootstrap replicates
+def _bootstrap_chunk(table, positions, replicates, seed):
+    '''
+    inputs: table-ReferenceTable for the selected bin size, positions-array of the user's mutated positions,
+    replicates-number of replicates in this chunk, seed-np.random.SeedSequence for this chunk
+
+    output: array of log likelihoods with one row per replicate and one column per distribution
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(positions)
+    # resample the user's mutations with replacement
+    resampled = positions[rng.integers(0, n, size=(replicates, n))].ravel()
+    rows = np.repeat(np.arange(replicates), n)
+    n_bins = table.counts.shape[1]
+    mut_counts = np.stack([count_matrix(rows, resampled, lookup, replicates, n_bins) for lookup in table.lookups],
+                          axis=1)
+    user_counts = mut_counts[:, table.groups]
+    # resample the counts of each existing distribution from a multinomial distribution
+    totals = table.counts.sum(axis=1)
+    dist_counts = np.stack([rng.multinomial(total, counts / total, size=replicates)
+                            for total, counts in zip(totals, table.counts)], axis=1)
+    # add one to each bin so that there are no bins lacking data
+    log_probs = np.log((dist_counts + 1) / np.sum(dist_counts + 1, axis=2, keepdims=True))
+    return np.sum(user_counts * log_probs, axis=2)
+
+# function to bootstrap confidence intervals of the log likelihoods and of the number of times more likely
+def bootstrap_likelihoods(binsize, mutated_nucleotide_list, reference_tables, replicates=10000, confidence=0.95,
+                          seed=None, jobs=1, chunk_size=2500):
+    '''
+    inputs: binsize-user-selected binsize, mutated_nucleotide_list-user's mutations (string or ParsedMutations),
+    reference_tables-ReferenceTables holding the existing distributions, replicates-number of bootstrap replicates,
+    confidence-confidence level of the intervals, seed-optional seed for reproducible results,
+    jobs-number of processes to spread the replicates over, chunk_size-number of replicates calculated together
+
+    output: BootstrapResult
+
+    Each replicate resamples the user's mutations with replacement and redraws the bin counts of every existing
+    distribution from a multinomial distribution with the observed proportions. Replicates are calculated in
+    vectorized chunks, and the chunks are given their own random streams so that the result for a given seed
+    doesn't depend on the number of jobs.
+    '''
+    table = reference_tables.table(binsize)
+    positions = tokenize_mutations(mutated_nucleotide_list).positions
+    if len(positions) == 0:
+        raise ValueError('Please enter a list of nucleotide positions in order to bootstrap likelihoods.')
+    likelihoods = get_likelihoods(table, positions)
+    # split the replicates into chunks, each with its own random stream
+    chunks = [chunk_size] * (replicates // chunk_size)
+    if replicates % chunk_size:
+        chunks.append(replicates % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = ([table] * len(chunks), [positions] * len(chunks), chunks, seeds)
+    if jobs > 1 and len(chunks) > 1:
+        results = list(get_process_pool(jobs).map(_bootstrap_chunk, *args))
+    else:
+        results = list(map(_bootstrap_chunk, *args))
+    samples = np.concatenate(results)
+    # best and next best fits from the point estimates
+    order = np.argsort(likelihoods, kind='stable')
+    best, second = order[-1], order[-2]
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(samples, [alpha, 1 - alpha], axis=0)
+    wins = np.bincount(np.argmax(samples, axis=1), minlength=len(table.names)) / len(samples)
+    differences = samples[:, best] - samples[:, second]
+    difference_lower, difference_upper = np.quantile(differences, [alpha, 1 - alpha])
+    return BootstrapResult(table.names, likelihoods, lower, upper, wins, table.names[best], table.names[second],
+                           math.exp(likelihoods[best] - likelihoods[second]), math.exp(difference_lower),
+                           math.exp(difference_upper), len(samples), confidence)
+
+# function to draw synthetic lineages from an existing distribution
+def draw_lineages(cumulative_probabilities, k, replicates, rng):
+    '''
+    inputs: cumulative_probabilities-cumulative sum of the proportion of mutations at each position of a
+    distribution (from its site_counts()), k-number of mutations per lineage, replicates-number of lineages,
+    rng-np.random.Generator
+
+    output: array of mutated positions with one row per lineage and k columns
+    '''
+    # inverse transform sampling: each uniform draw picks the position where the cumulative proportion passes it
+    draws = rng.random((replicates, k)) * cumulative_probabilities[-1]
+    return np.searchsorted(cumulative_probabilities, draws, side='right')
+
+# function to score synthetic lineages of one size drawn from every existing distribution
+def _simulate_chunk(tables, cumulative_probabilities, k, replicates, seed):
+    '''
+    inputs: tables-list of ReferenceTable (one per bin size), cumulative_probabilities-list of cumulative
+    proportions of each distribution (see draw_lineages()), k-number of mutations per lineage,
+    replicates-number of lineages to draw from each distribution, seed-np.random.SeedSequence for this chunk
+
+    output: array of counts with one confusion matrix (true distribution x best fit distribution) per table
+    '''
+    rng = np.random.default_rng(seed)
+    n_dists = len(cumulative_probabilities)
+    confusion = np.zeros((len(tables), n_dists, n_dists), dtype=int)
+    rows = np.repeat(np.arange(replicates), k)
+    for true_index, cumulative in enumerate(cumulative_probabilities):
+        # the same lineages are scored with every bin size
+        positions = draw_lineages(cumulative, k, replicates, rng).ravel()
+        for table_index, table in enumerate(tables):
+            likelihoods = score_matrix(table, rows, positions, replicates)
+            predicted = np.argmax(likelihoods, axis=1)
+            confusion[table_index, true_index] += np.bincount(predicted, minlength=n_dists)
+    return confusion
+
+# function to estimate how often lineages drawn from each distribution are classified correctly
+def simulate_classification(reference_tables, binsizes, lineage_sizes, replicates=10000, seed=None, jobs=1,
+                            chunk_size=10000):
+    '''
+    inputs: reference_tables-ReferenceTables holding the existing distributions, binsizes-list of bin sizes,
+    lineage_sizes-list of the numbers of mutations per lineage (k) to simulate, replicates-number of lineages
+    drawn from each distribution for each k, seed-optional seed for reproducible results,
+    jobs-number of processes to spread the simulations over, chunk_size-number of lineages drawn together
+
+    outputs: accuracy-pandas DataFrame with one row per bin size and k giving the overall accuracy and the
+    fraction of lineages from each distribution that were assigned to it,
+    confusion-dictionary of confusion matrices keyed by (bin size, k). Rows are the distribution the lineages
+    were drawn from and columns the distribution they fit best, in the order of reference_tables.names
+
+    Lineages are drawn position by position from each distribution (with its masks applied) and scored with
+    get_likelihood() against every distribution as a single matrix product per chunk.
+    '''
+    import pandas as pd
+    tables = [reference_tables.table(binsize) for binsize in binsizes]
+    cumulative_probabilities = [np.cumsum(reference_tables.site_counts(name)) for name in reference_tables.names]
+    # split each lineage size into chunks, each with its own random stream
+    tasks = []
+    for k in lineage_sizes:
+        chunks = [chunk_size] * (replicates // chunk_size)
+        if replicates % chunk_size:
+            chunks.append(replicates % chunk_size)
+        tasks.extend((k, chunk) for chunk in chunks)
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    args = ([tables] * len(tasks), [cumulative_probabilities] * len(tasks),
+            [k for k, chunk in tasks], [chunk for k, chunk in tasks], seeds)
+    if jobs > 1 and len(tasks) > 1:
+        results = get_process_pool(jobs).map(_simulate_chunk, *args)
+    else:
+        results = map(_simulate_chunk, *args)
+    n_dists = len(reference_tables.names)
+    confusion = {(binsize, k): np.zeros((n_dists, n_dists), dtype=int) for binsize in binsizes for k in lineage_sizes}
+    for (k, chunk), result in zip(tasks, results):
+        for binsize, matrix in zip(binsizes, result):
+            confusion[(binsize, k)] += matrix
+    rows = []
+    for (binsize, k), matrix in confusion.items():
+        row = {'binsize': binsize, 'k': k, 'accuracy': np.trace(matrix) / matrix.sum()}
+        for name, correct, total in zip(reference_tables.names, np.diag(matrix), matrix.sum(axis=1)):
+            row[name] = correct / total
+        rows.append(row)
+    return pd.DataFrame(rows), confusion
+
+# function to simulate the log likelihood ratio of lineages of one size drawn from the null distribution
+def _null_chunk(tables, cumulative_probabilities, k, replicates, seed, numerator_index, denominator_index):
+    '''
+    inputs: tables-list of ReferenceTable (one per bin size), cumulative_probabilities-cumulative proportions
+    of the null distribution (see draw_lineages()), k-number of mutations per lineage, replicates-number of
+    lineages, seed-np.random.SeedSequence for this chunk, numerator_index, denominator_index-rows of the
+    distributions being compared
+
+    output: array of log likelihood ratios with one row per table and one column per lineage
+    '''
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(replicates), k)
+    positions = draw_lineages(cumulative_probabilities, k, replicates, rng).ravel()
+    ratios = np.zeros((len(tables), replicates))
+    for table_index, table in enumerate(tables):
+        likelihoods = score_matrix(table, rows, positions, replicates)
+        ratios[table_index] = likelihoods[:, numerator_index] - likelihoods[:, denominator_index]
+    return ratios
+
+# quantile levels kept in a null table, spaced more finely towards the upper tail where the p-values are small
+null_levels = np.concatenate([np.linspace(0, 0.99, 100), 1 - np.logspace(-2, -5, 31)[1:], [1]])
+
+# class to hold the quantiles of the null distribution of a log likelihood ratio for each bin size and lineage size
+class NullTable:
+    '''
+    Quantiles of numerator log likelihood - denominator log likelihood for lineages drawn from the
+    denominator distribution, so that p-values can be looked up instead of simulated for each query.
+    '''
+    def __init__(self, binsizes, lineage_sizes, quantiles, replicates, numerator='chronic',
+                 denominator='global_pre-VoC', levels=null_levels):
+        '''
+        inputs: binsizes-list of bin sizes, lineage_sizes-sorted list of the numbers of mutations per lineage,
+        quantiles-array of quantiles with shape (bin sizes, lineage sizes, levels), replicates-number of
+        lineages simulated for each bin size and lineage size, numerator, denominator-names of the
+        distributions compared, levels-quantile levels of the last axis of quantiles
+        '''
+        self.binsizes = [str(i) for i in binsizes]
+        self.lineage_sizes = np.asarray(lineage_sizes, dtype=int)
+        self.quantiles = np.asarray(quantiles)
+        self.replicates = int(replicates)
+        self.numerator = str(numerator)
+        self.denominator = str(denominator)
+        self.levels = np.asarray(levels)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        input: filename-.npz file written by save()
+
+        output: NullTable
+        '''
+        with np.load(filename) as data:
+            return cls(data['binsizes'].tolist(), data['lineage_sizes'], data['quantiles'], data['replicates'],
+                       data['numerator'].item(), data['denominator'].item(), data['levels'])
+
+    def save(self, filename):
+        '''
+        input: filename-.npz file to write the table to
+        '''
+        np.savez_compressed(filename, binsizes=np.array(self.binsizes), lineage_sizes=self.lineage_sizes,
+                            quantiles=self.quantiles.astype(np.float32), replicates=self.replicates,
+                            numerator=self.numerator, denominator=self.denominator, levels=self.levels)
+
+    @property
+    def size_range(self):
+        '''
+        output: (smallest, largest) number of mutations per lineage that p-values are looked up for
+        '''
+        return int(self.lineage_sizes.min()), int(self.lineage_sizes.max())
+
+    def p_values(self, binsize, k, ratios):
+        '''
+        inputs: binsize-bin size used to calculate the likelihoods, k-number (or array of numbers) of mutations
+        in each lineage, ratios-log likelihood ratio (or array of ratios) of each lineage
+
+        output: array of the empirical probability of a ratio at least this large under the null distribution.
+        Lineages are compared with the closest simulated lineage size, p-values can't be smaller than
+        1 / (replicates + 1) and are nan for bin sizes missing from the table and for lineages with fewer or
+        more mutations than the simulated sizes (see size_range), whose ratios aren't calibrated by the table
+        '''
+        k, ratios = np.broadcast_arrays(np.asarray(k, dtype=int), np.asarray(ratios, dtype=float))
+        p = np.full(k.shape, np.nan)
+        if str(binsize) not in self.binsizes:
+            return p
+        quantiles = self.quantiles[self.binsizes.index(str(binsize))]
+        # index of the closest simulated lineage size
+        nearest = np.abs(k[..., None] - self.lineage_sizes).argmin(axis=-1)
+        smallest, largest = self.size_range
+        covered = (k >= max(smallest, 1)) & (k <= largest)
+        for index in np.unique(nearest[covered]):
+            rows = (nearest == index) & covered
+            # number of quantiles below each ratio (with a little tolerance for rounding)
+            below = np.searchsorted(quantiles[index], ratios[rows] - 1e-6, side='left')
+            p[rows] = np.where(below > 0, 1 - self.levels[np.maximum(below - 1, 0)], 1)
+        return np.maximum(p, 1 / (self.replicates + 1))
+
+# function to simulate the null distribution of a log likelihood ratio for each bin size and lineage size
+def build_null_table(reference_tables, binsizes, lineage_sizes, replicates=100000, seed=None, jobs=1,
+                     chunk_size=10000, numerator='chronic', denominator='global_pre-VoC'):
+    '''
+    inputs: reference_tables-ReferenceTables holding the existing distributions, binsizes-list of bin sizes,
+    lineage_sizes-list of the numbers of mutations per lineage (k) to simulate, replicates-number of lineages
+    simulated for each bin size and k, seed-optional seed for reproducible results, jobs-number of processes
+    to spread the simulations over, chunk_size-number of lineages drawn together,
+    numerator, denominator-names of the distributions compared. Lineages are drawn from the denominator
+
+    output: NullTable
+    '''
+    lineage_sizes = sorted(lineage_sizes)
+    tables = [reference_tables.table(binsize) for binsize in binsizes]
+    cumulative = np.cumsum(reference_tables.site_counts(denominator))
+    tasks = []
+    for k in lineage_sizes:
+        chunks = [chunk_size] * (replicates // chunk_size)
+        if replicates % chunk_size:
+            chunks.append(replicates % chunk_size)
+        tasks.extend((k, chunk) for chunk in chunks)
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    n = len(tasks)
+    args = ([tables] * n, [cumulative] * n, [k for k, chunk in tasks], [chunk for k, chunk in tasks], seeds,
+            [reference_tables.names.index(numerator)] * n, [reference_tables.names.index(denominator)] * n)
+    if jobs > 1 and n > 1:
+        results = get_process_pool(jobs).map(_null_chunk, *args)
+    else:
+        results = map(_null_chunk, *args)
+    ratios = {k: [] for k in lineage_sizes}
+    for (k, chunk), result in zip(tasks, results):
+        ratios[k].append(result)
+    quantiles = np.zeros((len(binsizes), len(lineage_sizes), len(null_levels)))
+    for index, k in enumerate(lineage_sizes):
+        quantiles[:, index] = np.quantile(np.concatenate(ratios[k], axis=1), null_levels, axis=1).T
+    return NullTable(binsizes, lineage_sizes, quantiles, replicates, numerator, denominator)
+
+# null table shipped with the package (built by build_null_tables.py), loaded the first time it is needed
+null_table_file = Path(__file__).parent / "./data/null_tables.npz"
+_null_table = None
+
+# function to get the shipped null table
+def get_null_table():
+    '''
+    output: NullTable loaded from null_table_file, or None if the file doesn't exist
+    '''
+    global _null_table
+    if _null_table is None and null_table_file.is_file():
+        _null_table = NullTable.load(null_table_file)
+    return _null_table
+
+# function to look up how surprising the likelihoods from most_likely() are under the shipped null table
+def empirical_p_value(binsize, zipped_likelihood_list, k, null_table=None):
+    '''
+    inputs: binsize-user-selected bin size, zipped_likelihood_list-list of (likelihood, name) tuples from most_likely(),
+    k-number of the user's mutations, null_table-optional NullTable (defaults to the shipped table)
+
+    output: empirical p-value of the log likelihood ratio of the null table's distributions (chronic vs.
+    global pre-VoC), or None if there is no null table or no p-value for this bin size
+    '''
+    if null_table is None:
+        null_table = get_null_table()
+    if null_table is None:
+        return None
+    likelihoods = {name: likelihood for likelihood, name in zipped_likelihood_list}
+    try:
+        ratio = likelihoods[null_table.numerator] - likelihoods[null_table.denominator]
+    except (KeyError, TypeError):
+        return None
+    p = null_table.p_values(binsize, k, ratio).item()
+    return None if math.isnan(p) else p
+
 # function to figure out how many times more likely the best fit distribution is than the default (global)
 def times_more_likely(zipped_likelihood_list):
     '''
@@ -213,7 +1229,7 @@ def times_more_likely(zipped_likelihood_list):
     # return the number of times that the user's mutation distribution is better explained by the best
     # fit distribution than the global distribution
     else:
-        return math.exp(unzipped_nums_float[3] - unzipped_nums_float[2]), unzipped_names[2]
+        return math.exp(unzipped_nums_float[-1] - unzipped_nums_float[-2]), unzipped_names[-2]
 
 # function to select colour palettes for the plot
 def select_palette(palette_name):
@@ -232,108 +1248,205 @@ def select_palette(palette_name):
         colour_list = ['#0173B2', '#de8f05', '#029e73', '#d55e00', '#cc78bc']
     return colour_list
 
+# regular expression that each mutation must match (after converting to uppercase and U to T):
+# optionally "INS", "DEL" or "INDEL", optionally followed by "A", "C", "T" or "G",
+# followed by a position of up to 5 digits, optionally followed by "A", "C", "T" or "G",
+# optionally followed by "INS", "DEL" or "INDEL"
+mutation_pattern = re.compile(r"(?P<prefix>INS|DEL|INDEL)?(?P<ref>[ACTG])?(?P<position>\d{1,5})(?P<alt>[ACTG])?(?P<suffix>INS|DEL|INDEL)?")
+
+# fields of a parsed mutation: position, reference and alternative nucleotides ('' if not given) and
+# kind of mutation ('sub', 'ins', 'del' or 'indel')
+mutation_dtype = np.dtype([('position', np.int32), ('ref', 'U1'), ('alt', 'U1'), ('kind', 'U5')])
+
+# error raised for an entry in the user's list that isn't a recognised mutation
+class MutationParseError(ValueError):
+    def __init__(self, token, index):
+        '''
+        inputs: token-the offending entry as the user typed it, index-its position in the user's list (from 0)
+        '''
+        self.token = token
+        self.index = index
+        super().__init__(f'Mutation {index + 1} ("{token}") is not a recognised mutation. Mutations should look like C897A, 897, ins21608 or del23009.')
+
+# class to hold the user's list of mutations after it has been parsed
+class ParsedMutations:
+    '''
+    Result of tokenize_mutations(). Every function that accepts the user's string of mutations also accepts
+    this object, so the string only needs to be parsed once.
+    '''
+    def __init__(self, tokens, records, errors):
+        '''
+        inputs: tokens-list of unique entries with whitespace removed (as returned by parse_user_input()),
+        records-structured array (mutation_dtype) with one record per valid entry,
+        errors-list of MutationParseError, one per invalid entry
+        '''
+        self.tokens = tokens
+        self.records = records
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @property
+    def valid(self):
+        '''
+        output: True if every entry is a recognised mutation
+        '''
+        return len(self.errors) == 0
+
+    @property
+    def positions(self):
+        '''
+        output: array of the positions of the valid mutations that fall within the genome (1-30000)
+        '''
+        positions = self.records['position'].astype(int)
+        return positions[(positions > 0) & (positions < 30001)]
+
+    def check(self):
+        '''
+        raises the MutationParseError for the first invalid entry, if there is one
+        '''
+        if not self.valid:
+            raise self.errors[0]
+
+# function to parse the user's string of mutations in a single pass
+def tokenize_mutations(input):
+    '''
+    input:
+    input - string of comma-separated nucleotide positions where mutations occur (optionally
+    flanked by nucleotides and or "ins", "del" or "indel"). A ParsedMutations object is returned unchanged
+    output:
+    ParsedMutations holding the unique entries, a record for each valid entry and an error for each invalid entry
+    '''
+    if isinstance(input, ParsedMutations):
+        return input
+    tokens = []
+    records = []
+    errors = []
+    seen = set()
+    # first strip trailing commas and whitespace from end of string input
+    # then split by commas
+    for token in input.rstrip(',').rstrip().split(','):
+        # remove any additional tabs, newlines, returns or whitespace
+        token = token.strip(' \t\n\r')
+        # remove any list entries that are empty or duplicated
+        if token == '' or token in seen:
+            continue
+        seen.add(token)
+        tokens.append(token)
+        # replace uracil with thymidine and convert all alphabetic characters to uppercase
+        match = mutation_pattern.fullmatch(token.upper().replace('U', 'T'))
+        if match is None:
+            errors.append(MutationParseError(token, len(tokens) - 1))
+            continue
+        kind = (match['prefix'] or match['suffix'] or 'sub').lower()
+        records.append((int(match['position']), match['ref'] or '', match['alt'] or '', kind))
+    return ParsedMutations(tokens, np.array(records, dtype=mutation_dtype), errors)
+
 # function to parse user's input into a list and make sure each entry is unique
 def parse_user_input(input):
     '''
     input:
     input - string of comma-separated nucleotide positions where mutations occur (optionally
-    flanked by nucleotides and or "ins", "del" or "indel")
+    flanked by nucleotides and or "ins", "del" or "indel"), or ParsedMutations
     output - list of unique nucleotide positions where mutations occur with trailing commas and
     whitespace removed
     '''
     if input is None:
         return None
-    # first strip trailing commas and whitespace from end of string input
-    # then split by commas
-    input_split = input.rstrip(',').rstrip().split(',')
-    # remove any additional tabs, newlines, returns or whitespace from list
-    input_cleaned = [i.strip(' \t\n\r') for i in input_split]
-    # remove any list entries that are empty
-    input_nonempty = [i for i in input_cleaned if i != '']
-    # remove any duplicate entries
-    return list(set(input_nonempty))
+    return tokenize_mutations(input).tokens
 
 # function to check if user input matches specified format
 def check_for_standard_nucleotides(nuc_list):
     '''
     input:
     nuc_list - list of unique nucleotide positions where mutations occur optionally flanked by 
-    uppercase nucleotides and /or "ins", "del" or "indel" with trailing commas and whitespace removed
+    uppercase nucleotides and /or "ins", "del" or "indel" with trailing commas and whitespace removed,
+    or ParsedMutations
     output:
-        if each element in the list matches the regular expression, True else False
-        regex matches the following:
-            optionally "ins", "del" or "indel" optionally followed by "A", "C", "T" or "G", 
-            followed by a digit between 1 and 30000, optionally followed by "A", "C", "T" or "G", 
-            optionally followed by "ins", "del" or "indel" (but ONLY if "ins", "del" or "indel" 
-            is NOT at the start of the capture group)
-    '''
-    # instantiate the regular expression
-    pattern = re.compile(r"^(?:INS|DEL|INDEL)?[ACTG]?\d{1,5}[ACTG]?(?:(?<!^)INS|DEL|INDEL)?$")
+        if each element in the list matches mutation_pattern, True else False
+    '''
+    if isinstance(nuc_list, ParsedMutations):
+        return nuc_list.valid
     # for each item in the user's input list, check to see if it matches the regular expression
     for i in nuc_list:
-        if re.match(pattern, i):
-            pass
-        else:
+        if mutation_pattern.fullmatch(i) is None:
             # if any items don't match, return False
             return False
     # if all items match, return True
     return True
 
+# nucleotides in the order used by the substitution tables
+nucleotides = 'ACGT'
+
+# table classifying each (reference, alternative) pair of nucleotides, indexed in the order above:
+# 1 for transitions, 2 for transversions, 0 where the nucleotide is unchanged
+substitution_types = np.array([[0, 2, 1, 2],
+                               [2, 0, 2, 1],
+                               [1, 2, 0, 2],
+                               [2, 1, 2, 0]])
+
+# names of the 12 substitution classes in the order they are returned by substitution_spectrum()
+substitution_classes = [f'{ref}>{alt}' for ref in nucleotides for alt in nucleotides if ref != alt]
+
+# function to count the 12 classes of substitution in one or many lists of mutations
+def substitution_spectrum(mutation_sets):
+    '''
+    input:
+    mutation_sets - string of comma-separated mutations or ParsedMutations for a single lineage,
+    or a list of them for a batch of lineages
+    output:
+    spectrum - counts of each substitution class (ordered as substitution_classes), with one row per
+    lineage if a list was given
+    transitions - count(s) of transitions
+    transversions - count(s) of transversions
+    Only substitutions with both nucleotides given are counted (not insertions, deletions or indels)
+    '''
+    single = isinstance(mutation_sets, (str, ParsedMutations))
+    if single:
+        mutation_sets = [mutation_sets]
+    records = [tokenize_mutations(i).records for i in mutation_sets]
+    n = len(records)
+    rows = np.repeat(np.arange(n), [len(i) for i in records])
+    records = np.concatenate(records) if n > 0 else np.array([], dtype=mutation_dtype)
+    # convert nucleotides to their index in the tables (-1 if not given)
+    ref = np.full(len(records), -1)
+    alt = np.full(len(records), -1)
+    for code, nucleotide in enumerate(nucleotides):
+        ref[records['ref'] == nucleotide] = code
+        alt[records['alt'] == nucleotide] = code
+    keep = (records['kind'] == 'sub') & (ref >= 0) & (alt >= 0)
+    # count every (reference, alternative) pair for every lineage at once
+    flat = rows[keep] * 16 + ref[keep] * 4 + alt[keep]
+    pairs = np.bincount(flat, minlength=n * 16).reshape(n, 4, 4)
+    spectrum = pairs[:, substitution_types != 0]
+    transitions = np.sum(pairs * (substitution_types == 1), axis=(1, 2))
+    transversions = np.sum(pairs * (substitution_types == 2), axis=(1, 2))
+    if single:
+        return spectrum[0], int(transitions[0]), int(transversions[0])
+    return spectrum, transitions, transversions
+
 # function to count the number of transitions and transversions in a list of mutations with
 # associated nucleotides
 def transition_or_transversion(nuc_pos_list):
     '''
     input:
     nuc_pos_list - string of comma-separated nucleotide positions where mutations occur (optionally
-    flanked by nucleotides and or "ins", "del" or "indel")
+    flanked by nucleotides and or "ins", "del" or "indel"), or ParsedMutations
     output: 
     transitions - count of transitions in user's list of mutations
     transversions - count of transversions in user's list of mutations
     '''
-    # first generate list of unique nucleotide positions where mutations occur with trailing commas and
-    # whitespace removed
     if nuc_pos_list is None:
         return False, False
-    nuc_pos_list_blank_removed = parse_user_input(nuc_pos_list)
-    # replace uracil with thymidine
-    nuc_list_standard = [s.replace('u', 'T').replace('U', 'T') for s in nuc_pos_list_blank_removed]
-    # convert all alphabetic characters to uppercase
-    nuc_list_upper = [i.upper() for i in nuc_list_standard]
+    parsed = tokenize_mutations(nuc_pos_list)
     # make sure user's input matches expected pattern
     # if not, instead of returning counts of transitions and transversions, return
     # False, False
-    if check_for_standard_nucleotides(nuc_list_upper) == False:
+    if not parsed.valid:
         return False, False
-    # remove digits from list of mutations so that we can count transitions and transversions
-    nuc_pos_list_no_digits = [re.sub('\d+', '', i) for i in nuc_list_upper]
-    # instantiate transition and transversion counts
-    transitions = 0
-    transversions = 0
-    # remove 'INS', 'DEL' and 'INDEL' from list, only keep list items with 2 nucleotides
-    nuc_list_parsed = [i for i in nuc_pos_list_no_digits if (len(i) == 2)]
-    # iterate through each item in list of mutated nucleotides
-    # classify each as a transition or transversion
-    for i in nuc_list_parsed:
-        if i[0] == 'A':
-            if i[1] == 'G':
-                transitions += 1
-            elif i[1] in ['C', 'T']:
-                transversions += 1
-        elif i[0] == 'C':
-            if i[1] == 'T':
-                transitions += 1
-            elif i[1] in ['A', 'G']:
-                transversions += 1
-        elif i[0] == 'G':
-            if i[1] == 'A':
-                transitions += 1
-            elif i[1] in ['C', 'T']:
-                transversions += 1
-        elif i[0] == 'T':
-            if i[1] == 'C':
-                transitions += 1
-            elif i[1] in ['A', 'G']:
-                transversions += 1
+    # classify each substitution as a transition or transversion
+    spectrum, transitions, transversions = substitution_spectrum(parsed)
     # if there are no transversions, add one to the count to avoid a division by 0 error
     if transversions == 0:
         transversions += 1
@@ -346,20 +1459,15 @@ def mut_lineage_parsing(nuc_pos_list):
     '''
     input:
     nuc_pos_list - string of comma-separated nucleotide positions where mutations occur (optionally
-    flanked by nucleotides and or "ins", "del" or "indel")
+    flanked by nucleotides and or "ins", "del" or "indel"), or ParsedMutations
     output:
     mutator_text - list of user-entered mutations conferring mutator phenotype in string format
     potential_mutator_text - list of user-entered mutations potentially conferring mutator phenotype
     in string format
     '''
     try:
-        # parse user input to list of unique nucleotide positions where mutations occur with trailing commas and
-        # whitespace removed
-        nuc_pos_list_parsed = parse_user_input(nuc_pos_list)
-        # remove any non-digit characters from list of nucleotide positions
-        int_nuc_list = [re.sub('\D', '', i) for i in nuc_pos_list_parsed]
-        # convert each list entry to an integer
-        mut_nuc_list = [int(i) for i in int_nuc_list]
+        # parse user input to the positions of the user's mutations
+        mut_nuc_list = tokenize_mutations(nuc_pos_list).records['position'].tolist()
         # instantiate lists of mutator and potential mutator mutations
         mutator_list = [18155, 18218, 18647]
         potential_mutator_list = [18307, 18308, 18309, 18313, 18314, 18315, 18610, 18611, 18612, 18841, 18842, 18843, 18856, 18857, 18858]
@@ -379,6 +1487,36 @@ def mut_lineage_parsing(nuc_pos_list):
         potential_mutator_text = ''
     return mutator_text, potential_mutator_text
     
+# everything the app shows about one list of mutations, see analyze_mutations()
+Analysis = namedtuple('Analysis', ['mutations', 'binsize', 'valid', 'transitions', 'transversions', 'mutators',
+                                   'potential_mutators', 'counts', 'bins', 'total_counts', 'likelihoods', 'most_likely',
+                                   'times_more_likely', 'compared_to', 'p_value'])
+
+# function to run every calculation on the user's list of mutations once
+def analyze_mutations(binsize, mutated_nucleotide_list, reference_tables, null_table=None):
+    '''
+    inputs: binsize-user-selected bin size, mutated_nucleotide_list-string of comma-separated mutations or
+    ParsedMutations, reference_tables-ReferenceTables holding the existing distributions, null_table-optional
+    NullTable (defaults to the shipped table)
+
+    output: Analysis holding the parsed mutations, transition and transversion counts, mutator sites, the
+    user's bin counts, the likelihoods from rank_distributions(), the fold change from times_more_likely()
+    and the empirical p-value; only the parsed mutations and mutator sites are filled in if the input is invalid
+    '''
+    parsed = tokenize_mutations(mutated_nucleotide_list)
+    transitions, transversions = transition_or_transversion(parsed)
+    mutators, potential_mutators = mut_lineage_parsing(parsed)
+    if transversions == False:
+        return Analysis(parsed, binsize, False, transitions, transversions, mutators, potential_mutators,
+                        None, None, None, None, None, None, None, None)
+    # the user's mutations per bin, for plotting next to the existing distributions
+    counts, bins = make_bins(parsed.positions, binsize)
+    likelihoods, best_fit = rank_distributions(binsize, parsed, reference_tables)
+    fold_change, compared_to = times_more_likely(likelihoods)
+    p_value = empirical_p_value(binsize, likelihoods, len(parsed.positions), null_table)
+    return Analysis(parsed, binsize, True, transitions, transversions, mutators, potential_mutators,
+                    counts, bins, max(sum(counts), 1), likelihoods, best_fit, fold_change, compared_to, p_value)
+
 # function to parse numeric data into scientific notation
 def sci_notation(number, sig_fig=2):
     '''
@@ -6,79 +6,632 @@ import numpy as np # numbers are important!
 import re # regex
 import math # math is important!
 from pathlib import Path
-from subprocess import call
+from concurrent.futures import ThreadPoolExecutor, Future # running the reference datasets at the same time
+from collections import deque
+from functools import lru_cache
 import os
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import hashlib
+import json
+import csv
+try:
+    import fcntl # locks shared by every process on the host
+except ImportError:
+    fcntl = None
 
-def generate_alignment_script(input_path):
-    path_string = str(input_path)
-    path_root = path_string.split('.')[0]
-    file_to_copy = Path(__file__).parent / "./nextclade"
-    path = Path(__file__).parent / "./data/results/"
-    shutil.copy2(file_to_copy, path)
-    os.environ['PATH'] += os.pathsep + str(path)
-    ref_seqs = ['wuhan', 'BA2', 'BA286', 'XBB']
-    script_path = Path(__file__).parent / "./data/results/nextcladerun.sh"
-    # results = Path(__file__).parent / "./data/results/"
-    test_file = Path(__file__).parent / "./data/reference_seqs/"
-    user_file = Path(__file__).parent / input_path
-    script_path.touch()
-    with script_path.open('w') as file:
-        for i in ref_seqs:
-            file.write(f'nextclade run {user_file} --output-tsv {path_root}{i}results.tsv --input-dataset {test_file}/{i}/\n')
-
-def generate_alignments():
-    subprocess.run(['chmod', '0777', "./data/results/nextclade"])        
-    path = Path(__file__).parent / "./data/results/nextcladerun.sh"
-    with open(path, 'rb') as file:
-        script = file.read()
-    call(script, shell=True)
-
-def get_best_reference(input_path):
-    generate_alignments()
-    path_string = str(input_path)
-    path_root = path_string.split('.')[0]
-    ref_seqs = ['wuhan', 'BA2', 'BA286', 'XBB']
-    score_list = []
+ref_seqs = ['wuhan', 'BA2', 'BA286', 'XBB']
+# number of reference datasets aligned at the same time, and the longest a single run may take (seconds)
+nextclade_jobs = int(os.environ.get('NEXTCLADE_JOBS', len(ref_seqs)))
+nextclade_timeout = float(os.environ.get('NEXTCLADE_TIMEOUT', 300))
+private_mutation_columns = ['privateNucMutations.reversionSubstitutions', 'privateNucMutations.labeledSubstitutions', 'privateNucMutations.unlabeledSubstitutions']
+result_columns = ['index', 'seqName', 'alignmentScore'] + private_mutation_columns
+# k-mer length of the reference pre-screen, and how many more k-mers the closest reference must share with
+# a sequence than the runner-up before the other datasets are skipped
+screen_k = 21
+screen_margin = int(os.environ.get('NEXTCLADE_SCREEN_MARGIN', 2 * screen_k))
+# at most host_slots Nextclade processes run at once on the host, across every process that shares slot_dir
+# (0 turns the limit off)
+host_slots = int(os.environ.get('NEXTCLADE_HOST_SLOTS', nextclade_jobs))
+slot_dir = Path(os.environ.get('NEXTCLADE_SLOT_DIR', Path(tempfile.gettempdir()) / "smdp-nextclade-slots"))
+# results of earlier runs are kept here, up to cache_size sequences (0 turns the cache off)
+cache_dir = Path(os.environ.get('NEXTCLADE_CACHE_DIR', Path(__file__).parent / "data/nextclade_cache"))
+cache_size = int(os.environ.get('NEXTCLADE_CACHE_SIZE', 10000))
+
+class HostSlots:
+    # host-wide limit on running Nextclade processes: each process holds an exclusive lock on one of the
+    # slot files while it runs, and the system releases the lock even if its holder dies
+    def __init__(self, directory=slot_dir, slots=host_slots):
+        self.directory = Path(directory)
+        self.slots = slots
+
+    def acquire(self, cancelled=None, poll=0.1):
+        # waits for a free slot and returns its open file, or None if the job was cancelled meanwhile or
+        # the limit can't be used here (no file locks, or a folder that can't be written)
+        if fcntl is None or self.slots <= 0:
+            return None
+        try:
+            if not self.directory.is_dir():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                # shared with app workers running as other users
+                os.chmod(self.directory, 0o1777)
+        except OSError:
+            return None
+        while cancelled is None or not cancelled.is_set():
+            opened = False
+            for i in range(self.slots):
+                try:
+                    fd = os.open(self.directory / f'slot-{i}', os.O_RDWR | os.O_CREAT, 0o666)
+                except OSError:
+                    continue
+                opened = True
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except OSError:
+                    os.close(fd)
+            if not opened:
+                return None
+            time.sleep(poll)
+        return None
+
+    def release(self, fd):
+        if fd is not None:
+            os.close(fd)
+
+host_limit = HostSlots()
+
+class ResultCache:
+    # best reference and private mutations of each sequence already run, one small JSON file per sequence
+    # (named with entry_prefix, nothing else in the folder is touched); the file's modification time is its
+    # last use, and the least recently used are removed once there are more than max_entries
+    entry_prefix = 'nextclade-'
+
+    def __init__(self, directory=cache_dir, max_entries=cache_size):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        # entries counted by the last scan plus the ones written since, so the folder is only scanned
+        # when it is probably full
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def entry_path(self, key):
+        return self.directory / f'{self.entry_prefix}{key}.json'
+
+    def get(self, key):
+        if self.max_entries <= 0:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # marks the entry as recently used; a read-only cache is still used, just without that
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['reference'], entry['mutations']
+
+    def put(self, key, reference, mutations):
+        if self.max_entries <= 0:
+            return
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            new = not self.entry_path(key).exists()
+            # written under a temporary name first so readers never see half an entry
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f'.{self.entry_prefix}', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'reference': reference, 'mutations': mutations}, f)
+            os.replace(temp_path, self.entry_path(key))
+        except OSError:
+            # the cache only saves time, a folder that can't be written just means no caching
+            return
+        with self.lock:
+            if self.entries is not None and new:
+                self.entries += 1
+            if self.entries is None or self.entries > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        # removes the least recently used entries, down to a tenth below max_entries so that the
+        # folder isn't scanned again for a while
+        entries = []
+        for path in self.directory.glob(f'{self.entry_prefix}*.json'):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        self.entries = len(entries)
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        keep = self.max_entries - self.max_entries // 10
+        for mtime, path in entries[:len(entries) - keep]:
+            try:
+                path.unlink()
+                self.entries -= 1
+            except OSError:
+                continue
+
+result_cache = ResultCache()
+
+@lru_cache(maxsize=None)
+def dataset_version():
+    # hash of every file of the reference datasets, so results are rerun when a dataset is updated
+    digest = hashlib.sha256()
     for i in ref_seqs:
-        results = pd.read_csv(f'{path_root}{i}results.tsv', sep= '\t')
-        score = results['alignmentScore'].tolist()
+        dataset = Path(__file__).parent / "data/reference_seqs" / i
+        for path in sorted(dataset.rglob('*')):
+            if path.is_file():
+                digest.update(f'{i}/{path.relative_to(dataset)}'.encode())
+                digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+def normalize_sequence(sequence):
+    # the same sequence gets the same key regardless of line breaks and case
+    return re.sub(r'\s', '', sequence).upper()
+
+def sequence_key(sequence):
+    return hashlib.sha256(f'{dataset_version()}:{normalize_sequence(sequence)}'.encode()).hexdigest()
+
+def read_fasta(input_path):
+    with open(input_path) as f:
+        return parse_fasta(f)
+
+def parse_fasta(lines):
+    # (name, sequence) of each record, names as Nextclade reports them
+    records = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('>'):
+            records.append([line[1:], []])
+        elif records:
+            records[-1][1].append(line)
+    return [(name, ''.join(sequence_lines)) for name, sequence_lines in records]
+
+def fasta_text(records):
+    return ''.join(f'>{name}\n{sequence}\n' for name, sequence in records)
+
+@lru_cache(maxsize=None)
+def find_nextclade():
+    # looked up once per process: nextclade on PATH, otherwise the binary shipped next to this file
+    found = shutil.which('nextclade')
+    if found is not None:
+        return found
+    bundled = Path(__file__).parent / "nextclade"
+    if bundled.is_file():
+        if not os.access(bundled, os.X_OK):
+            os.chmod(bundled, 0o755)
+        return str(bundled)
+    return 'nextclade'
+
+def alignment_command(reference, threads=1):
+    # the sequences are read from stdin and the results table written to stdout
+    test_file = Path(__file__).parent / "./data/reference_seqs/"
+    return [find_nextclade(), 'run', '--input-dataset', f'{test_file}/{reference}/', '--output-tsv', '-', '--jobs', str(threads)]
+
+def alignment_commands(jobs=nextclade_jobs):
+    # share the cores between the runs that happen at the same time
+    threads = max((os.cpu_count() or 1) // jobs, 1)
+    return {i: alignment_command(i, threads) for i in ref_seqs}
+
+def parse_results(lines):
+    # reads the results table as it is written, keeping only the columns that are used
+    reader = csv.reader(lines, delimiter='\t')
+    header = next(reader, None)
+    if header is None:
+        raise ValueError('no results')
+    positions = {column: header.index(column) for column in result_columns if column in header}
+    rows = [[row[j] for j in positions.values()] for row in reader if row]
+    df = pd.DataFrame(rows, columns=list(positions))
+    df['index'] = df['index'].astype(int)
+    df['alignmentScore'] = pd.to_numeric(df['alignmentScore'], errors='coerce')
+    return df.set_index('index').sort_index()
+
+def run_alignment(command, fasta='', timeout=nextclade_timeout, job=None):
+    # returns (results, None) if the run succeeded, otherwise (None, what went wrong)
+    if job is not None and job.cancelled.is_set():
+        return None, 'cancelled'
+    # wait for one of the host's slots, held until the process has finished
+    slot = host_limit.acquire(job.cancelled if job is not None else None)
+    try:
+        if job is not None and job.cancelled.is_set():
+            return None, 'cancelled'
+        return stream_alignment(command, fasta, timeout, job)
+    finally:
+        host_limit.release(slot)
+
+def stream_alignment(command, fasta, timeout, job):
+    if job is not None and job.cancelled.is_set():
+        return None, 'cancelled'
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+        return None, str(e)
+    if job is not None:
+        # the job kills the process if it is cancelled
+        job.attach(process)
+    timed_out = threading.Event()
+    def stop():
+        timed_out.set()
+        process.kill()
+    timer = threading.Timer(timeout, stop)
+    stderr = []
+    def feed():
         try:
-            score_list.append(int(score[0]))
-        except:
-            return "Error"
-    m = max(score_list)
-    best_index = score_list.index(m)
-    return ref_seqs[best_index]
-
-def get_private_mutations(input_path):
-    best_reference = get_best_reference(input_path)
-    path_string = str(input_path)
-    path_root = path_string.split('.')[0]
-    if best_reference == "Error":
-        return "Error"
-    tsv = best_reference + "results.tsv"
-    df = pd.read_csv(f'{path_root}{tsv}', sep = '\t')
-    return ((f'{df["privateNucMutations.reversionSubstitutions"][0]},{df["privateNucMutations.labeledSubstitutions"][0]},{df["privateNucMutations.unlabeledSubstitutions"][0]}').split(','))
-
-def parse_private_mutations(input_path):
-    mutation_list = get_private_mutations(input_path)
-    if mutation_list == "Error":
-        path = Path(__file__).parent / "data/results"
-        os.system('rm -rf %s/*' % path)
-        return "Error"
+            process.stdin.write(fasta)
+            process.stdin.close()
+        except OSError:
+            pass
+    threads = [threading.Thread(target=feed), threading.Thread(target=lambda: stderr.append(process.stderr.read()))]
+    timer.start()
+    for thread in threads:
+        thread.start()
+    try:
+        results = parse_results(process.stdout)
+    except (ValueError, KeyError) as e:
+        results, error = None, str(e)
+    finally:
+        process.stdout.close()
+        for thread in threads:
+            thread.join()
+        process.wait()
+        timer.cancel()
+        if job is not None:
+            job.detach(process)
+    if job is not None and job.cancelled.is_set():
+        return None, 'cancelled'
+    if timed_out.is_set():
+        return None, f'timed out after {timeout:g} seconds'
+    if process.returncode != 0:
+        return None, ''.join(stderr).strip() or f'exit status {process.returncode}'
+    if results is None:
+        return None, error
+    return results, None
+
+def generate_alignments(fasta, jobs=nextclade_jobs, timeout=nextclade_timeout, job=None):
+    # each reference dataset is aligned in its own process, up to jobs at a time
+    return run_commands({i: (command, fasta) for i, command in alignment_commands(jobs).items()}, jobs, timeout, job)
+
+def run_commands(commands, jobs=nextclade_jobs, timeout=nextclade_timeout, job=None):
+    # commands maps each reference to (command, sequences); returns the results and failures of each reference
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        runs = dict(zip(commands, pool.map(lambda command: run_alignment(*command, timeout=timeout, job=job), commands.values())))
+    results = {i: result for i, (result, error) in runs.items() if error is None}
+    failures = {i: error for i, (result, error) in runs.items() if error is not None}
+    for reference, error in failures.items():
+        print(f'Nextclade run against the {reference} dataset failed: {error}', file=sys.stderr)
+    return results, failures
+
+def get_best_references(results):
+    scores = pd.DataFrame({i: pd.to_numeric(df['alignmentScore'], errors='coerce') for i, df in results.items()})
+    best = scores.fillna(-np.inf).idxmax(axis=1)
+    # records that didn't align to any dataset
+    best[scores.isna().all(axis=1)] = "Error"
+    return best
+
+def clean_private_mutations(mutation_list):
     pattern = r'(\|.*)|(^-.*)'
     fixed_list = []
     for item in mutation_list:
         item = re.sub(pattern, '', item)
         if len(item) > 0:
-            fixed_list.append(item)        
-    path = Path(__file__).parent / "data/results"
-    os.system('rm -rf %s/*' % path)
-    return (','.join(fixed_list))
+            fixed_list.append(item)
+    return ','.join(fixed_list)
+
+def get_reference_records(fasta, job=None):
+    results, failures = generate_alignments(fasta, job=job)
+    if not results:
+        raise ValueError('no dataset could be run')
+    return reference_records(results)
+
+def records_from_results(results):
+    return [(name, mutations) for name, reference, mutations in reference_records(results)]
+
+def reference_records(results):
+    # (name, best reference, private mutations) of every record, from the datasets that ran
+    best = get_best_references(results)
+    names = next(iter(results.values()))['seqName']
+    records = []
+    for index, reference in best.items():
+        name = str(names[index])
+        if reference == "Error":
+            records.append((name, "Error", "Error"))
+            continue
+        records.append((name, reference, row_mutations(results[reference].loc[index])))
+    return records
+
+def row_mutations(row):
+    mutation_list = []
+    for column in private_mutation_columns:
+        if isinstance(row.get(column), str):
+            mutation_list.extend(row[column].split(','))
+    return clean_private_mutations(mutation_list)
+
+def run_uncached(records, job=None):
+    # only the sequences that aren't in the cache are aligned; they are streamed to each Nextclade process,
+    # so concurrent jobs share no files
+    try:
+        return align_records(records, job)
+    except (OSError, KeyError, ValueError):
+        return [("Error", "Error")] * len(records)
+
+def align_records(records, job=None):
+    results = [None] * len(records)
+    # sequences that are clearly closest to one reference are only aligned against that dataset
+    groups = {}
+    for i, (name, sequence) in enumerate(records):
+        reference = screen_reference(sequence)
+        if reference is not None:
+            groups.setdefault(reference, []).append(i)
+    if groups:
+        threads = max((os.cpu_count() or 1) // min(nextclade_jobs, len(groups)), 1)
+        commands = {reference: (alignment_command(reference, threads), fasta_text([records[i] for i in indices])) for reference, indices in groups.items()}
+        screened, failures = run_commands(commands, job=job)
+        for reference, df in screened.items():
+            for i, (index, row) in zip(groups[reference], df.iterrows()):
+                if pd.notna(row['alignmentScore']):
+                    results[i] = (reference, row_mutations(row))
+    # the rest (too close to call, or not aligned above) are run against every dataset
+    rest = [i for i, result in enumerate(results) if result is None]
+    if rest:
+        for i, (name, reference, mutations) in zip(rest, get_reference_records(fasta_text([records[i] for i in rest]), job=job)):
+            results[i] = (reference, mutations)
+    return results
+
+@lru_cache(maxsize=None)
+def reference_sketches():
+    # k-mers of each reference that aren't in all of them; the ones they share can't tell them apart
+    kmers = {}
+    for i in ref_seqs:
+        name, sequence = read_fasta(Path(__file__).parent / "data/reference_seqs" / i / "reference.fasta")[0]
+        kmers[i] = sequence_kmers(sequence)
+    shared = set.intersection(*kmers.values())
+    return {i: frozenset(kmers[i] - shared) for i in ref_seqs}
+
+def sequence_kmers(sequence):
+    sequence = normalize_sequence(sequence)
+    return {sequence[j:j + screen_k] for j in range(len(sequence) - screen_k + 1)}
+
+def screen_reference(sequence, margin=None):
+    # closest reference by shared k-mers, or None when the top two are too close to call
+    margin = screen_margin if margin is None else margin
+    kmers = sequence_kmers(sequence)
+    scores = sorted(((len(kmers & sketch), i) for i, sketch in reference_sketches().items()), reverse=True)
+    if scores[0][0] - scores[1][0] < max(margin, 1):
+        return None
+    return scores[0][1]
+
+def execute_nextclade_records(input_path, job=None):
+    # (name, private mutations) of every record
+    return [(name, mutations) for name, reference, mutations in nextclade_records(input_path, job)]
+
+def nextclade_records(input_path, job=None):
+    # (name, best reference, private mutations) of every record
+    records = read_records(input_path)
+    if not records:
+        return [("", "Error", "Error")]
+    return sequence_records(records, job)
+
+def read_records(input_path):
+    # (name, sequence) of every record, or None if the file can't be read
+    try:
+        return read_fasta(input_path)
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def sequence_records(records, job=None):
+    # (name, best reference, private mutations) of every (name, sequence) record; the ones that aren't
+    # cached are aligned together
+    keys = [sequence_key(sequence) for name, sequence in records]
+    found = {key: result_cache.get(key) for key in dict.fromkeys(keys)}
+    missing = [key for key, hit in found.items() if hit is None]
+    if missing:
+        # identical sequences are only aligned once
+        sequences = {}
+        for key, record in zip(keys, records):
+            sequences.setdefault(key, record)
+        results = run_uncached([sequences[key] for key in missing], job)
+        for key, (reference, mutations) in zip(missing, results):
+            found[key] = (reference, mutations)
+            if reference != "Error":
+                result_cache.put(key, reference, mutations)
+    return [(name, *found[key]) for key, (name, sequence) in zip(keys, records)]
         
 def execute_nextclade(input_path):
-    generate_alignment_script(input_path)
-    return parse_private_mutations(input_path)
-#print(execute_nextclade(Path(__file__).parent / '/Users/egill/Desktop/testFASTA/test.fasta'))
+    # private mutations of the first record
+    return execute_nextclade_records(input_path)[0][1]
+
+class QueueFullError(RuntimeError):
+    # raised by submit_job() when too many files are already waiting
+    pass
+
+class NextcladeJob:
+    # one file analyzed in the background by submit_job(); status goes from 'queued' to 'running' and then
+    # 'done', 'failed' or 'cancelled'. The result is a list of (name, private mutations), or of
+    # (name, best reference, private mutations) with references=True
+    def __init__(self, input_path, queue=None, references=False):
+        self.input_path = input_path
+        self.queue = queue
+        self.references = references
+        self.status = 'queued'
+        self.result = None
+        self.future = Future()
+        self.cancelled = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.submitted_at = time.monotonic()
+        self.wait_time = None
+        self.run_time = None
+
+    def run(self):
+        if self.cancelled.is_set():
+            return None
+        self.status = 'running'
+        try:
+            result = self.analyze()
+        except Exception:
+            self.status = 'cancelled' if self.cancelled.is_set() else 'failed'
+            raise
+        if self.cancelled.is_set():
+            self.status = 'cancelled'
+            return None
+        self.result = result
+        self.status = 'done'
+        return result
+
+    def analyze(self):
+        if self.references:
+            return nextclade_records(self.input_path, job=self)
+        return execute_nextclade_records(self.input_path, job=self)
+
+    def attach(self, process):
+        with self.lock:
+            self.processes.add(process)
+            if self.cancelled.is_set():
+                process.kill()
+
+    def detach(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        # a queued job never starts, a running one has its Nextclade processes killed
+        self.cancelled.set()
+        if self.future.cancel():
+            self.status = 'cancelled'
+            if self.queue is not None:
+                self.queue.remove(self)
+        with self.lock:
+            for process in self.processes:
+                process.kill()
+
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def position(self):
+        # place in the queue (1 is next), 0 once the job has left it
+        return self.queue.position(self) if self.queue is not None else 0
+
+class BatchJob(NextcladeJob):
+    # several files analyzed as a single job, so a batch takes one place in the queue; the records of every
+    # file go through one Nextclade run per dataset, and the result (also in finished once the run is over)
+    # is the list of (name, best reference, private mutations) of each file
+    def __init__(self, input_paths, queue=None):
+        super().__init__(None, queue, references=True)
+        self.input_paths = list(input_paths)
+        self.finished = []
+
+    def analyze(self):
+        files = [read_records(input_path) or [] for input_path in self.input_paths]
+        results = sequence_records([record for records in files for record in records], job=self)
+        # split the results back into files, in the same order
+        finished = []
+        start = 0
+        for records in files:
+            if not records:
+                finished.append([("", "Error", "Error")])
+                continue
+            finished.append(results[start:start + len(records)])
+            start += len(records)
+        self.finished = finished
+        return list(finished)
+
+class JobQueue:
+    # first in, first out queue of NextcladeJob run by a fixed number of threads; submissions are turned
+    # away once max_queued jobs are waiting, and the wait and run times of finished jobs are counted
+    def __init__(self, workers=None, max_queued=None):
+        self.workers = workers or nextclade_workers
+        self.max_queued = nextclade_queue_depth if max_queued is None else max_queued
+        self.queued = deque()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.counters = {'submitted': 0, 'rejected': 0, 'cancelled': 0, 'completed': 0, 'running': 0,
+                         'wait_time': 0.0, 'run_time': 0.0, 'max_wait_time': 0.0}
+
+    def submit(self, job):
+        with self.condition:
+            if len(self.queued) >= self.max_queued:
+                self.counters['rejected'] += 1
+                raise QueueFullError(f'{len(self.queued)} uploads are already waiting for Nextclade, please try again later.')
+            job.queue = self
+            self.queued.append(job)
+            self.counters['submitted'] += 1
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name=f'nextclade-{len(self.threads)}', daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        return job
+
+    def remove(self, job):
+        with self.condition:
+            if job in self.queued:
+                self.queued.remove(job)
+                self.counters['cancelled'] += 1
+
+    def position(self, job):
+        with self.condition:
+            try:
+                return self.queued.index(job) + 1
+            except ValueError:
+                return 0
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queued:
+                    self.condition.wait()
+                job = self.queued.popleft()
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                job.wait_time = time.monotonic() - job.submitted_at
+                self.counters['running'] += 1
+            start = time.monotonic()
+            try:
+                job.future.set_result(job.run())
+            except Exception as e:
+                job.future.set_exception(e)
+            job.run_time = time.monotonic() - start
+            with self.condition:
+                self.counters['running'] -= 1
+                self.counters['completed'] += 1
+                self.counters['wait_time'] += job.wait_time
+                self.counters['run_time'] += job.run_time
+                self.counters['max_wait_time'] = max(self.counters['max_wait_time'], job.wait_time)
+
+    def stats(self):
+        # counters so far, with the number of jobs waiting and the mean wait and run times (seconds)
+        with self.condition:
+            stats = dict(self.counters, queued=len(self.queued))
+        completed = max(stats['completed'], 1)
+        stats['mean_wait_time'] = stats['wait_time'] / completed
+        stats['mean_run_time'] = stats['run_time'] / completed
+        return stats
+
+# background jobs run on their own threads, at most nextclade_workers files at a time per process, with up to
+# nextclade_queue_depth more waiting
+nextclade_workers = int(os.environ.get('NEXTCLADE_WORKERS', 2))
+nextclade_queue_depth = int(os.environ.get('NEXTCLADE_QUEUE_DEPTH', 20))
+_job_queue = None
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue()
+    return _job_queue
+
+def submit_job(input_path, references=False):
+    # queues the file to be analyzed in the background and returns its NextcladeJob straight away,
+    # or raises QueueFullError if the queue is full
+    return get_job_queue().submit(NextcladeJob(input_path, references=references))
+
+def submit_batch(input_paths):
+    # queues the files as one BatchJob, analyzed together, or raises QueueFullError
+    return get_job_queue().submit(BatchJob(input_paths))
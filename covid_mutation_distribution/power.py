@@ -0,0 +1,104 @@
+import argparse
+import json
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import cli
+import functions
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="""Estimate how often lineages drawn from each mutation distribution are classified correctly.
+
+Synthetic lineages of k mutations are drawn from every distribution and scored against all of them,
+for each bin size and k requested. Re-run this whenever the reference data changes.""",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--bin-sizes",
+        nargs="+",
+        choices=["genes_split", "gene", "500", "1000"],
+        default=["genes_split", "gene", "500", "1000"],
+        help="Bin sizes to evaluate (default: all)",
+    )
+    parser.add_argument(
+        "--mutations",
+        nargs="+",
+        type=int,
+        default=[5, 10, 15, 20, 30, 40, 50],
+        metavar="K",
+        help="Numbers of mutations per lineage to evaluate (default: 5 10 15 20 30 40 50)",
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        default=10000,
+        help="Number of lineages drawn from each distribution for each bin size and k (default: 10000)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed for the simulations",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use (default: 1)",
+    )
+    parser.add_argument(
+        "--output",
+        default="classification_accuracy.tsv",
+        help="Output file for the accuracy table (default: classification_accuracy.tsv)",
+    )
+    parser.add_argument(
+        "--confusion-output",
+        help="Optional JSON file for the confusion matrix of every bin size and k",
+    )
+    return parser.parse_args()
+
+
+def write_confusion(
+    confusion: Dict[Tuple[str, int], np.ndarray], names: List[str], output_file: str
+) -> None:
+    matrices = [
+        {
+            "bin_size": binsize,
+            "k": k,
+            "distributions": names,
+            "counts": matrix.tolist(),
+        }
+        for (binsize, k), matrix in confusion.items()
+    ]
+    with open(output_file, "w") as f:
+        json.dump(matrices, f, indent=2)
+    print(f"Confusion matrices saved as {output_file}")
+
+
+def main() -> None:
+    args = parse_arguments()
+    if min(args.mutations) < 1 or args.replicates < 1:
+        print("Error: `--mutations` and `--replicates` must be positive.")
+        exit(1)
+
+    reference_tables = cli.load_reference_tables()
+    accuracy, confusion = functions.simulate_classification(
+        reference_tables,
+        args.bin_sizes,
+        args.mutations,
+        replicates=args.replicates,
+        seed=args.seed,
+        jobs=args.jobs,
+    )
+
+    accuracy.to_csv(args.output, sep="\t", index=False, float_format="%.4f")
+    print(accuracy.to_string(index=False, float_format="%.4f"))
+    print(f"Accuracy table saved as {args.output}")
+    if args.confusion_output:
+        write_confusion(confusion, reference_tables.names, args.confusion_output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,11 @@
 import pytest
+import numpy as np
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
 from covid_mutation_distribution import functions
 
@@ -44,4 +51,548 @@ def test_make_bins_genes_split():
     
 def test_make_bins_genes_split_names():
     counts, bins0 = functions.make_bins(functions.parse_mutation_files(test_dist)[0], 'genes_split')
-    assert bins0[-1] == 'ORF10'
\ No newline at end of file
+    assert bins0[-1] == 'ORF10'
+
+def test_reference_tables_cached():
+    dist = functions.parse_mutation_files(test_dist)[0]
+    tables = functions.ReferenceTables(dist, dist, dist, dist)
+    assert tables.table(1000) is tables.table('1000')
+
+def test_reference_tables_match_get_likelihood():
+    dist = functions.parse_mutation_files(test_dist)[0]
+    tables = functions.ReferenceTables(dist, dist, dist, dist)
+    table = tables.table('gene')
+    mut_counts, bins = functions.make_bins(mut_list, 'gene')
+    likelihoods = functions.get_likelihoods(table, mut_list)
+    assert likelihoods[0] == pytest.approx(functions.get_likelihood(functions.make_bins(dist, 'gene')[0], mut_counts))
+
+def test_bin_lookup_matches_make_bins():
+    dist = functions.parse_mutation_files(test_dist)[0]
+    lookup = functions.bin_lookup('genes_split')
+    expected = functions.make_bins(dist, 'genes_split')[0]
+    counts = functions.count_matrix(np.zeros(len(dist), dtype=int), np.array(dist), lookup, 1, len(expected))
+    assert list(counts[0]) == list(expected)
+
+def test_score_batch_matches_most_likely():
+    dist = functions.parse_mutation_files(test_dist)[0]
+    tables = functions.ReferenceTables(dist, dist[:100], dist[100:], dist)
+    mutations = ', '.join(str(i) for i in mut_list)
+    zipped, best_fit = functions.most_likely(1000, None, None, None, None, mutations, reference_tables=tables)
+    df = functions.score_batch(1000, [mutations, ''], tables)
+    assert df['chronic'][0] == pytest.approx(zipped[2][0])
+    assert df['best_fit'][0] == best_fit[1]
+    assert df['mutations_count'][1] == 0
+
+def test_parse_mutation_counts_total():
+    mutations, total_mutation = functions.parse_mutation_counts(test_dist)
+    assert total_mutation == 282
+    assert mutations.weights.sum() == 282
+
+def test_make_bins_weighted_matches_expanded():
+    mutations = functions.parse_mutation_counts(test_dist)[0]
+    expanded = functions.parse_mutation_files(test_dist)[0]
+    for binsize in ['gene', 500]:
+        for deer in [False, True]:
+            weighted_counts = functions.make_bins(mutations, binsize, deer=deer)[0]
+            assert list(weighted_counts) == list(functions.make_bins(expanded, binsize, deer=deer)[0])
+
+def test_genome_mask_from_bed():
+    assert functions.deer_mask.masked[1]
+    assert functions.deer_mask.masked[265]
+    assert not functions.deer_mask.masked[266]
+    assert list(functions.deer_mask.apply([100, 300, 29700])) == [300]
+
+def test_make_bins_with_registered_mask():
+    mask = functions.GenomeMask([897, 3431])
+    counts, bins0 = functions.make_bins(mut_list, 1000, mask=mask)
+    assert counts.sum() == len(mut_list) - 2
+
+def test_scoring_with_mask_over_last_bin(monkeypatch):
+    monkeypatch.setattr(functions, 'distribution_masks', {})
+    functions.register_mask('chronic', functions.GenomeMask(np.arange(29001, 30002)))
+    dist = functions.parse_mutation_files(test_dist)[0]
+    tables = functions.ReferenceTables(dist, dist[:100], dist[100:], dist)
+    mutations = ', '.join(str(i) for i in mut_list + [29500])
+    zipped, best_fit = functions.rank_distributions(1000, mutations, tables)
+    df = functions.score_batch(1000, [mutations, ''], tables)
+    assert df['chronic'][0] == pytest.approx(zipped[2][0])
+    # the masked bin is left out of the chronic likelihood only
+    table = tables.table(1000)
+    counts = functions.make_bins(mut_list + [29500], 1000)[0]
+    assert zipped[0][0] == pytest.approx(functions.get_likelihood(table.counts[0], counts))
+    result = functions.bootstrap_likelihoods(1000, mutations, tables, replicates=50, seed=1)
+    assert result.replicates == 50
+
+def test_tokenize_mutations_records():
+    parsed = functions.tokenize_mutations('C897A, ins21608, del23009, 3431, c897a, C897A,')
+    assert parsed.valid
+    assert len(parsed) == 5
+    assert list(parsed.records['kind']) == ['sub', 'ins', 'del', 'sub', 'sub']
+    assert parsed.records['ref'][0] == 'C' and parsed.records['alt'][0] == 'A'
+
+def test_tokenize_mutations_error_points_to_token():
+    parsed = functions.tokenize_mutations('C897A, S:G107Y')
+    assert not parsed.valid
+    with pytest.raises(functions.MutationParseError) as error:
+        parsed.check()
+    assert error.value.token == 'S:G107Y'
+    assert error.value.index == 1
+
+def test_parsed_mutations_accepted_downstream():
+    parsed = functions.tokenize_mutations('C897A, G3431T, A7842G, G18155T')
+    assert functions.transition_or_transversion(parsed) == functions.transition_or_transversion('C897A, G3431T, A7842G, G18155T')
+    assert functions.mut_lineage_parsing(parsed) == ('18155', '')
+
+def test_substitution_spectrum_single_and_batch():
+    spectrum, transitions, transversions = functions.substitution_spectrum('C897A, G3431T, A7842G, C8293T, ins21608')
+    assert (transitions, transversions) == (2, 2)
+    assert spectrum[functions.substitution_classes.index('C>T')] == 1
+    spectra, transitions, transversions = functions.substitution_spectrum(['C897A, C8293T', 'A7842G', ''])
+    assert spectra.shape == (3, 12)
+    assert list(transitions) == [1, 1, 0]
+    assert list(transversions) == [1, 0, 0]
+
+# weighted test distribution with a narrower chronic distribution, shared by the likelihood tests below
+@pytest.fixture(scope='module')
+def tables():
+    dist = functions.parse_mutation_counts(test_dist)[0]
+    chronic = functions.parse_mutation_files(test_dist)[0][:100]
+    return functions.ReferenceTables(dist, dist, chronic, dist)
+
+def test_likelihood_ratio_track_matches_bins(tables):
+    mutations = ', '.join(str(i) for i in mut_list)
+    starts, ends, ratios = functions.likelihood_ratio_track(mutations, tables, 1000)
+    zipped, best_fit = functions.most_likely(1000, None, None, None, None, mutations, reference_tables=tables)
+    # windows that line up with the 1000 nucleotide bins add up to the whole-genome ratio
+    assert ratios[starts % 1000 == 1].sum() == pytest.approx(zipped[2][0] - zipped[0][0])
+
+def test_bootstrap_likelihoods_reproducible(tables):
+    mutations = ', '.join(str(i) for i in mut_list)
+    result = functions.bootstrap_likelihoods('gene', mutations, tables, replicates=500, seed=1, chunk_size=200)
+    again = functions.bootstrap_likelihoods('gene', mutations, tables, replicates=500, seed=1, chunk_size=200, jobs=2)
+    assert result.replicates == 500
+    assert np.allclose(result.lower, again.lower)
+    assert np.all(result.lower <= result.likelihoods) and np.all(result.likelihoods <= result.upper)
+    assert result.win_fraction.sum() == pytest.approx(1)
+
+def test_simulate_classification(tables):
+    accuracy, confusion = functions.simulate_classification(tables, ['gene', 500], [5, 20], replicates=300,
+                                                            seed=2, chunk_size=200)
+    assert list(accuracy['k']) == [5, 20, 5, 20]
+    assert confusion[('gene', 5)].sum(axis=1).tolist() == [300] * 4
+    assert np.all((accuracy['accuracy'] >= 0) & (accuracy['accuracy'] <= 1))
+    # lineages drawn from the narrower chronic distribution get easier to recognise with more mutations
+    assert accuracy['chronic'][1] >= accuracy['chronic'][0]
+    again = functions.simulate_classification(tables, ['gene', 500], [5, 20], replicates=300, seed=2,
+                                              chunk_size=200, jobs=2)[1]
+    assert all(np.array_equal(confusion[key], again[key]) for key in confusion)
+
+def test_null_table_p_values(tables, tmp_path):
+    null_table = functions.build_null_table(tables, ['gene'], [5, 10], replicates=500, seed=3)
+    null_table.save(tmp_path / 'null.npz')
+    loaded = functions.NullTable.load(tmp_path / 'null.npz')
+    assert loaded.binsizes == ['gene'] and loaded.lineage_sizes.tolist() == [5, 10]
+    p = loaded.p_values('gene', [5, 5, 5, 0], [-100, 0, 100, 0])
+    assert p[0] == 1 and p[0] >= p[1] >= p[2] and p[2] == pytest.approx(1 / 501)
+    assert np.isnan(p[3]) and np.isnan(loaded.p_values(500, 5, 0))
+    df = functions.score_batch('gene', ['C241T, C3037T, A23403G, C897A, G3431T', ''], tables, null_table=loaded)
+    assert 0 < df['p_value'][0] <= 1 and np.isnan(df['p_value'][1])
+
+def test_null_table_p_values_calibrated_only_inside_table(tables):
+    null_table = functions.build_null_table(tables, ['gene'], [5, 10], replicates=2000, seed=4)
+    assert null_table.size_range == (5, 10)
+    # lineages drawn from the null distribution get p < 0.05 about 5% of the time inside the table
+    rng = np.random.default_rng(5)
+    expanded = np.array(functions.parse_mutation_files(test_dist)[0])
+    for k, expected in [(10, True), (40, False)]:
+        lineages = [', '.join(str(i) for i in rng.choice(expanded, k)) for j in range(2000)]
+        df = functions.score_batch('gene', lineages, tables, null_table=null_table)
+        p = df['p_value'].to_numpy()[df['mutations_count'].to_numpy() == k]
+        if expected:
+            assert 0.02 < np.mean(p < 0.05) < 0.08
+        else:
+            # larger lineages aren't covered by the table, so they get no p-value instead of a wrong one
+            assert len(p) > 0 and np.isnan(p).all()
+
+def test_registry_with_extra_distribution(tmp_path):
+    assert functions.distribution_names == ['global_pre-VoC', 'global_Omicron', 'chronic', 'deer']
+    entries = [{'name': name, 'file': str(Path(test_dist).resolve())} for name in ['global_pre-VoC', 'chronic']]
+    entries.append({'name': 'mink', 'file': str(Path(test_dist).resolve()), 'display_name': 'farmed mink',
+                    'masks': [str(functions.data_dir / 'masks' / 'deer.bed')], 'colour': '#123456'})
+    (tmp_path / 'distributions.json').write_text(json.dumps({'distributions': entries}))
+    registry = functions.load_registry(tmp_path)
+    tables = functions.ReferenceTables.from_registry(registry)
+    assert tables.names == ['global_pre-VoC', 'chronic', 'mink']
+    assert tables.display_names == ['global pre-VoC', 'chronic', 'farmed mink']
+    assert tables.palette('plasma')[2] == '#123456'
+    zipped, best_fit = functions.rank_distributions('gene', 'C897A, G3431T', tables)
+    assert [name for likelihood, name in zipped] == tables.names
+    df = functions.score_batch(500, ['C897A, G3431T', 'C100T'], tables)
+    assert list(df.columns[3:6]) == tables.names
+    # the mink rows use the deer mask, so the masked mutation doesn't count against it
+    assert df['mink'][1] == 0
+
+def test_reference_store_rebuilds_on_change(tmp_path):
+    counts_file = tmp_path / 'counts.tsv'
+    counts_file.write_bytes(Path(test_dist).read_bytes())
+    entries = [{'name': name, 'file': 'counts.tsv'} for name in ['global_pre-VoC', 'chronic']]
+    entries[1]['masks'] = [str(functions.data_dir / 'masks' / 'deer.bed')]
+    (tmp_path / 'distributions.json').write_text(json.dumps({'distributions': entries}))
+    registry = functions.load_registry(tmp_path)
+    stores = tmp_path / 'stores'
+    # other data in the store folder is left alone
+    (stores / 'important_project').mkdir(parents=True)
+    tables = functions.load_reference_tables(registry, stores)
+    direct = functions.ReferenceTables.from_registry(registry)
+    store_name = functions.store_prefix + functions.reference_hash(registry)
+    assert sorted(i.name for i in stores.iterdir()) == ['important_project', store_name]
+    # readable by app workers running as another user
+    assert (stores / store_name).stat().st_mode & 0o777 == 0o755
+    assert isinstance(tables.table('gene').counts, np.memmap)
+    for binsize in ['gene', 500, 250]:
+        assert np.array_equal(tables.table(binsize).counts, direct.table(binsize).counts)
+    assert list(tables.groups) == list(direct.groups)
+    assert np.array_equal(tables.site_counts('chronic'), direct.site_counts('chronic'))
+    # changing the reference data replaces the store
+    with open(counts_file, 'a') as f:
+        f.write('1000\t5\n')
+    tables = functions.load_reference_tables(registry, stores)
+    store_name = functions.store_prefix + functions.reference_hash(registry)
+    assert sorted(i.name for i in stores.iterdir()) == ['important_project', store_name]
+    assert tables.site_counts('global_pre-VoC')[1000] == direct.site_counts('global_pre-VoC')[1000] + 5
+    # a store that can't be read falls back to the distribution files
+    (stores / store_name / 'metadata.json').unlink()
+    tables = functions.load_reference_tables(registry, stores)
+    assert not isinstance(tables.table('gene').counts, np.memmap)
+
+# cold start budget (seconds) for one CLI call, the way pipelines call it once per sample
+cli_startup_budget = float(os.environ.get('SMDP_STARTUP_BUDGET', 1.0))
+cli_script = Path(__file__).parent.parent / 'covid_mutation_distribution' / 'cli.py'
+
+def test_cli_startup_budget():
+    timings = []
+    for i in range(3):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, str(cli_script), 'C241T, C3037T, A23403G'], capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        assert result.returncode == 0, result.stderr
+    assert min(timings) < cli_startup_budget
+    # heavy modules are only imported by the code paths that need them
+    check = ('import sys; sys.argv = ["cli.py", "C3037T, A23403G"]; import cli; cli.main(); '
+             'print(sorted({m.split(".")[0] for m in sys.modules} & {"pandas", "matplotlib", "seaborn"}))')
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=cli_script.parent)
+    assert result.stdout.strip().splitlines()[-1] == '[]'
+
+def test_cli_batch_mode(tmp_path):
+    batch = tmp_path / 'batch.jsonl'
+    with open(batch, 'w') as f:
+        for i in range(7):
+            f.write(json.dumps({'sample_id': f's{i}', 'mutations': ['C897A', 'G3431T', 'A7842G'][:i % 4]}) + '\n')
+    result = subprocess.run([sys.executable, str(cli_script), '--batch', str(batch), '--batch-size', '2', '--jobs', '2'],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    records = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [record['sample_id'] for record in records] == [f's{i}' for i in range(7)]
+    assert [record['mutations_count'] for record in records] == [0, 1, 2, 3, 0, 1, 2]
+    single = subprocess.run([sys.executable, str(cli_script), 'C897A, G3431T, A7842G', '--output', 'json'],
+                            capture_output=True, text=True)
+    assert records[3]['likelihoods'] == json.loads(single.stdout)['likelihoods']
+    # duplicates and tokens that can't be read aren't counted in either mode
+    mutations = 'C897A, C897A, banana, G3431T'
+    single = subprocess.run([sys.executable, str(cli_script), mutations, '--output', 'json'], capture_output=True, text=True)
+    with open(batch, 'w') as f:
+        f.write(json.dumps({'sample_id': 's', 'mutations': mutations}) + '\n')
+    result = subprocess.run([sys.executable, str(cli_script), '--batch', str(batch)], capture_output=True, text=True)
+    assert json.loads(single.stdout)['mutations_count'] == json.loads(result.stdout)['mutations_count'] == 2
+
+def test_cli_track_keeps_json_output_clean(tmp_path):
+    track = tmp_path / 'track.bedgraph'
+    result = subprocess.run([sys.executable, str(cli_script), 'C897A, G3431T', '--output', 'json', '--track-window', '1000',
+                             '--track-output', str(track)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout)['mutations_count'] == 2
+    assert 'Track saved as' in result.stderr and track.exists()
+
+def test_cli_rejects_track_window_out_of_range(tmp_path):
+    for window in ['0', '40000']:
+        result = subprocess.run([sys.executable, str(cli_script), 'C897A, G3431T', '--track-window', window,
+                                 '--track-output', str(tmp_path / 'track.bedgraph')], capture_output=True, text=True)
+        assert result.returncode == 1
+        assert result.stdout.startswith('Error: `--track-window`')
+        assert 'Traceback' not in result.stderr
+    assert not (tmp_path / 'track.bedgraph').exists()
+
+def test_cli_checks_plot_bin_size_before_aligning(tmp_path, monkeypatch):
+    # the FASTA would need Nextclade, which isn't run when an option is wrong
+    monkeypatch.setenv('PATH', str(tmp_path))
+    fasta = tmp_path / 'sample.fasta'
+    fasta.write_text('>sample\nACGT\n')
+    result = subprocess.run([sys.executable, str(cli_script), str(fasta), '--plot', '--bin-size', 'gene'],
+                            capture_output=True, text=True)
+    assert result.returncode == 1
+    assert result.stdout.startswith('Error: Plotting is only available for integer bin sizes.')
+
+def test_nextclade_records_pick_best_reference_per_record():
+    from covid_mutation_distribution import nextcladefunctions
+    columns = ['index', 'seqName', 'clade', 'alignmentScore'] + nextcladefunctions.private_mutation_columns
+    scores = {'wuhan': [90, 10, ''], 'BA2': [50, 80, ''], 'BA286': [10, 20, ''], 'XBB': [20, 30, '']}
+    results = {}
+    for offset, (reference, reference_scores) in enumerate(scores.items()):
+        lines = ['\t'.join(columns)]
+        # rows aren't necessarily written in input order
+        for index in [2, 1, 0]:
+            mutations = [f'C{1000 * offset + index}T', f'G{200 + index}A|x', f'-A{300 + index}G']
+            lines.append('\t'.join([str(index), f'seq{index}', '21L', str(reference_scores[index])] + mutations))
+        results[reference] = nextcladefunctions.parse_results(lines)
+    # unused columns are dropped while reading
+    assert 'clade' not in results['wuhan'].columns
+    records = nextcladefunctions.records_from_results(results)
+    assert records == [('seq0', 'C0T,G200A'), ('seq1', 'C1001T,G201A'), ('seq2', 'Error')]
+
+def test_nextclade_runs_concurrently_with_timeouts(monkeypatch, capsys):
+    from covid_mutation_distribution import nextcladefunctions
+    sleep = [sys.executable, '-c', 'import time; time.sleep(0.5); print("index\\tseqName\\talignmentScore")']
+    commands = {'wuhan': sleep, 'BA2': sleep, 'BA286': sleep,
+                'XBB': [sys.executable, '-c', 'import sys; sys.exit("bad dataset")']}
+    monkeypatch.setattr(nextcladefunctions, 'alignment_commands', lambda jobs: commands)
+    start = time.perf_counter()
+    results, failures = nextcladefunctions.generate_alignments('>a\nACGT\n', jobs=4, timeout=10)
+    # the runs overlap, so this takes about as long as one of them
+    assert time.perf_counter() - start < 1.4
+    assert sorted(results) == ['BA2', 'BA286', 'wuhan']
+    assert failures == {'XBB': 'bad dataset'}
+    assert 'XBB dataset failed: bad dataset' in capsys.readouterr().err
+    assert nextcladefunctions.run_alignment(sleep, timeout=0.1) == (None, 'timed out after 0.1 seconds')
+
+fake_nextclade = """
+import sys
+records = [line[1:].strip() for line in sys.stdin if line.startswith('>')]
+print('index\\tseqName\\tclade\\talignmentScore\\tprivateNucMutations.unlabeledSubstitutions')
+for index in reversed(range(len(records))):
+    print(f'{index}\\t{records[index]}\\t21L\\t{sys.argv[1]}\\tC{sys.argv[1]}T')
+"""
+
+def test_nextclade_streams_sequences_without_files(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    scores = {'wuhan': 10, 'BA2': 40, 'BA286': 30, 'XBB': 20}
+    monkeypatch.setattr(nextcladefunctions, 'alignment_commands',
+                        lambda jobs: {i: [sys.executable, '-c', fake_nextclade, str(score)] for i, score in scores.items()})
+    monkeypatch.setattr(nextcladefunctions, 'result_cache', nextcladefunctions.ResultCache(max_entries=0))
+    upload = tmp_path / 'upload.fasta'
+    upload.write_text('>a\nACGT\n>b\nTTTT\n')
+    assert nextcladefunctions.execute_nextclade_records(upload) == [('a', 'C40T'), ('b', 'C40T')]
+    assert nextcladefunctions.execute_nextclade(upload) == 'C40T'
+    # the sequences went to Nextclade through a pipe, nothing was written next to the upload
+    assert [path.name for path in tmp_path.iterdir()] == ['upload.fasta']
+    assert nextcladefunctions.find_nextclade() is nextcladefunctions.find_nextclade()
+
+def test_nextclade_results_are_cached_by_sequence(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    runs = []
+    def fake_records(fasta, job=None):
+        records = nextcladefunctions.parse_fasta(fasta.splitlines())
+        runs.append([name for name, sequence in records])
+        return [(name, 'BA2', f'C{len(sequence)}T') for name, sequence in records]
+    monkeypatch.setattr(nextcladefunctions, 'get_reference_records', fake_records)
+    cache = nextcladefunctions.ResultCache(tmp_path / 'cache', max_entries=2)
+    monkeypatch.setattr(nextcladefunctions, 'result_cache', cache)
+    (tmp_path / 'cache').mkdir()
+    (tmp_path / 'cache' / 'settings.json').write_text('{}')
+    upload = tmp_path / 'upload.fasta'
+    upload.write_text('>a\nACGT\nAC\n>b\nACG\n>c\nacgt\nac\n')
+    assert nextcladefunctions.execute_nextclade_records(upload) == [('a', 'C6T'), ('b', 'C3T'), ('c', 'C6T')]
+    # a and c are the same sequence once line breaks and case are ignored, so it was only aligned once
+    assert runs == [['a', 'b']]
+    upload.write_text('>renamed\nACGTAC\n>d\nACGTA\n')
+    assert nextcladefunctions.execute_nextclade_records(upload) == [('renamed', 'C6T'), ('d', 'C5T')]
+    assert runs == [['a', 'b'], ['d']]
+    # only the two most recently used sequences are kept, other files in the folder are left alone
+    assert len(list((tmp_path / 'cache').glob('nextclade-*.json'))) == 2
+    assert (tmp_path / 'cache' / 'settings.json').exists()
+    assert cache.get(nextcladefunctions.sequence_key('ACG')) is None
+    assert cache.get(nextcladefunctions.sequence_key('ACGTA')) == ('BA2', 'C5T')
+
+def test_result_cache_read_only_entries_are_hits(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    cache = nextcladefunctions.ResultCache(tmp_path, max_entries=10)
+    cache.put('key', 'BA2', 'C3037T')
+    # a shared cache that can't be written still returns its entries
+    def utime(path):
+        raise PermissionError(path)
+    monkeypatch.setattr(nextcladefunctions.os, 'utime', utime)
+    assert cache.get('key') == ('BA2', 'C3037T')
+
+def test_result_cache_only_scans_when_full(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    cache = nextcladefunctions.ResultCache(tmp_path, max_entries=100)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, 'evict', lambda: scans.append(1) or evict())
+    for i in range(250):
+        cache.put(f'{i:064x}', 'BA2', 'C3037T')
+    # one scan to count the folder, then one each time it goes over the limit (it is cut down to 90
+    # entries, so every 11 puts here), rather than one per put
+    assert len(scans) == 15
+    assert 90 <= len(list(tmp_path.glob('nextclade-*.json'))) <= 100
+
+def test_reference_prescreen_skips_other_datasets(monkeypatch):
+    from covid_mutation_distribution import nextcladefunctions
+    ba286 = nextcladefunctions.read_fasta(Path(nextcladefunctions.__file__).parent / 'data/reference_seqs/BA286/reference.fasta')[0][1]
+    query = ba286[:5000] + 'T' + ba286[5001:-200]
+    assert nextcladefunctions.screen_reference(query) == 'BA286'
+    # nothing to tell the references apart
+    assert nextcladefunctions.screen_reference(ba286[:15]) is None
+    commands = []
+    def fake_run(command_dict, jobs=1, timeout=1, job=None):
+        commands.append(sorted(command_dict))
+        results = {}
+        for reference, (command, fasta) in command_dict.items():
+            names = [name for name, sequence in nextcladefunctions.parse_fasta(fasta.splitlines())]
+            lines = ['index\tseqName\talignmentScore\t' + '\t'.join(nextcladefunctions.private_mutation_columns)]
+            lines += [f'{i}\t{name}\t100\tC5001T\t\t' for i, name in enumerate(names)]
+            results[reference] = nextcladefunctions.parse_results(lines)
+        return results, {}
+    monkeypatch.setattr(nextcladefunctions, 'run_commands', fake_run)
+    monkeypatch.setattr(nextcladefunctions, 'generate_alignments',
+                        lambda fasta, job=None: fake_run({i: (command, fasta) for i, command in nextcladefunctions.alignment_commands(4).items()}))
+    results = nextcladefunctions.align_records([('a', query), ('b', 'ACGT')])
+    # only the BA.2.86 dataset for the first sequence, every dataset for the one that couldn't be screened
+    assert commands == [['BA286'], sorted(nextcladefunctions.ref_seqs)]
+    assert results == [('BA286', 'C5001T'), ('wuhan', 'C5001T')]
+
+def test_analyze_mutations_matches_individual_functions():
+    tables = functions.load_reference_tables()
+    mutations = 'C897A, G3431T, A7842G, C18155T, G18308A, T13339C'
+    analysis = functions.analyze_mutations('gene', mutations, tables)
+    assert analysis.valid
+    assert (analysis.transitions, analysis.transversions) == functions.transition_or_transversion(mutations)
+    assert (analysis.mutators, analysis.potential_mutators) == functions.mut_lineage_parsing(mutations)
+    assert list(analysis.counts) == list(functions.make_bins(analysis.mutations.positions, 'gene')[0])
+    assert (analysis.likelihoods, analysis.most_likely) == functions.rank_distributions('gene', mutations, tables)
+    assert (analysis.times_more_likely, analysis.compared_to) == functions.times_more_likely(analysis.likelihoods)
+    invalid = functions.analyze_mutations('gene', 'C897A, banana', tables)
+    assert not invalid.valid and invalid.likelihoods is None
+
+def test_reference_data_loaded_once_per_process():
+    assert functions.get_reference_tables() is functions.get_reference_tables()
+    genelist, names = functions.parse_gene_files('gene')
+    names.append('extra')
+    # callers get their own copies of the cached gene tables
+    assert functions.parse_gene_files('gene')[1] == names[:-1]
+    assert functions._gene_files['gene'][0] == genelist
+
+def test_nextclade_jobs_run_in_background_and_cancel(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    slow = [sys.executable, '-c', 'import time; time.sleep(30)']
+    monkeypatch.setattr(nextcladefunctions, 'alignment_commands', lambda jobs: {i: slow for i in nextcladefunctions.ref_seqs})
+    monkeypatch.setattr(nextcladefunctions, 'result_cache', nextcladefunctions.ResultCache(max_entries=0))
+    monkeypatch.setattr(nextcladefunctions, '_job_queue', nextcladefunctions.JobQueue(workers=1))
+    upload = tmp_path / 'upload.fasta'
+    upload.write_text('>a\nACGT\n')
+    running = nextcladefunctions.submit_job(upload)
+    queued = nextcladefunctions.submit_job(upload)
+    # submitting doesn't wait for the alignments
+    while not running.processes:
+        time.sleep(0.01)
+    assert (running.status, queued.status) == ('running', 'queued')
+    start = time.perf_counter()
+    queued.cancel()
+    running.cancel()
+    running.future.result(timeout=10)
+    # the Nextclade processes were killed rather than waited for
+    assert time.perf_counter() - start < 5
+    assert (running.status, queued.status) == ('cancelled', 'cancelled')
+    assert running.result is None and running.done()
+
+def test_job_queue_is_fifo_with_admission_control(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    order = []
+    release = threading.Event()
+    def fake_records(input_path, job=None):
+        order.append(input_path)
+        release.wait(10)
+        return [('a', 'C3037T')]
+    monkeypatch.setattr(nextcladefunctions, 'execute_nextclade_records', fake_records)
+    queue = nextcladefunctions.JobQueue(workers=1, max_queued=2)
+    first = queue.submit(nextcladefunctions.NextcladeJob('first'))
+    while first.status != 'running':
+        time.sleep(0.01)
+    second, third = queue.submit(nextcladefunctions.NextcladeJob('second')), queue.submit(nextcladefunctions.NextcladeJob('third'))
+    assert (second.position(), third.position()) == (1, 2)
+    # the queue is full, so the next file is turned away straight away
+    with pytest.raises(nextcladefunctions.QueueFullError):
+        queue.submit(nextcladefunctions.NextcladeJob('fourth'))
+    second.cancel()
+    assert third.position() == 1
+    release.set()
+    assert third.future.result(timeout=10) == [('a', 'C3037T')]
+    assert order == ['first', 'third']
+    # the counters are updated just after the result is handed over
+    while queue.stats()['completed'] < 2:
+        time.sleep(0.01)
+    stats = queue.stats()
+    assert (stats['submitted'], stats['rejected'], stats['cancelled'], stats['completed']) == (3, 1, 1, 2)
+    assert stats['queued'] == 0 and stats['max_wait_time'] >= third.wait_time > 0
+
+def test_batch_results_table():
+    tables = functions.load_reference_tables()
+    samples = [('s1', 'BA2', 'C897A, G3431T, A7842G, C18155T'), ('s2', 'Error', 'Error'), ('s3', 'XBB', 'C3037T, A23403G')]
+    df = functions.batch_results_table('gene', samples, tables)
+    assert list(df['sample']) == ['s1', 's2', 's3']
+    assert list(df['best_reference']) == ['BA2', 'Error', 'XBB']
+    assert list(df['mutations_count']) == [4, 0, 2]
+    assert df['mutators'][0] == '18155'
+    assert set(tables.display_names) <= set(df.columns)
+    zipped, best_fit = functions.rank_distributions('gene', samples[0][2], tables)
+    assert df[tables.display_names[0]][0] == pytest.approx(zipped[0][0])
+    assert df['best_fit'][0] == dict(zip(tables.names, tables.display_names))[best_fit[1]]
+    assert df['best_fit'][1] == ''
+
+def test_batch_job_takes_one_place_in_the_queue(monkeypatch, tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    runs = []
+    def run_uncached(records, job=None):
+        runs.append(len(records))
+        return [('BA2', f'C{len(sequence)}T') for name, sequence in records]
+    monkeypatch.setattr(nextcladefunctions, 'run_uncached', run_uncached)
+    monkeypatch.setattr(nextcladefunctions, 'result_cache', nextcladefunctions.ResultCache(max_entries=0))
+    queue = nextcladefunctions.JobQueue(workers=1, max_queued=1)
+    monkeypatch.setattr(nextcladefunctions, '_job_queue', queue)
+    files = []
+    for i in range(30):
+        files.append(tmp_path / f'file{i}.fasta')
+        files[-1].write_text(''.join(f'>file{i}_{j}\n{"ACGT" * (i + 1)}{"A" * j}\n' for j in range(2)))
+    job = nextcladefunctions.submit_batch(files[:10] + [tmp_path / 'missing.fasta'] + files[10:])
+    result = job.future.result(timeout=10)
+    # every file was analyzed in one pass, without being turned away, and split back out in order
+    assert runs == [60]
+    assert len(result) == 31 and result[10] == [("", "Error", "Error")]
+    assert [[name for name, reference, mutations in records] for records in result[:10] + result[11:]] == \
+        [[f'file{i}_0', f'file{i}_1'] for i in range(30)]
+    assert result[11][1] == ('file10_1', 'BA2', 'C45T')
+    assert job.finished == result and job.status == 'done'
+    assert queue.stats()['rejected'] == 0
+
+def test_host_slots_limit_nextclade_processes_across_workers(tmp_path):
+    from covid_mutation_distribution import nextcladefunctions
+    if nextcladefunctions.fcntl is None:
+        pytest.skip('no file locks on this platform')
+    # another app worker holding the host's only slot, in a process of its own
+    holder = subprocess.Popen([sys.executable, '-c', f'''
+import fcntl, os, sys, time
+fd = os.open({str(tmp_path / 'slot-0')!r}, os.O_RDWR | os.O_CREAT)
+fcntl.flock(fd, fcntl.LOCK_EX)
+print('locked', flush=True)
+sys.stdin.read()
+'''], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    assert holder.stdout.readline().strip() == 'locked'
+    slots = nextcladefunctions.HostSlots(tmp_path, slots=1)
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    # no slot frees up, so the wait only ends when the job is cancelled
+    assert slots.acquire(cancelled, poll=0.01) is None
+    holder.stdin.close()
+    holder.wait()
+    slot = slots.acquire(poll=0.01)
+    assert slot is not None
+    slots.release(slot)